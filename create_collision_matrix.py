@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import argparse
+import time
+
+from pybullet_tools.pr2_utils import DRAKE_PR2_URDF, PR2_URDF
+from pybullet_tools.movo_constants import MOVO_URDF
+from pybullet_tools.flying_gripper_utils import FE_GRIPPER_URDF, FRANKA_URDF
+from pybullet_tools.utils import connect, disconnect, load_model, HideOutput, TURTLEBOT_URDF, elapsed_time, \
+    get_body_name, compute_collision_matrix, save_collision_matrix, NEVER_COLLIDE, ALWAYS_COLLIDE, SOMETIMES_COLLIDE
+
+URDF_FROM_ROBOT = {
+    'pr2': DRAKE_PR2_URDF,
+    'pr2_full': PR2_URDF,
+    'movo': MOVO_URDF,
+    'feg': FE_GRIPPER_URDF,
+    'franka': FRANKA_URDF,
+    'turtlebot': TURTLEBOT_URDF,
+}
+
+#######################################################
+
+def main():
+    parser = argparse.ArgumentParser()  # Automatically includes help
+    parser.add_argument('-robot', default='pr2', choices=sorted(URDF_FROM_ROBOT), help='robot to process.')
+    parser.add_argument('-urdf', default=None, help='overrides the robot URDF path.')
+    parser.add_argument('-num', type=int, default=10000, help='number of random configurations.')
+    parser.add_argument('-viewer', action='store_true', help='enable viewer.')
+    args = parser.parse_args()
+
+    connect(use_gui=args.viewer)
+    urdf = URDF_FROM_ROBOT[args.robot] if args.urdf is None else args.urdf
+    with HideOutput():
+        robot = load_model(urdf, fixed_base=True)
+
+    start_time = time.time()
+    matrix = compute_collision_matrix(robot, num_samples=args.num, verbose=True)
+    path = save_collision_matrix(robot, matrix, num_samples=args.num)
+    for category in [NEVER_COLLIDE, ALWAYS_COLLIDE, SOMETIMES_COLLIDE]:
+        print('{}: {} pairs'.format(category, sum(value == category for value in matrix.values())))
+    print('Robot: {} | Samples: {} | Time: {:.3f} | Wrote: {}'.format(
+        get_body_name(robot), args.num, elapsed_time(start_time), path))
+    disconnect()
+
+if __name__ == '__main__':
+    main()
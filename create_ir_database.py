@@ -6,14 +6,15 @@ import time
 
 from pybullet_tools.pr2_utils import set_arm_conf, get_other_arm, arm_conf, REST_LEFT_ARM, \
     get_carry_conf, get_gripper_link, GET_GRASPS, IR_FILENAME, get_database_file, DRAKE_PR2_URDF, \
-    set_group_conf, get_group_conf, get_base_pose
+    set_group_conf, get_group_conf, get_base_pose, save_inverse_reachability_array
 from pybullet_tools.utils import create_box, disconnect, add_data_path, connect, get_movable_joints, get_joint_positions, \
     sample_placement, set_pose, multiply, invert, set_joint_positions, pairwise_collision, inverse_kinematics, \
     get_link_pose, get_body_name, write_pickle, uniform_pose_generator, set_base_values, \
     load_pybullet, HideOutput, wait_if_gui, draw_point, point_from_pose, has_gui, elapsed_time, \
     sub_inverse_kinematics, BodySaver
 from pybullet_tools.pr2_problems import create_table
-from pybullet_tools.ikfast.pr2.ik import pr2_inverse_kinematics, is_ik_compiled
+from pybullet_tools.ikfast.pr2.ik import pr2_inverse_kinematics, is_ik_compiled, load_ik_cache, save_ik_cache, \
+    IK_CACHE_FILENAME
 from pybullet_tools.ikfast.utils import USE_CURRENT
 from pybullet_tools.pr2_primitives import get_stable_gen, get_grasp_gen, get_ik_ir_gen
 
@@ -34,6 +35,7 @@ def save_inverse_reachability(robot, arm, grasp_type, tool_link, gripper_from_ba
         'gripper_from_base': gripper_from_base_list,
     }
     write_pickle(path, data)
+    save_inverse_reachability_array(arm, grasp_type, gripper_from_base_list)
 
     if has_gui():
         handles = []
@@ -63,7 +65,7 @@ def create_inverse_reachability(robot, body, table, arm, grasp_type, max_attempt
             set_group_conf(robot, 'base', base_conf)
             if pairwise_collision(robot, table):
                 continue
-            grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose) #, nearby_conf=USE_CURRENT)
+            grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, cache=True) #, nearby_conf=USE_CURRENT)
             #conf = inverse_kinematics(robot, link, gripper_pose)
             if (grasp_conf is None) or pairwise_collision(robot, table):
                 continue
@@ -124,6 +126,7 @@ def main():
     parser.add_argument('-arm', required=True)
     parser.add_argument('-grasp', required=True)
     parser.add_argument('-viewer', action='store_true', help='enable viewer.')
+    parser.add_argument('-cache', action='store_true', help='persist the IK cache across runs.')
     args = parser.parse_args()
 
     arm = args.arm
@@ -144,8 +147,13 @@ def main():
     table = create_table()
     box = create_box(.07, .07, .14)
 
+    cache_path = get_database_file(IK_CACHE_FILENAME)
+    if args.cache:
+        print('Loaded {} cached IK solution sets'.format(load_ik_cache(cache_path)))
     #create_inverse_reachability(robot, box, table, arm=arm, grasp_type=grasp_type)
     create_inverse_reachability2(robot, box, table, arm=arm, grasp_type=grasp_type)
+    if args.cache:
+        save_ik_cache(cache_path)
     disconnect()
 
 if __name__ == '__main__':
@@ -31,7 +31,7 @@ from pybullet_tools.utils import connect, disconnect, wait_if_gui, LockRenderer,
     pairwise_collision, connect, get_pose, point_from_pose, \
     disconnect, get_joint_positions, enable_gravity, save_state, restore_state, HideOutput, remove_body, \
     get_distance, LockRenderer, get_min_limit, get_max_limit, has_gui, WorldSaver, wait_if_gui, add_line, SEPARATOR, \
-    BROWN, BLUE, WHITE, TAN, GREY, YELLOW, GREEN, BLACK, RED, CLIENTS
+    BROWN, BLUE, WHITE, TAN, GREY, YELLOW, GREEN, BLACK, RED, CLIENTS, instrument_stream_map
 
 from os.path import join, isfile
 from pddlstream.algorithms.algorithm import parse_problem, reset_globals
@@ -111,7 +111,8 @@ def get_stream_map(p, c, l, t):
         # 'TrajArmCollision': fn_from_constant(False),
         # 'TrajGraspCollision': fn_from_constant(False),
     }
-    return stream_map
+    # Attributes collision statistics to each stream
+    return instrument_stream_map(stream_map)
 
 from pybullet_tools.pr2_agent import opt_move_cost_fn, opt_pose_fn, opt_ik_fn, opt_ik_wconf_fn, opt_motion_fn, \
     move_cost_fn
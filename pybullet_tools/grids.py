@@ -0,0 +1,381 @@
+import heapq
+import math
+import time
+import numpy as np
+
+from collections import namedtuple, OrderedDict
+
+from .utils import get_aabb, get_aabbs, parse_body, get_base_values, set_base_values, get_joint_positions, \
+    set_joint_positions, get_moving_links, get_custom_limits, check_path, wrap_angle, circular_difference, \
+    elapsed_time, PoseSaver, ConfSaver, CIRCULAR_LIMITS, INF
+from .sdf import get_scene_hash
+
+GRID_RESOLUTION = 0.05 # meters
+NUM_HEADINGS = 16
+FLOOR_TOLERANCE = 0.01 # meters
+LATTICE_PADDING = 2. # meters
+MAX_GRIDS = 8
+GRID_CACHE = OrderedDict() # Least recently used grids
+PRIMITIVE_CACHE = {}
+
+# Grid directions whose endpoints lie on cell centers
+LATTICE_DIRECTIONS = [(1, 0), (2, 1), (1, 1), (1, 2), (0, 1), (-1, 2), (-1, 1), (-2, 1),
+                      (-1, 0), (-2, -1), (-1, -1), (-1, -2), (0, -1), (1, -2), (1, -1), (2, -1)]
+
+Primitive = namedtuple('Primitive', ['dx', 'dy', 'dh', 'cost', 'cells'])
+
+################################################################################
+
+class OccupancyGrid(object):
+    """
+    2D occupancy grid of the obstacle footprints that overlap the robot's height range
+    along with the distance transform from each cell to the nearest occupied cell
+    Maps derived from the grid are cached with it and evicted together
+    """
+    def __init__(self, occupied, lower, resolution=GRID_RESOLUTION):
+        from scipy.ndimage import distance_transform_edt
+        self.occupied = np.array(occupied, dtype=bool)
+        self.lower = np.array(lower, dtype=float)
+        self.resolution = resolution
+        self.distances = distance_transform_edt(~self.occupied, sampling=resolution)
+        self.cache = {}
+    @property
+    def shape(self):
+        return self.occupied.shape
+    def cells_from_points(self, points):
+        return np.floor((np.array(points)[..., :2] - self.lower) / self.resolution).astype(int)
+    def points_from_cells(self, cells):
+        return self.lower + self.resolution*(np.array(cells) + 0.5)
+    def interior(self, cell):
+        return all(1 <= c < s - 1 for c, s in zip(cell, self.shape))
+    def __repr__(self):
+        return '{}(shape={}, occupied={})'.format(self.__class__.__name__, self.shape, np.count_nonzero(self.occupied))
+
+def rasterize_obstacles(obstacles, base_limits, z_limits, resolution=GRID_RESOLUTION):
+    lower, upper = map(np.array, base_limits)
+    shape = tuple(np.ceil((upper - lower) / resolution).astype(int))
+    occupied = np.zeros(shape, dtype=bool)
+    z_lower, z_upper = z_limits
+    for obstacle in obstacles:
+        body, links = parse_body(obstacle)
+        for aabb_lower, aabb_upper in get_aabbs(body, links=links):
+            # Ignores the floor and anything above the robot
+            if (aabb_upper[2] <= z_lower + FLOOR_TOLERANCE) or (z_upper <= aabb_lower[2]):
+                continue
+            cell_lower = np.clip(np.floor((np.array(aabb_lower[:2]) - lower) / resolution).astype(int), 0, shape)
+            cell_upper = np.clip(np.ceil((np.array(aabb_upper[:2]) - lower) / resolution).astype(int), 0, shape)
+            occupied[cell_lower[0]:cell_upper[0], cell_lower[1]:cell_upper[1]] = True
+    return OccupancyGrid(occupied, lower, resolution=resolution)
+
+def get_occupancy_grid(obstacles, base_limits, z_limits, resolution=GRID_RESOLUTION):
+    # Rasterized once per scene
+    key = (get_scene_hash(obstacles, resolution=resolution, padding=0.),
+           tuple(map(tuple, base_limits)), tuple(np.round(z_limits, 3)))
+    if key in GRID_CACHE:
+        GRID_CACHE[key] = GRID_CACHE.pop(key)
+    else:
+        GRID_CACHE[key] = rasterize_obstacles(obstacles, base_limits, z_limits, resolution=resolution)
+        while len(GRID_CACHE) > MAX_GRIDS:
+            GRID_CACHE.popitem(last=False)
+    return GRID_CACHE[key]
+
+################################################################################
+
+def get_footprint(body, joints=None, links=None):
+    # Robot AABB relative to its (x, y) at zero heading, including the arms
+    if joints is None:
+        with PoseSaver(body):
+            x, y, _ = get_base_values(body)
+            set_base_values(body, (x, y, 0.))
+            lower, upper = get_aabb(body, links=links)
+    else:
+        with ConfSaver(body):
+            x, y, _ = get_joint_positions(body, joints)
+            set_joint_positions(body, joints, (x, y, 0.))
+            lower, upper = get_aabb(body, links=get_moving_links(body, joints) if links is None else links)
+    return (np.array(lower[:2]) - [x, y], np.array(upper[:2]) - [x, y]), (lower[2], upper[2])
+
+def get_headings(num_headings=NUM_HEADINGS):
+    return np.linspace(CIRCULAR_LIMITS[0], CIRCULAR_LIMITS[1], num=num_headings, endpoint=False)
+
+def get_footprint_kernel(footprint, theta, resolution=GRID_RESOLUTION):
+    lower, upper = footprint
+    radius = int(np.ceil(np.max(np.abs([lower, upper])) * np.sqrt(2) / resolution)) + 1
+    offsets = np.indices((2*radius + 1, 2*radius + 1)).reshape(2, -1).T - radius
+    points = resolution*offsets
+    # Rotates the cell offsets into the robot frame
+    c, s = np.cos(theta), np.sin(theta)
+    local = points.dot(np.array([[c, -s], [s, c]]))
+    half = resolution / 2.
+    inside = np.all((lower - half <= local) & (local <= upper + half), axis=1)
+    return inside.reshape(2*radius + 1, 2*radius + 1)
+
+def get_collision_maps(grid, footprint, headings):
+    # Cells where the footprint at each heading overlaps an occupied cell or leaves the grid
+    from scipy.signal import fftconvolve
+    key = ('collision', tuple(np.round(np.concatenate(footprint), 3)), tuple(headings))
+    if key in grid.cache:
+        return grid.cache[key].copy()
+    maps = []
+    for theta in headings:
+        kernel = get_footprint_kernel(footprint, theta, grid.resolution)
+        radius = kernel.shape[0] // 2
+        occupied = np.pad(grid.occupied.astype(float), radius, mode='constant', constant_values=1.)
+        # Correlation with the kernel is convolution with the flipped kernel
+        overlap = fftconvolve(occupied, kernel[::-1, ::-1].astype(float), mode='valid')
+        maps.append(overlap > 0.5)
+    maps = np.array(maps)
+    # The search never expands border cells, so neighbors are always within the grid
+    maps[:, [0, -1], :] = True
+    maps[:, :, [0, -1]] = True
+    grid.cache[key] = maps
+    return maps.copy()
+
+################################################################################
+
+def astar(start, goal, successors_fn, heuristic_fn, max_time=INF):
+    start_time = time.time()
+    costs = {start: 0.}
+    parents = {start: None}
+    queue = [(heuristic_fn(start), 0., start)]
+    while queue and (elapsed_time(start_time) < max_time):
+        _, cost, state = heapq.heappop(queue)
+        if state == goal:
+            states = []
+            while state is not None:
+                states.append(state)
+                state = parents[state]
+            return states[::-1]
+        if cost > costs[state]:
+            continue
+        for neighbor, step in successors_fn(state):
+            new_cost = cost + step
+            if new_cost < costs.get(neighbor, INF):
+                costs[neighbor] = new_cost
+                parents[neighbor] = state
+                heapq.heappush(queue, (new_cost + heuristic_fn(neighbor), new_cost, neighbor))
+    return None
+
+def grid_search(grid, collision_maps, start_cell, goal_cell, weights=np.ones(3), clearance_weight=0.1,
+                max_clearance=0.5, max_time=INF):
+    """
+    A* over (x, y, heading) cells with 8-connected translations and rotations between adjacent headings
+    The cost penalizes cells close to obstacles using the distance transform
+    """
+    num_headings = len(collision_maps)
+    angle = 2*np.pi / num_headings
+    penalties = clearance_weight*np.maximum(max_clearance - grid.distances, 0.) / max_clearance
+    moves = [(dx, dy, 0, grid.resolution*np.hypot(weights[0]*dx, weights[1]*dy))
+             for dx in [-1, 0, 1] for dy in [-1, 0, 1] if (dx, dy) != (0, 0)] + \
+            [(0, 0, dh, angle*weights[2]) for dh in [-1, 1]]
+
+    def heuristic(cell):
+        dx, dy = grid.resolution*(cell[0] - goal_cell[0]), grid.resolution*(cell[1] - goal_cell[1])
+        dh = abs(cell[2] - goal_cell[2]) % num_headings
+        return math.hypot(weights[0]*dx, weights[1]*dy) + weights[2]*angle*min(dh, num_headings - dh)
+
+    def successors(cell):
+        x, y, h = cell
+        for dx, dy, dh, step in moves:
+            neighbor = (x + dx, y + dy, (h + dh) % num_headings)
+            if not collision_maps[neighbor[2], neighbor[0], neighbor[1]]:
+                yield neighbor, step + penalties[neighbor[0], neighbor[1]]
+    return astar(tuple(start_cell), tuple(goal_cell), successors, heuristic, max_time=max_time)
+
+def plan_grid_base_motion(body, end_conf, base_limits, obstacles=[], weights=np.ones(3), extend_fn=None,
+                          collision_fn=None, start_conf=None, resolution=GRID_RESOLUTION,
+                          num_headings=NUM_HEADINGS, max_time=INF, verbose=False, **kwargs):
+    """
+    Plans over an occupancy grid of the obstacle footprints and only uses Bullet to verify the final path
+    """
+    start_time = time.time()
+    if start_conf is None:
+        start_conf = get_base_values(body)
+    footprint, z_limits = get_footprint(body)
+    grid = get_occupancy_grid(obstacles, base_limits, z_limits, resolution=resolution)
+    headings = get_headings(num_headings)
+    collision_maps = get_collision_maps(grid, footprint, headings)
+
+    def cell_from_conf(conf):
+        heading = int(np.round(wrap_angle(conf[2] - headings[0]) / (2*np.pi / num_headings))) % num_headings
+        return tuple(grid.cells_from_points(conf[:2])) + (heading,)
+
+    start_cell, goal_cell = cell_from_conf(start_conf), cell_from_conf(end_conf)
+    if not (grid.interior(start_cell[:2]) and grid.interior(goal_cell[:2])):
+        return None
+    # The start and goal are verified by Bullet rather than the conservative footprint
+    for cell in [start_cell, goal_cell]:
+        collision_maps[cell[2], cell[0], cell[1]] = False
+    cells = grid_search(grid, collision_maps, start_cell, goal_cell, weights=weights,
+                        max_time=max_time - elapsed_time(start_time), **kwargs)
+    if verbose:
+        print('{} | cells: {} | time: {:.3f}'.format(grid, None if cells is None else len(cells),
+                                                     elapsed_time(start_time)))
+    if cells is None:
+        return None
+    waypoints = [tuple(grid.points_from_cells(cell[:2])) + (headings[cell[2]],) for cell in cells[1:-1]]
+    waypoints = [tuple(start_conf)] + waypoints + [tuple(end_conf)]
+    if collision_fn is None:
+        return waypoints
+    return check_path(waypoints, extend_fn, collision_fn, bisect=True)
+
+################################################################################
+
+def get_lattice_headings(num_headings=NUM_HEADINGS):
+    assert num_headings in [4, 8, 16]
+    directions = LATTICE_DIRECTIONS[::len(LATTICE_DIRECTIONS) // num_headings]
+    return directions, [math.atan2(dy, dx) for dx, dy in directions]
+
+def get_swept_cells(footprint, poses, resolution=GRID_RESOLUTION):
+    # Cell offsets whose square may overlap the footprint at any of the poses relative to the cell center
+    lower, upper = footprint
+    poses = np.array(poses, dtype=float)
+    extent = np.max(np.abs([lower, upper]))*np.sqrt(2) + np.max(np.abs(poses[:, :2]))
+    radius = int(np.ceil(extent / resolution)) + 1
+    offsets = np.indices((2*radius + 1, 2*radius + 1)).reshape(2, -1).T - radius
+    points = resolution*offsets
+    margin = resolution*np.sqrt(2) / 2.
+    swept = np.zeros(len(offsets), dtype=bool)
+    for x, y, theta in poses:
+        c, s = np.cos(theta), np.sin(theta)
+        local = (points - [x, y]).dot(np.array([[c, -s], [s, c]]))
+        swept |= np.all((lower - margin <= local) & (local <= upper + margin), axis=1)
+    return offsets[swept]
+
+def get_motion_primitives(footprint, resolution=GRID_RESOLUTION, num_headings=NUM_HEADINGS,
+                          reversible=True, weights=np.ones(3)):
+    """
+    Turn-drive-turn primitives for each lattice heading along with the cells that each sweeps
+    Computed once per footprint and reused by every query
+    """
+    key = (tuple(np.round(np.concatenate(footprint), 3)), resolution, num_headings, reversible, tuple(weights))
+    if key in PRIMITIVE_CACHE:
+        return PRIMITIVE_CACHE[key]
+    directions, headings = get_lattice_headings(num_headings)
+    lower, upper = footprint
+    radius = max(math.hypot(x, y) for x in [lower[0], upper[0]] for y in [lower[1], upper[1]])
+    primitives = []
+    for h, ((dx, dy), theta) in enumerate(zip(directions, headings)):
+        primitives.append([])
+        for sign in ([+1, -1] if reversible else [+1]):
+            # Drives straight to the next cell center along the heading
+            num = int(np.ceil(2*math.hypot(dx, dy))) + 1
+            poses = [(sign*t*resolution*dx, sign*t*resolution*dy, theta) for t in np.linspace(0, 1, num)]
+            primitives[h].append(Primitive(sign*dx, sign*dy, 0, resolution*math.hypot(weights[0]*dx, weights[1]*dy),
+                                           get_swept_cells(footprint, poses, resolution)))
+        for dh in [-1, +1]:
+            # Turns in place to the adjacent heading
+            angle = circular_difference(headings[(h + dh) % num_headings], theta)
+            num = int(np.ceil(2*radius*abs(angle) / resolution)) + 1
+            poses = [(0., 0., theta + t*angle) for t in np.linspace(0, 1, num)]
+            primitives[h].append(Primitive(0, 0, dh, weights[2]*abs(angle),
+                                           get_swept_cells(footprint, poses, resolution)))
+    PRIMITIVE_CACHE[key] = primitives
+    return primitives
+
+def get_blocked_maps(occupied, primitives, offset):
+    # Cells from which each primitive sweeps an occupied cell, where occupied is padded by offset
+    from scipy.signal import fftconvolve
+    size = 2*offset + 1
+    blocked = []
+    for heading_primitives in primitives:
+        blocked.append([])
+        for primitive in heading_primitives:
+            kernel = np.zeros((size, size))
+            kernel[primitive.cells[:, 0] + offset, primitive.cells[:, 1] + offset] = 1.
+            overlap = fftconvolve(occupied.astype(float), kernel[::-1, ::-1], mode='valid')
+            blocked[-1].append(overlap > 0.5)
+    return blocked
+
+def plan_lattice_motion(body, joints, end_conf, obstacles=[], weights=np.ones(3), reversible=True, extend_fn=None,
+                        collision_fn=None, start_conf=None, custom_limits={}, resolution=GRID_RESOLUTION,
+                        num_headings=NUM_HEADINGS, padding=LATTICE_PADDING, max_time=INF, verbose=False):
+    """
+    Plans over a state lattice of precomputed motion primitives for a nonholonomic (x, y, theta) base
+    Primitives are checked by looking up their swept cells in the occupancy grid and Bullet only verifies the final path
+    """
+    start_time = time.time()
+    assert len(joints) == len(end_conf) == 3
+    if start_conf is None:
+        start_conf = get_joint_positions(body, joints)
+    footprint, z_limits = get_footprint(body, joints)
+    # Rounded to meters so that nearby queries share a rasterized grid
+    lower = np.floor(np.minimum(start_conf[:2], end_conf[:2]) - padding)
+    upper = np.ceil(np.maximum(start_conf[:2], end_conf[:2]) + padding)
+    custom_lower, custom_upper = get_custom_limits(body, joints[:2], custom_limits)
+    base_limits = (np.maximum(lower, custom_lower), np.minimum(upper, custom_upper))
+    grid = get_occupancy_grid(obstacles, base_limits, z_limits, resolution=resolution)
+    _, headings = get_lattice_headings(num_headings)
+    primitives = get_motion_primitives(footprint, resolution, num_headings, reversible=reversible, weights=weights)
+
+    def state_from_conf(conf):
+        heading = int(np.argmin([abs(circular_difference(conf[2], theta)) for theta in headings]))
+        return tuple(grid.cells_from_points(conf[:2])) + (heading,)
+
+    def conf_from_state(state):
+        return tuple(grid.points_from_cells(state[:2])) + (headings[state[2]],)
+
+    def connect_state(conf, reverse=False):
+        # Nearest lattice state whose turn-drive-turn connection to conf is collision-free
+        x, y, h = state_from_conf(conf)
+        states = [(x + dx, y + dy, h) for dx in [-1, 0, 1] for dy in [-1, 0, 1] if grid.interior((x + dx, y + dy))]
+        for state in sorted(states, key=lambda s: np.linalg.norm(np.subtract(conf_from_state(s)[:2], conf[:2]))):
+            edge = [conf, conf_from_state(state)]
+            if (collision_fn is None) or (check_path(edge[::-1] if reverse else edge,
+                                                     extend_fn, collision_fn) is not None):
+                return state
+        return None
+
+    start_state, goal_state = connect_state(start_conf), connect_state(end_conf, reverse=True)
+    if (start_state is None) or (goal_state is None):
+        return None
+    # Cells outside of the grid are occupied
+    offset = max(np.max(np.abs(primitive.cells)) for primitive in sum(primitives, [])) + 1
+    occupied = np.pad(grid.occupied, offset, mode='constant', constant_values=True)
+    key = ('blocked', tuple(np.round(np.concatenate(footprint), 3)), num_headings, reversible)
+    if key not in grid.cache:
+        grid.cache[key] = get_blocked_maps(occupied, primitives, offset)
+    blocked = [list(heading_blocked) for heading_blocked in grid.cache[key]]
+    # The start and goal are verified by Bullet rather than the conservative footprint
+    windows = []
+    for conf, state in [(start_conf, start_state), (end_conf, goal_state)]:
+        x, y, theta = conf_from_state(state)
+        poses = [(conf[0] - x, conf[1] - y, conf[2]), (0., 0., theta)]
+        cells = np.clip(get_swept_cells(footprint, poses, resolution) + state[:2] + offset,
+                        0, np.array(occupied.shape) - 1)
+        cells = cells[occupied[cells[:, 0], cells[:, 1]]]
+        if len(cells) != 0:
+            occupied[cells[:, 0], cells[:, 1]] = False
+            # Only states whose primitives sweep a carved cell change
+            windows.append((np.maximum(np.min(cells, axis=0) - 2*offset, 0),
+                            np.minimum(np.max(cells, axis=0), np.array(grid.shape) - 1)))
+    for (x0, y0), (x1, y1) in windows:
+        local = get_blocked_maps(occupied[x0:x1 + 2*offset + 1, y0:y1 + 2*offset + 1], primitives, offset)
+        for h, heading_blocked in enumerate(blocked):
+            for i, primitive_blocked in enumerate(heading_blocked):
+                if primitive_blocked is grid.cache[key][h][i]:
+                    heading_blocked[i] = primitive_blocked = primitive_blocked.copy()
+                primitive_blocked[x0:x1 + 1, y0:y1 + 1] = local[h][i]
+
+    def successors(state):
+        x, y, h = state
+        for i, primitive in enumerate(primitives[h]):
+            if not blocked[h][i][x, y]:
+                yield (x + primitive.dx, y + primitive.dy, (h + primitive.dh) % num_headings), primitive.cost
+
+    rotations = [weights[2]*abs(circular_difference(theta, headings[goal_state[2]])) for theta in headings]
+
+    def heuristic(state):
+        dx, dy = grid.resolution*(state[0] - goal_state[0]), grid.resolution*(state[1] - goal_state[1])
+        return math.hypot(weights[0]*dx, weights[1]*dy) + rotations[state[2]]
+
+    states = astar(start_state, goal_state, successors, heuristic, max_time=max_time - elapsed_time(start_time))
+    if verbose:
+        print('{} | states: {} | time: {:.3f}'.format(grid, None if states is None else len(states),
+                                                      elapsed_time(start_time)))
+    if states is None:
+        return None
+    waypoints = [tuple(start_conf)] + list(map(conf_from_state, states)) + [tuple(end_conf)]
+    if collision_fn is None:
+        return waypoints
+    return check_path(waypoints, extend_fn, collision_fn, bisect=True)
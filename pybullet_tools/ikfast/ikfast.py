@@ -11,14 +11,16 @@ sys.path.append(PARENT_DIR)
 
 from itertools import islice, chain
 
-from .utils import compute_inverse_kinematics, compute_forward_kinematics
+from .utils import compute_inverse_kinematics, compute_inverse_kinematics_batch, compute_forward_kinematics
+from ..kinematics import get_link_poses, dls_inverse_kinematics
 from ..utils import get_link_pose, link_from_name, multiply, invert, parent_joint_from_link, parent_link_from_joint, \
-    prune_fixed_joints, joints_from_names, INF, get_difference_fn, \
+    prune_fixed_joints, joints_from_names, INF, get_difference_fn, get_difference_array_fn, is_circular, \
     get_joint_positions, get_min_limits, get_max_limits, interval_generator, elapsed_time, randomize, violates_limits, \
     get_length, get_relative_pose, set_joint_positions, get_pose_distance, ConfSaver, \
     sub_inverse_kinematics, set_configuration, wait_for_user, multiple_sub_inverse_kinematics, get_ordered_ancestors
 
 SETUP_FILENAME = 'setup.py'
+BATCH_SIZE = 64
 
 
 def get_module_name(ikfast_info):
@@ -90,9 +92,7 @@ def get_ik_joints(robot, ikfast_info, tool_link):
 ##################################################
 
 def check_solution(robot, joints, conf, tool_link, target_pose, tolerance=1e-6):
-    with ConfSaver(robot, joints=joints):
-        set_joint_positions(robot, joints, conf)
-        actual_pose = get_link_pose(robot, tool_link)
+    [actual_pose] = get_link_poses(robot, joints, [conf], tool_link)
     pos_distance, ori_distance = get_pose_distance(target_pose, actual_pose)
     valid = (pos_distance <= tolerance) and (ori_distance <= tolerance)
     if not valid:
@@ -168,23 +168,75 @@ def ikfast_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
                 yield conf
 
 
-def closest_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target,
-                               max_candidates=INF, norm=INF, verbose=True, **kwargs):
+def get_free_sample_fn(robot, ikfast_info, fixed_joints=[], max_distance=INF):
+    free_joints = joints_from_names(robot, ikfast_info.free_joints)
+    current_positions = np.array(get_joint_positions(robot, free_joints))
+    free_deltas = np.array([0. if joint in fixed_joints else max_distance for joint in free_joints])
+    lower_limits = np.maximum(get_min_limits(robot, free_joints), current_positions - free_deltas)
+    upper_limits = np.minimum(get_max_limits(robot, free_joints), current_positions + free_deltas)
+    def fn(num_samples, include_current=False):
+        free_samples = np.random.uniform(lower_limits, upper_limits, size=(num_samples, len(free_joints)))
+        if include_current and num_samples:
+            free_samples[0] = current_positions
+        return free_samples
+    return fn
+
+
+def ikfast_inverse_kinematics_batch(robot, ikfast_info, tool_link, world_from_target, free_samples,
+                                    norm=INF, max_distance=INF):
+    """
+    Solves for all free joint samples within a single call to the compiled solver
+    :param free_samples: (N, num_free) array of free joint values
+    :return: (M, num_joints) array of solutions within the joint limits sorted by their distance to the current conf
+    """
+    if max_distance is None:
+        max_distance = INF
+    ikfast = import_ikfast(ikfast_info)
+    ik_joints = get_ik_joints(robot, ikfast_info, tool_link)
+    base_from_ee = get_base_from_ee(robot, ikfast_info, tool_link, world_from_target)
+    solutions, _ = compute_inverse_kinematics_batch(ikfast, base_from_ee, free_samples, len(ik_joints))
+    # Same as violates_limits
+    circular = np.array([is_circular(robot, joint) for joint in ik_joints], dtype=bool)
+    lower_limits = np.where(circular, -INF, get_min_limits(robot, ik_joints))
+    upper_limits = np.where(circular, +INF, get_max_limits(robot, ik_joints))
+    valid = np.all((lower_limits <= solutions) & (solutions <= upper_limits), axis=1)
+    difference_fn = get_difference_array_fn(robot, ik_joints)
+    distances = np.linalg.norm(difference_fn(get_joint_positions(robot, ik_joints), solutions), ord=norm, axis=1) \
+        if len(solutions) else np.zeros(0)
+    valid &= (distances <= max_distance)
+    order = np.argsort(distances[valid], kind='stable')
+    return solutions[valid][order]
+
+
+def closest_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, max_candidates=INF, norm=INF,
+                               verbose=True, fixed_joints=[], max_attempts=INF, max_time=INF, max_distance=INF,
+                               batch_size=BATCH_SIZE, **kwargs):
+    assert (max_attempts < INF) or (max_time < INF)
+    if max_distance is None:
+        max_distance = INF
     start_time = time.time()
     ik_joints = get_ik_joints(robot, ikfast_info, tool_link)
     current_conf = get_joint_positions(robot, ik_joints)
-    generator = ikfast_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, norm=norm, **kwargs)
-    if max_candidates < INF:
-        generator = islice(generator, max_candidates)
-    solutions = list(generator)
+    sample_fn = get_free_sample_fn(robot, ikfast_info, fixed_joints=fixed_joints, max_distance=max_distance)
+    batches = []
+    num_attempts = num_solutions = 0
+    while (num_attempts < max_attempts) and (elapsed_time(start_time) < max_time) and (num_solutions < max_candidates):
+        # The first sample is the current free joint values
+        free_samples = sample_fn(int(min(batch_size, max_attempts - num_attempts)), include_current=(num_attempts == 0))
+        batches.append(ikfast_inverse_kinematics_batch(robot, ikfast_info, tool_link, world_from_target, free_samples,
+                                                       norm=norm, max_distance=max_distance))
+        num_attempts += len(free_samples)
+        num_solutions += len(batches[-1])
+    solutions = np.vstack(batches)[:int(min(max_candidates, num_solutions))] if batches else np.zeros((0, len(ik_joints)))
     # TODO: relative to joint limits
-    difference_fn = get_difference_fn(robot, ik_joints) # get_distance_fn
-    solutions = sorted(solutions, key=lambda q: get_length(difference_fn(q, current_conf), norm=norm))
+    difference_fn = get_difference_array_fn(robot, ik_joints)
+    distances = np.linalg.norm(difference_fn(solutions, current_conf), ord=norm, axis=1) \
+        if len(solutions) else np.zeros(0)
+    solutions = solutions[np.argsort(distances, kind='stable')]
     if verbose:
-        min_distance = min([INF] + [get_length(difference_fn(q, current_conf), norm=norm) for q in solutions])
         print('Identified {} IK solutions with minimum distance of {:.3f} in {:.3f} seconds'.format(
-            len(solutions), min_distance, elapsed_time(start_time)))
-    return iter(solutions)
+            len(solutions), min([INF] + list(distances)), elapsed_time(start_time)))
+    return iter(map(tuple, solutions))
 
 
 ##################################################
@@ -205,8 +257,46 @@ def pybullet_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target
         yield get_joint_positions(robot, ik_joints)
 
 
+def numpy_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=[], max_candidates=INF,
+                             max_attempts=INF, max_time=INF, max_distance=INF, norm=INF, custom_limits={},
+                             num_seeds=32, min_distance=1e-2, **kwargs):
+    # Multi-seed damped least-squares IK for robots without a compiled IKFast module
+    # Each attempt restarts num_seeds seeds and yields the solutions that are new before the next attempt
+    assert (max_attempts < INF) or (max_time < INF)
+    if max_distance is None:
+        max_distance = INF
+    start_time = time.time()
+    ik_joints = get_ik_joints(robot, ikfast_info, tool_link)
+    free_joints = [joint for joint in ik_joints if joint not in fixed_joints]
+    assert free_joints
+    free_indices = [ik_joints.index(joint) for joint in free_joints]
+    current_conf = np.array(get_joint_positions(robot, ik_joints))
+    difference_fn = get_difference_array_fn(robot, ik_joints)
+    free_difference_fn = get_difference_array_fn(robot, free_joints)
+    found = np.zeros((0, len(free_joints)))
+    num_attempts = num_candidates = 0
+    while (num_attempts < max_attempts) and (elapsed_time(start_time) < max_time) and (num_candidates < max_candidates):
+        free_solutions = dls_inverse_kinematics(robot, free_joints, tool_link, world_from_target, num_seeds=num_seeds,
+                                                include_current=(num_attempts == 0), custom_limits=custom_limits,
+                                                max_time=max_time - elapsed_time(start_time), min_distance=min_distance)
+        num_attempts += 1
+        for free_solution in free_solutions:
+            if len(found) and np.any(np.linalg.norm(free_difference_fn(found, free_solution), axis=1) <= min_distance):
+                continue
+            found = np.vstack([found, free_solution])
+            solution = np.array(current_conf)
+            solution[free_indices] = free_solution
+            if np.linalg.norm(difference_fn(solution, current_conf), ord=norm) <= max_distance:
+                num_candidates += 1
+                yield tuple(solution)
+                if num_candidates >= max_candidates:
+                    return
+
+
 def either_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=[],
                               use_pybullet=False, **kwargs):
-    if not use_pybullet and is_ik_compiled(ikfast_info):
+    if use_pybullet:
+        return pybullet_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=[])
+    if is_ik_compiled(ikfast_info):
         return closest_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=fixed_joints, **kwargs)
-    return pybullet_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=[])
+    return numpy_inverse_kinematics(robot, ikfast_info, tool_link, world_from_target, fixed_joints=fixed_joints, **kwargs)
@@ -1,11 +1,16 @@
 import random
+import os
+
+import numpy as np
+
+from collections import OrderedDict, namedtuple
 
 from ..utils import get_ik_limits, compute_forward_kinematics, compute_inverse_kinematics, select_solution, \
-    USE_ALL, USE_CURRENT
+    compute_inverse_kinematics_batch, USE_ALL, USE_CURRENT
 from ...pr2_utils import PR2_TOOL_FRAMES, get_torso_arm_joints, get_gripper_link, get_arm_joints, side_from_arm
 from ...utils import multiply, get_link_pose, link_from_name, get_joint_positions, \
     joint_from_name, invert, get_custom_limits, all_between, sub_inverse_kinematics, set_joint_positions, \
-    get_joint_positions, pairwise_collision
+    get_joint_positions, pairwise_collision, read_pickle, write_pickle, ensure_dir
 from ...ikfast.utils import IKFastInfo
 #from ...ikfast.ikfast import closest_inverse_kinematics # TODO: use these functions instead
 
@@ -41,6 +46,54 @@ def get_if_info(arm):
 
 #####################################
 
+# LRU cache of base-relative IK solution sets
+IKCacheEntry = namedtuple('IKCacheEntry', ['base_from_ik', 'free_values', 'solutions', 'indices'])
+IK_CACHE = OrderedDict()
+IK_CACHE_SIZE = 10000
+IK_CACHE_RESOLUTION = (0.01, np.pi/64) # meters, radians
+IK_CACHE_SAMPLES = 100 # maximum number of sampled values retained per entry
+IK_CACHE_FILENAME = 'pr2_ik_cache.pickle'
+
+def get_ik_cache_key(arm, base_from_ik, sampled_limits, resolution=IK_CACHE_RESOLUTION):
+    pos_resolution, ori_resolution = resolution
+    point, quat = map(np.array, base_from_ik)
+    if quat[3] < 0: # q and -q are the same rotation
+        quat = -quat
+    limits = np.array(sampled_limits).flatten()
+    return (arm, tuple(np.round(point / pos_resolution).astype(int)),
+            tuple(np.round(quat / (ori_resolution / 2.)).astype(int)),
+            tuple(np.round(limits / pos_resolution).astype(int)))
+
+def get_cached_ik(key):
+    if key not in IK_CACHE:
+        return None
+    IK_CACHE.move_to_end(key)
+    return IK_CACHE[key]
+
+def add_cached_ik(key, entry, max_size=IK_CACHE_SIZE):
+    IK_CACHE[key] = entry
+    IK_CACHE.move_to_end(key)
+    while len(IK_CACHE) > max_size:
+        IK_CACHE.popitem(last=False)
+    return entry
+
+def clear_ik_cache():
+    IK_CACHE.clear()
+
+def save_ik_cache(filename):
+    ensure_dir(os.path.abspath(filename))
+    write_pickle(filename, list(IK_CACHE.items()))
+    return filename
+
+def load_ik_cache(filename, max_size=IK_CACHE_SIZE):
+    if not os.path.exists(filename):
+        return 0
+    for key, entry in read_pickle(filename):
+        add_cached_ik(key, IKCacheEntry(*entry), max_size=max_size)
+    return len(IK_CACHE)
+
+#####################################
+
 def get_tool_pose(robot, arm):
     from .ikLeft import leftFK
     from .ikRight import rightFK
@@ -85,16 +138,80 @@ def get_ik_generator(robot, arm, ik_pose, torso_limits=USE_ALL, upper_limits=USE
         if all(lower == upper for lower, upper in sampled_limits):
             break
 
+def get_ik_batch_fn(robot, arm, ik_pose, torso_limits=USE_ALL, upper_limits=USE_ALL, custom_limits={}, cache=False):
+    from . import ikLeft, ikRight
+    arm_ikfast = {'left': ikLeft, 'right': ikRight}
+    world_from_base = get_link_pose(robot, link_from_name(robot, BASE_FRAME))
+    base_from_ik = multiply(invert(world_from_base), ik_pose)
+    sampled_joints = [joint_from_name(robot, name) for name in [TORSO_JOINT, UPPER_JOINT[arm]]]
+    sampled_limits = [get_ik_limits(robot, joint, limits) for joint, limits in zip(sampled_joints, [torso_limits, upper_limits])]
+    lower, upper = map(np.array, zip(*sampled_limits))
+    arm_joints = get_torso_arm_joints(robot, arm)
+    min_limits, max_limits = map(np.array, get_custom_limits(robot, arm_joints, custom_limits))
+    key = get_ik_cache_key(arm, base_from_ik, sampled_limits) if cache else None
+
+    def solve(sampled_values, entry=None):
+        confs, indices = compute_inverse_kinematics_batch(arm_ikfast[arm], base_from_ik, sampled_values, len(arm_joints))
+        if (key is not None) and len(confs):
+            # Only retains the sampled values that produced solutions
+            # Infeasible sets are not cached because another batch of samples may succeed
+            successes = np.unique(indices)
+            free_values, indices = sampled_values[successes], np.searchsorted(successes, indices)
+            if entry is not None:
+                # Extends the existing set, dropping its oldest sampled values beyond IK_CACHE_SAMPLES
+                num_dropped = max(len(entry.free_values) + len(free_values) - IK_CACHE_SAMPLES, 0)
+                retained = entry.indices >= num_dropped
+                free_values = np.vstack([entry.free_values[num_dropped:], free_values])
+                indices = np.concatenate([entry.indices[retained] - num_dropped,
+                                          indices + len(entry.free_values) - num_dropped])
+                confs = np.vstack([entry.solutions[retained], confs])
+            add_cached_ik(key, IKCacheEntry(base_from_ik, free_values, confs, indices))
+        return confs, indices
+
+    def fn(num_samples):
+        # Solves for num_samples sampled torso and upper arm values in a single call
+        entry = get_cached_ik(key) if key is not None else None
+        if entry is None:
+            confs, indices = solve(np.random.uniform(lower, upper, size=(num_samples, len(sampled_joints))))
+        elif np.allclose(np.concatenate(entry.base_from_ik), np.concatenate(base_from_ik), rtol=0., atol=1e-9):
+            # A repeated target usually means that the previous solutions were rejected downstream (e.g. by collisions)
+            # Samples new torso and upper arm values on every hit and adds their solutions to the cached set
+            confs, indices = solve(np.random.uniform(lower, upper, size=(num_samples, len(sampled_joints))), entry=entry)
+            if not len(confs):
+                confs, indices = entry.solutions, entry.indices
+        else:
+            # Nearby targets are likely solvable using the same sampled values
+            confs, indices = compute_inverse_kinematics_batch(arm_ikfast[arm], base_from_ik, entry.free_values, len(arm_joints))
+            if not len(confs):
+                confs, indices = solve(np.random.uniform(lower, upper, size=(num_samples, len(sampled_joints))))
+        valid = np.all((min_limits <= confs) & (confs <= max_limits), axis=1)
+        return confs[valid], indices[valid]
+    return fn
+
 def get_tool_from_ik(robot, arm):
     # TODO: change PR2_TOOL_FRAMES[arm] to be IK_LINK[arm]
     world_from_tool = get_link_pose(robot, link_from_name(robot, PR2_TOOL_FRAMES[arm]))
     world_from_ik = get_link_pose(robot, link_from_name(robot, IK_FRAME[arm]))
     return multiply(invert(world_from_tool), world_from_ik)
 
-def sample_tool_ik(robot, arm, tool_pose, nearby_conf=USE_ALL, max_attempts=25, **kwargs):
+def sample_tool_ik(robot, arm, tool_pose, nearby_conf=USE_ALL, max_attempts=25, batch=True, cache=False, **kwargs):
     ik_pose = multiply(tool_pose, get_tool_from_ik(robot, arm))
-    generator = get_ik_generator(robot, arm, ik_pose, **kwargs)
     arm_joints = get_torso_arm_joints(robot, arm)
+    if batch:
+        # Solves doubling batches of attempts and selects among the solutions of a successful attempt
+        # Cached solution sets are computed using all attempts at once
+        batch_fn = get_ik_batch_fn(robot, arm, ik_pose, cache=cache, **kwargs)
+        num_attempts, batch_size = 0, (max_attempts if cache else 1)
+        while num_attempts < max_attempts:
+            num_samples = min(batch_size, max_attempts - num_attempts)
+            solutions, indices = batch_fn(num_samples)
+            if len(solutions):
+                candidates = list(solutions[indices == random.choice(indices)])
+                return tuple(select_solution(robot, arm_joints, candidates, nearby_conf=nearby_conf))
+            num_attempts += num_samples
+            batch_size *= 2
+        return None
+    generator = get_ik_generator(robot, arm, ik_pose, **kwargs)
     for _ in range(max_attempts):
         try:
             solutions = next(generator)
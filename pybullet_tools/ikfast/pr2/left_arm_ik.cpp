@@ -13033,6 +13033,63 @@ static PyObject *left_arm_ik(PyObject *self, PyObject *args) {
     return solutionList;
 }
 
+static PyObject *left_arm_ik_batch(PyObject *self, PyObject *args) {
+    // Solves for each list of free joint values in freeLists within a single call.
+    // Returns the list of all solutions and, for each solution, the index of the free joint values that produced it.
+    std::vector<IkReal> vfree(GetNumFreeParameters());
+    std::vector<IkReal> solvalues(GetNumJoints());
+    IkReal eerot[9], eetrans[3];
+
+    PyObject *rotList; // 3x3 rotation matrix
+    PyObject *transList; // [x,y,z]
+    PyObject *freeLists; // list of free joint values
+
+    if(!PyArg_ParseTuple(args, "O!O!O!", &PyList_Type, &rotList, &PyList_Type, &transList, &PyList_Type, &freeLists)) {
+        return NULL;
+    }
+
+    for(std::size_t i = 0; i < 3; ++i) {
+        eetrans[i] = PyFloat_AsDouble(PyList_GetItem(transList, i));
+
+        PyObject* rowList = PyList_GetItem(rotList, i);
+        for( std::size_t j = 0; j < 3; ++j) {
+            eerot[3*i + j] = PyFloat_AsDouble(PyList_GetItem(rowList, j));
+        }
+    }
+
+    PyObject *solutionList = PyList_New(0);
+    PyObject *indexList = PyList_New(0);
+    for(Py_ssize_t k = 0; k < PyList_Size(freeLists); ++k) {
+        PyObject *freeList = PyList_GetItem(freeLists, k);
+        for(int i = 0; i < GetNumFreeParameters(); ++i) {
+            vfree[i] = PyFloat_AsDouble(PyList_GetItem(freeList, i));
+        }
+
+        IkSolutionList<IkReal> solutions;
+        if (!ComputeIk(eetrans, eerot, GetNumFreeParameters() > 0 ? &vfree[0] : NULL, solutions)) {
+            continue;
+        }
+
+        for(std::size_t i = 0; i < solutions.GetNumSolutions(); ++i) {
+            const IkSolutionBase<IkReal>& sol = solutions.GetSolution(i);
+            std::vector<IkReal> vsolfree(sol.GetFree().size());
+            sol.GetSolution(&solvalues[0],vsolfree.size()>0?&vsolfree[0]:NULL);
+
+            PyObject *individualSolution = PyList_New(GetNumJoints());
+            for( std::size_t j = 0; j < solvalues.size(); ++j) {
+                PyList_SetItem(individualSolution, j, PyFloat_FromDouble(solvalues[j]));
+            }
+            PyList_Append(solutionList, individualSolution);
+            Py_DECREF(individualSolution);
+
+            PyObject *index = PyLong_FromSsize_t(k);
+            PyList_Append(indexList, index);
+            Py_DECREF(index);
+        }
+    }
+    return Py_BuildValue("NN", solutionList, indexList);
+}
+
 static PyObject *left_arm_fk(PyObject *self, PyObject *args) {
     std::vector<IkReal> joints(8);
     IkReal eerot[9], eetrans[3];
@@ -13071,6 +13128,7 @@ static PyObject *left_arm_fk(PyObject *self, PyObject *args) {
 
 static PyMethodDef ikLeftMethods[] = {
     {"get_ik", left_arm_ik, METH_VARARGS, "Compute ik solutions using ikfast."},
+    {"get_ik_batch", left_arm_ik_batch, METH_VARARGS, "Compute ik solutions for multiple free joint values using ikfast."},
     {"get_fk", left_arm_fk, METH_VARARGS, "Compute fk solutions using ikfast."},
     // TODO: deprecate
     {"leftIK", left_arm_ik, METH_VARARGS, "Compute IK for the PR2's left arm."},
@@ -32,6 +32,27 @@ def compute_inverse_kinematics(ik_fn, pose, sampled=[]):
     return solutions
 
 
+def compute_inverse_kinematics_batch(ikfast, pose, free_samples, num_joints):
+    """
+    :param ikfast: compiled ikfast module
+    :param free_samples: (N, num_free) array of free joint values
+    :return: (M, num_joints) array of solutions and the (M,) index of the free joint values that produced each one
+    """
+    pos = point_from_pose(pose)
+    rot = matrix_from_quat(quat_from_pose(pose)).tolist()
+    free_samples = np.array(free_samples, dtype=float)
+    if hasattr(ikfast, 'get_ik_batch'):
+        solutions, indices = ikfast.get_ik_batch(list(rot), list(pos), free_samples.tolist())
+    else:
+        # Modules compiled before get_ik_batch was added
+        solutions, indices = [], []
+        for index, sampled in enumerate(free_samples):
+            confs = compute_inverse_kinematics(ikfast.get_ik, pose, sampled)
+            solutions.extend(confs)
+            indices.extend(len(confs)*[index])
+    return np.array(solutions, dtype=float).reshape(len(solutions), num_joints), np.array(indices, dtype=int)
+
+
 def get_ik_limits(robot, joint, limits=USE_ALL):
     if limits is USE_ALL:
         return get_joint_limits(robot, joint)
@@ -0,0 +1,228 @@
+import time
+
+import numpy as np
+import pybullet as p
+
+from .utils import get_joints, get_joint_info, get_dynamics_info, get_pose, get_joint_positions, \
+    get_model_info, get_num_joints, get_client, matrix_from_quat, invert_quat, pose_from_tform, BASE_LINK, \
+    get_custom_limits, get_difference_array_fn, is_circular, elapsed_time, INF, CIRCULAR_LIMITS
+
+################################################################################
+
+def matrix_from_pose(pose):
+    point, quat = pose
+    matrix = np.eye(4)
+    matrix[:3, :3] = matrix_from_quat(quat)
+    matrix[:3, 3] = point
+    return matrix
+
+def invert_matrix(matrix):
+    inverse = np.eye(4)
+    inverse[:3, :3] = matrix[:3, :3].T
+    inverse[:3, 3] = -matrix[:3, :3].T.dot(matrix[:3, 3])
+    return inverse
+
+def rotation_matrices(axis, angles):
+    # Rodrigues' formula for a batch of angles about a single unit axis
+    x, y, z = axis
+    skew = np.array([[0, -z, y], [z, 0, -x], [-y, x, 0]])
+    angles = np.array(angles)[:, None, None]
+    return np.eye(3) + np.sin(angles)*skew + (1 - np.cos(angles))*skew.dot(skew)
+
+class KinematicTree(object):
+    """
+    Forward kinematics for a loaded body computed in NumPy from its joint origins and axes
+    Poses match get_link_pose (link frames) and get_com_pose (center of mass frames)
+    """
+    def __init__(self, body):
+        self.body = body
+        self.joints = get_joints(body)
+        infos = [get_joint_info(body, joint) for joint in self.joints]
+        self.parents = [info.parentIndex for info in infos]
+        self.types = [info.jointType for info in infos]
+        self.axes = [np.array(info.jointAxis) / max(np.linalg.norm(info.jointAxis), 1e-12) for info in infos]
+        # Joint origins are expressed in the parent's center of mass frame
+        # getJointInfo reports the inverse of the joint origin's orientation
+        self.parent_from_joints = [matrix_from_pose((info.parentFramePos, invert_quat(info.parentFrameOrn)))
+                                   for info in infos]
+        self.link_from_coms = [matrix_from_pose(get_dynamics_info(body, link)[3:5])
+                               for link in [BASE_LINK] + self.joints]
+    def __len__(self):
+        return len(self.joints)
+    def get_chain(self, links):
+        # Joints that move any of links in topological order
+        chain = set()
+        for link in links:
+            while (link != BASE_LINK) and (link not in chain):
+                chain.add(link)
+                link = self.parents[link]
+        return sorted(chain)
+    def _forward_kinematics(self, confs, joints, chain):
+        confs = np.array(confs, dtype=float).reshape(-1, len(joints))
+        positions = np.zeros((len(confs), len(self)))
+        positions[:, chain] = get_joint_positions(self.body, chain)
+        positions[:, list(joints)] = confs
+        world_from_coms = np.full((len(confs), len(self) + 1, 4, 4), np.nan)
+        world_from_coms[:, 0] = matrix_from_pose(get_pose(self.body))
+        world_from_links = np.full_like(world_from_coms, np.nan)
+        world_from_links[:, 0] = world_from_coms[:, 0].dot(invert_matrix(self.link_from_coms[0]))
+        for joint in chain:
+            motion = np.tile(np.eye(4), (len(confs), 1, 1))
+            if self.types[joint] in (p.JOINT_REVOLUTE, p.JOINT_SPHERICAL):
+                motion[:, :3, :3] = rotation_matrices(self.axes[joint], positions[:, joint])
+            elif self.types[joint] == p.JOINT_PRISMATIC:
+                motion[:, :3, 3] = positions[:, joint, None] * self.axes[joint]
+            parent_from_joint = world_from_coms[:, self.parents[joint] + 1].dot(self.parent_from_joints[joint])
+            world_from_links[:, joint + 1] = np.matmul(parent_from_joint, motion)
+            world_from_coms[:, joint + 1] = world_from_links[:, joint + 1].dot(self.link_from_coms[joint + 1])
+        return world_from_links, world_from_coms
+    def forward_kinematics(self, confs, joints, com=False):
+        """
+        :param confs: (N, len(joints)) array; the remaining joints are held at their current positions
+        :return: (N, len(self) + 1, 4, 4) array of world poses where index 0 is BASE_LINK and index i + 1 is link i
+        """
+        world_from_links, world_from_coms = self._forward_kinematics(confs, joints, self.joints)
+        return world_from_coms if com else world_from_links
+    def link_poses(self, confs, joints, links, com=False):
+        """
+        :return: (N, len(links), 4, 4) array of world poses
+        """
+        world_from_links, world_from_coms = self._forward_kinematics(confs, joints, self.get_chain(links))
+        return (world_from_coms if com else world_from_links)[:, np.array(links, dtype=int) + 1]
+    def jacobians(self, confs, joints, link, com=False):
+        """
+        :return: (N, 6, len(joints)) array of world frame linear (rows 0-2) and angular (rows 3-5) Jacobians
+                 of the link frame origin (or center of mass)
+        """
+        return self.pose_jacobians(confs, joints, link, com=com)[1]
+    def pose_jacobians(self, confs, joints, link, com=False):
+        """
+        :return: (N, 4, 4) array of world poses of link and the (N, 6, len(joints)) array of its Jacobians
+        """
+        chain = self.get_chain([link])
+        world_from_links, world_from_coms = self._forward_kinematics(confs, joints, chain)
+        world_from_targets = (world_from_coms if com else world_from_links)[:, link + 1]
+        target = world_from_targets[:, :3, 3]
+        jacobians = np.zeros((len(world_from_links), 6, len(joints)))
+        for i, joint in enumerate(joints):
+            if joint not in chain:
+                continue
+            axis = world_from_links[:, joint + 1, :3, :3].dot(self.axes[joint])
+            if self.types[joint] in (p.JOINT_REVOLUTE, p.JOINT_SPHERICAL):
+                jacobians[:, :3, i] = np.cross(axis, target - world_from_links[:, joint + 1, :3, 3])
+                jacobians[:, 3:, i] = axis
+            elif self.types[joint] == p.JOINT_PRISMATIC:
+                jacobians[:, :3, i] = axis
+        return world_from_targets, jacobians
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, self.body, len(self))
+
+KINEMATIC_TREES = {}
+
+def get_kinematic_tree(body):
+    # Body ids are reused after remove_body
+    key = (get_client(), body, get_model_info(body), get_num_joints(body))
+    if key not in KINEMATIC_TREES:
+        KINEMATIC_TREES[key] = KinematicTree(body)
+    return KINEMATIC_TREES[key]
+
+def get_link_poses(body, joints, confs, link, com=False):
+    # Poses of link for each conf without modifying the simulator state
+    world_from_links = get_kinematic_tree(body).link_poses(confs, joints, [link], com=com)[:, 0]
+    return [pose_from_tform(world_from_link) for world_from_link in world_from_links]
+
+def get_link_pose_fn(body, joints, link, com=False):
+    kinematic_tree = get_kinematic_tree(body)
+    def fn(conf):
+        return pose_from_tform(kinematic_tree.link_poses([conf], joints, [link], com=com)[0, 0])
+    return fn
+
+def get_jacobians(body, joints, confs, link, com=False):
+    return get_kinematic_tree(body).jacobians(confs, joints, link, com=com)
+
+################################################################################
+
+def rotation_errors(target_rotation, rotations):
+    # World frame axis-angle vectors that rotate each of rotations onto target_rotation
+    errors = np.matmul(target_rotation, np.swapaxes(rotations, -1, -2))
+    vectors = np.stack([errors[:, 2, 1] - errors[:, 1, 2],
+                        errors[:, 0, 2] - errors[:, 2, 0],
+                        errors[:, 1, 0] - errors[:, 0, 1]], axis=-1)
+    angles = np.arccos(np.clip((np.trace(errors, axis1=1, axis2=2) - 1) / 2., -1., 1.))
+    sines = np.sin(angles)
+    scales = np.where(sines > 1e-6, angles / (2*np.maximum(sines, 1e-6)), 0.5)
+    return scales[:, None]*vectors, angles
+
+def remove_duplicate_confs(confs, difference_fn, min_distance=1e-2):
+    # Keeps the first of the confs that are within min_distance of each other
+    indices = []
+    for i, conf in enumerate(confs):
+        if not indices or np.all(np.linalg.norm(difference_fn(confs[indices], conf), axis=1) > min_distance):
+            indices.append(i)
+    return confs[indices]
+
+def dls_inverse_kinematics(body, joints, link, target_pose, num_seeds=32, seed_confs=None, include_current=True,
+                           custom_limits={}, max_iterations=100, max_time=INF, max_solutions=INF, damping=1e-2,
+                           max_step=0.5, null_space_gain=0.1, pos_tolerance=1e-3, ori_tolerance=1e-3*np.pi,
+                           min_distance=1e-2):
+    """
+    Damped least-squares (Levenberg-Marquardt) inverse kinematics over many seeds at once
+    :param seed_confs: initial (M, len(joints)) confs; defaults to uniform samples
+    :param include_current: if True, the first default seed is the current conf
+    :param min_distance: seeds that converge within min_distance of each other return a single solution
+    :return: (K, len(joints)) array of distinct solutions within custom_limits sorted by their distance to the current conf
+    """
+    start_time = time.time()
+    kinematic_tree = get_kinematic_tree(body)
+    joints = list(joints)
+    current_conf = np.array(get_joint_positions(body, joints))
+    circular_joints = np.array([is_circular(body, joint) for joint in joints], dtype=bool)
+    lower_limits, upper_limits = map(np.array, get_custom_limits(body, joints, custom_limits))
+    if seed_confs is None:
+        sample_lower = np.where(circular_joints, CIRCULAR_LIMITS[0], lower_limits)
+        sample_upper = np.where(circular_joints, CIRCULAR_LIMITS[1], upper_limits)
+        seed_confs = np.random.uniform(sample_lower, sample_upper, size=(num_seeds, len(joints)))
+        if include_current:
+            seed_confs[0] = np.clip(current_conf, lower_limits, upper_limits)
+    confs = np.array(seed_confs, dtype=float).reshape(-1, len(joints))
+    # The null-space bias pulls bounded joints toward the center of their limits
+    bounded = np.isfinite(lower_limits) & np.isfinite(upper_limits)
+    center_conf = (np.where(bounded, lower_limits, 0.) + np.where(bounded, upper_limits, 0.)) / 2.
+    target_point = np.array(target_pose[0])
+    target_rotation = matrix_from_quat(target_pose[1])
+
+    converged = np.zeros(len(confs), dtype=bool)
+    for iteration in range(max_iterations + 1):
+        if (np.count_nonzero(converged) >= max_solutions) or (elapsed_time(start_time) >= max_time):
+            break
+        active = np.flatnonzero(~converged)
+        if not len(active):
+            break
+        poses, jacobians = kinematic_tree.pose_jacobians(confs[active], joints, link)
+        pos_errors = target_point - poses[:, :3, 3]
+        ori_errors, angles = rotation_errors(target_rotation, poses[:, :3, :3])
+        done = (np.linalg.norm(pos_errors, axis=1) <= pos_tolerance) & (angles <= ori_tolerance)
+        converged[active[done]] = True
+        if iteration == max_iterations:
+            break
+        errors = np.concatenate([pos_errors, ori_errors], axis=1)[~done]
+        jacobians = jacobians[~done]
+        active = active[~done]
+        # dq = J^T (J J^T + lambda^2 I)^-1 e + (I - J^+ J) bias
+        damped = np.matmul(jacobians, np.swapaxes(jacobians, 1, 2)) + (damping**2)*np.eye(6)
+        pseudo_inverses = np.matmul(np.swapaxes(jacobians, 1, 2), np.linalg.inv(damped))
+        steps = np.matmul(pseudo_inverses, errors[:, :, None])[:, :, 0]
+        biases = null_space_gain*np.where(bounded, center_conf - confs[active], 0.)
+        null_spaces = np.eye(len(joints)) - np.matmul(pseudo_inverses, jacobians)
+        steps += np.matmul(null_spaces, biases[:, :, None])[:, :, 0]
+        norms = np.linalg.norm(steps, axis=1, keepdims=True)
+        steps *= np.minimum(1., max_step / np.maximum(norms, 1e-12))
+        confs[active] = np.clip(confs[active] + steps, lower_limits, upper_limits)
+
+    solutions = confs[converged]
+    solutions[:, circular_joints] = np.mod(solutions[:, circular_joints] + np.pi, 2*np.pi) - np.pi
+    difference_fn = get_difference_array_fn(body, joints)
+    distances = np.linalg.norm(difference_fn(solutions, current_conf), axis=1) if len(solutions) else np.zeros(0)
+    solutions = remove_duplicate_confs(solutions[np.argsort(distances, kind='stable')], difference_fn,
+                                       min_distance=min_distance)
+    return solutions[:int(min(max_solutions, len(solutions)))]
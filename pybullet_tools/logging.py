@@ -160,6 +160,42 @@ def write_stream_statistics(externals, verbose=True):
     if verbose:
         print('Wrote:', filename)
 
+COLLISION_FIELDS = ['calls', 'time', 'hits', 'pairs', 'pruned']
+
+def get_collision_statistics(group_by=('stream', 'function')):
+    """ aggregates pybullet_tools.utils.COLLISION_STATISTICS by any of
+        'stream', 'call_site', 'function', and 'bodies' """
+    from pybullet_tools.utils import COLLISION_STATISTICS
+
+    keys = ['stream', 'call_site', 'function', 'bodies']
+    rows = {}
+    for key, statistics in COLLISION_STATISTICS.items():
+        key = dict(zip(keys, key))
+        group = tuple(str(key[name]) for name in group_by)
+        row = rows.setdefault(group, dict(zip(group_by, group), **{field: 0 for field in COLLISION_FIELDS}))
+        for field in COLLISION_FIELDS:
+            row[field] += statistics[field]
+    for row in rows.values():
+        row['time'] = round(row['time'], 6)
+        row['hit rate'] = round(row['hits'] / row['calls'], 4) if row['calls'] else None
+        row['prune rate'] = round(row['pruned'] / (row['pairs'] or row['calls']), 4) \
+            if (row['pairs'] or row['calls']) else None
+    return sorted(rows.values(), key=lambda row: -row['time'])
+
+def write_collision_statistics(filename=None, group_by=('stream', 'function'), verbose=True):
+    """ enable with pybullet_tools.utils.enable_collision_statistics() """
+    rows = get_collision_statistics(group_by=group_by)
+    if verbose:
+        from tabulate import tabulate
+        print()
+        print(tabulate([list(row.values()) for row in rows], headers=list(rows[0]) if rows else []))
+    if filename is not None:
+        with open(filename, 'w') as f:
+            json.dump(rows, f, indent=2)
+        if verbose:
+            print('Wrote:', filename)
+    return rows
+
 def dump_json(db, db_file, indent=2, width=160, **kwargs):
     """ don't break lines for list elements """
     with open(db_file, 'w') as f:
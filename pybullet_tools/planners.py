@@ -0,0 +1,432 @@
+import heapq
+import os
+import random
+import sys
+import time
+import numpy as np
+
+from collections import deque
+from itertools import count
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None # Falls back to brute force nearest neighbors
+
+# In-tree replacements for the motion_planners submodule (https://github.com/caelan/motion-planners)
+# Trees and roadmaps store configurations in NumPy arrays and use KD-trees for nearest neighbors
+# motion/ is the checkout path of that submodule, so these live here rather than shadowing it
+# The submodule still provides the algorithms that are not implemented here (see solve)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'motion'))
+
+INF = np.inf
+RRT_ITERATIONS = 20
+RRT_RESTARTS = 2
+RRT_SMOOTHING = 20
+NEAREST_CANDIDATES = 8 # Rescored with distance_fn
+REBUILD_SIZE = 64
+
+def elapsed_time(start_time):
+    return time.time() - start_time
+
+def get_kd_tree(points):
+    if cKDTree is None:
+        return None
+    return cKDTree(points)
+
+################################################################################
+
+class ConfigurationArray(object):
+    """
+    Growable array of configurations with approximate nearest neighbor queries
+    Configurations are embedded using weights, and circular coordinates are embedded on the unit circle
+    The KD-tree is rebuilt once enough new configurations have been added
+    """
+    def __init__(self, dimension, weights=None, circular={}, capacity=256):
+        self.dimension = dimension
+        self.weights = np.ones(dimension) if weights is None else np.array(weights, dtype=float)
+        self.circular = sorted(circular)
+        self.linear = [i for i in range(dimension) if i not in circular]
+        self.confs = np.empty((capacity, dimension))
+        self.points = np.empty((capacity, len(self.linear) + 2*len(self.circular)))
+        self.size = 0
+        self.kd_tree = None
+        self.indexed = 0
+    def __len__(self):
+        return self.size
+    def __getitem__(self, index):
+        return self.confs[index]
+    def embed(self, confs):
+        confs = np.array(confs, dtype=float).reshape(-1, self.dimension)
+        points = [confs[:, self.linear]*self.weights[self.linear]]
+        if self.circular:
+            angles = confs[:, self.circular]
+            weights = self.weights[self.circular]
+            points.extend([weights*np.cos(angles), weights*np.sin(angles)])
+        return np.hstack(points)
+    def extend(self, confs):
+        confs = np.array(confs, dtype=float).reshape(-1, self.dimension)
+        while self.size + len(confs) > len(self.confs):
+            self.confs = np.vstack([self.confs, np.empty_like(self.confs)])
+            self.points = np.vstack([self.points, np.empty_like(self.points)])
+        indices = np.arange(self.size, self.size + len(confs))
+        self.confs[indices] = confs
+        self.points[indices] = self.embed(confs)
+        self.size += len(confs)
+        return indices
+    def append(self, conf):
+        return self.extend([conf])[0]
+    def update(self):
+        if (cKDTree is not None) and ((self.size - self.indexed) >= max(REBUILD_SIZE, self.indexed // 2)):
+            self.kd_tree = get_kd_tree(self.points[:self.size])
+            self.indexed = self.size if self.kd_tree is not None else 0
+    def nearest_indices(self, conf, k=NEAREST_CANDIDATES, max_radius=INF):
+        self.update()
+        point = self.embed(conf)[0]
+        indices, distances = [], []
+        if self.kd_tree is not None:
+            kd_distances, kd_indices = self.kd_tree.query(point, k=min(k, self.indexed),
+                                                           distance_upper_bound=max_radius)
+            kd_distances, kd_indices = np.atleast_1d(kd_distances), np.atleast_1d(kd_indices)
+            finite = np.isfinite(kd_distances)
+            indices.append(kd_indices[finite])
+            distances.append(kd_distances[finite])
+        # Brute force over the configurations added since the last rebuild
+        recent = np.arange(self.indexed, self.size)
+        recent_distances = np.linalg.norm(self.points[recent] - point, axis=1)
+        within = recent_distances <= max_radius
+        indices.append(recent[within])
+        distances.append(recent_distances[within])
+        indices, distances = np.concatenate(indices).astype(int), np.concatenate(distances)
+        order = np.argsort(distances)[:k]
+        return indices[order]
+    def nearest(self, conf, distance_fn=None, k=NEAREST_CANDIDATES):
+        indices = self.nearest_indices(conf, k=k)
+        if (distance_fn is None) or (len(indices) == 1):
+            return indices[0]
+        return min(indices, key=lambda i: distance_fn(self.confs[i], conf))
+
+class Tree(ConfigurationArray):
+    def __init__(self, root, **kwargs):
+        root = np.array(root, dtype=float)
+        super(Tree, self).__init__(len(root), **kwargs)
+        self.parents = np.empty(len(self.confs), dtype=int)
+        self.add(root, parent=-1)
+    def add(self, conf, parent):
+        index = self.append(conf)
+        if len(self.parents) < len(self.confs):
+            self.parents = np.concatenate([self.parents, np.empty(len(self.confs) - len(self.parents), dtype=int)])
+        self.parents[index] = parent
+        return index
+    def retrace(self, index):
+        indices = []
+        while index != -1:
+            indices.append(index)
+            index = self.parents[index]
+        return [tuple(conf) for conf in self.confs[indices[::-1]]]
+
+################################################################################
+
+def direct_path(start, goal, extend_fn, collision_fn):
+    if collision_fn(start) or collision_fn(goal):
+        return None
+    path = [start]
+    for q in extend_fn(start, goal):
+        if collision_fn(q):
+            return None
+        path.append(q)
+    return path
+
+def extend_towards(tree, target, distance_fn, extend_fn, collision_fn):
+    index = tree.nearest(target, distance_fn=distance_fn)
+    success = True
+    for q in extend_fn(tree[index], target):
+        if collision_fn(q):
+            success = False
+            break
+        index = tree.add(q, index)
+    return index, success
+
+def rrt_connect(start, goal, distance_fn, sample_fn, extend_fn, collision_fn,
+                max_iterations=RRT_ITERATIONS, max_time=INF, weights=None, circular={}, **kwargs):
+    start_time = time.time()
+    if collision_fn(start) or collision_fn(goal):
+        return None
+    tree1, tree2 = Tree(start, weights=weights, circular=circular), Tree(goal, weights=weights, circular=circular)
+    swap = False # True when tree1 is the goal tree
+    for iteration in count():
+        if (iteration >= max_iterations) or (elapsed_time(start_time) >= max_time):
+            break
+        if len(tree1) > len(tree2):
+            tree1, tree2 = tree2, tree1
+            swap = not swap
+        target = sample_fn()
+        index1, _ = extend_towards(tree1, target, distance_fn, extend_fn, collision_fn)
+        index2, success = extend_towards(tree2, tree1[index1], distance_fn, extend_fn, collision_fn)
+        if success:
+            path1, path2 = tree1.retrace(index1), tree2.retrace(index2)
+            if swap:
+                path1, path2 = path2, path1
+            return [start] + path1[1:] + path2[::-1][1:-1] + [goal]
+    return None
+
+BISECTION_ORDERS = {}
+
+def bisection_order(num):
+    # Recursive bisection (van der Corput) order over range(num): midpoint first, then the quarter points, ...
+    if num in BISECTION_ORDERS:
+        return BISECTION_ORDERS[num]
+    order = []
+    queue = deque([(0, num - 1)])
+    while queue:
+        lower, upper = queue.popleft()
+        if upper < lower:
+            continue
+        middle = (lower + upper + 1) // 2
+        order.append(middle)
+        queue.extend([(lower, middle - 1), (middle + 1, upper)])
+    BISECTION_ORDERS[num] = np.array(order, dtype=int)
+    return BISECTION_ORDERS[num]
+
+def get_batch_fn(collision_fn):
+    # Wraps collision functions that do not support batching (e.g. plan_base_motion)
+    if hasattr(collision_fn, 'batch'):
+        return collision_fn.batch
+    def batch_fn(confs, early_exit=False, order=None, **kwargs):
+        collisions = np.zeros(len(confs), dtype=bool)
+        order = np.arange(len(confs)) if order is None else np.array(order, dtype=int)
+        for k, i in enumerate(order):
+            if collision_fn(confs[i], **kwargs):
+                collisions[i] = True
+                if early_exit:
+                    collisions[order[k:]] = True
+                    break
+        return collisions
+    return batch_fn
+
+#####################################
+
+# Edge validation
+
+def get_edge_fn(collision_fn, bisect=True):
+    # Returns True if any configuration along the (already interpolated) edge is in collision
+    batch_fn = get_batch_fn(collision_fn)
+    def edge_fn(confs):
+        confs = list(confs)
+        if not confs:
+            return False
+        order = bisection_order(len(confs)) if bisect else None
+        return batch_fn(confs, early_exit=True, order=order).any()
+    return edge_fn
+
+def get_segment_costs(waypoints, distance_fn=None):
+    if distance_fn is None:
+        return np.linalg.norm(np.diff(waypoints, axis=0), axis=1)
+    return np.array([distance_fn(q1, q2) for q1, q2 in zip(waypoints[:-1], waypoints[1:])])
+
+def shortcut_path(path, extend_fn, collision_fn, distance_fn=None, edge_fn=None, num_candidates=16,
+                  max_iterations=INF, max_time=INF, min_improvement=1e-3, patience=3):
+    """
+    Proposes num_candidates random shortcuts per iteration, ranked by their cost reduction,
+    and applies the non-overlapping ones whose edges are collision-free
+    Terminates after max_time, max_iterations, or patience iterations that each improve the cost by less than
+    a min_improvement fraction
+    """
+    start_time = time.time()
+    if (path is None) or (len(path) <= 2):
+        return path
+    if edge_fn is None:
+        edge_fn = get_edge_fn(collision_fn)
+    waypoints = np.array(path, dtype=float)
+    costs = get_segment_costs(waypoints, distance_fn)
+    stalled = 0
+    for iteration in count():
+        if (iteration >= max_iterations) or (stalled >= patience) or (elapsed_time(start_time) >= max_time) \
+                or (len(waypoints) <= 2):
+            break
+        cumulative = np.concatenate([[0.], np.cumsum(costs)])
+        candidates = np.sort(np.random.randint(0, len(waypoints), size=(num_candidates, 2)), axis=1)
+        candidates = np.unique(candidates[candidates[:, 1] - candidates[:, 0] > 1], axis=0)
+        if not len(candidates):
+            stalled += 1
+            continue
+        starts, ends = candidates.T
+        if distance_fn is None:
+            direct = np.linalg.norm(waypoints[ends] - waypoints[starts], axis=1)
+        else:
+            direct = np.array([distance_fn(waypoints[i], waypoints[j]) for i, j in candidates])
+        savings = cumulative[ends] - cumulative[starts] - direct
+        accepted = []
+        for index in np.argsort(-savings):
+            i, j = starts[index], ends[index]
+            if (savings[index] <= 0) or any((i < j2) and (i2 < j) for i2, j2, _ in accepted):
+                continue
+            shortcut = np.array(list(extend_fn(waypoints[i], waypoints[j])) or [waypoints[j]],
+                                dtype=float).reshape(-1, waypoints.shape[1])
+            if not edge_fn(shortcut):
+                accepted.append((i, j, shortcut))
+        if not accepted:
+            stalled += 1
+            continue
+        total = cumulative[-1]
+        pieces, cost_pieces = [], []
+        previous = 0
+        for i, j, shortcut in sorted(accepted, key=lambda item: item[0]):
+            pieces.extend([waypoints[previous:i+1], shortcut[:-1]])
+            cost_pieces.extend([costs[previous:i], get_segment_costs(np.vstack([waypoints[i:i+1], shortcut]), distance_fn)])
+            previous = j
+        pieces.append(waypoints[previous:])
+        cost_pieces.append(costs[previous:])
+        waypoints, costs = np.vstack(pieces), np.concatenate(cost_pieces)
+        improvement = (total - np.sum(costs)) / max(total, 1e-12)
+        stalled = stalled + 1 if improvement < min_improvement else 0
+    return [path[0]] + [tuple(q) for q in waypoints[1:-1]] + [path[-1]]
+
+def smooth_path(path, extend_fn, collision_fn, distance_fn=None, max_iterations=RRT_SMOOTHING, max_time=INF):
+    return shortcut_path(path, extend_fn, collision_fn, distance_fn=distance_fn,
+                         max_iterations=max_iterations, max_time=max_time)
+
+def birrt(start, goal, distance_fn, sample_fn, extend_fn, collision_fn,
+          max_restarts=RRT_RESTARTS, smooth=RRT_SMOOTHING, max_time=INF, restarts=None, iterations=None, **kwargs):
+    # restarts and iterations are the keywords of older versions of motion_planners
+    start_time = time.time()
+    if restarts is not None:
+        max_restarts = restarts
+    if iterations is not None:
+        kwargs['max_iterations'] = iterations
+    path = direct_path(start, goal, extend_fn, collision_fn)
+    if path is not None:
+        return path
+    for attempt in count():
+        if attempt > max_restarts:
+            break
+        if elapsed_time(start_time) >= max_time:
+            break
+        path = rrt_connect(start, goal, distance_fn, sample_fn, extend_fn, collision_fn,
+                           max_time=max_time - elapsed_time(start_time), **kwargs)
+        if path is not None:
+            if smooth is None:
+                return path
+            return smooth_path(path, extend_fn, collision_fn, distance_fn=distance_fn, max_iterations=smooth,
+                               max_time=max_time - elapsed_time(start_time))
+    return None
+
+################################################################################
+
+def get_roadmap_edges(samples, max_degree=10, max_distance=INF):
+    neighbors = [samples.nearest_indices(samples[i], k=max_degree + 1, max_radius=max_distance)
+                 for i in range(len(samples))]
+    return {(min(i, j), max(i, j)) for i, indices in enumerate(neighbors) for j in indices if i != j}
+
+def shortest_path(start, goal, neighbors, cost_fn):
+    # Dijkstra over the lazily validated roadmap
+    costs = {start: 0.}
+    parents = {start: None}
+    queue = [(0., start)]
+    while queue:
+        cost, vertex = heapq.heappop(queue)
+        if vertex == goal:
+            path = []
+            while vertex is not None:
+                path.append(vertex)
+                vertex = parents[vertex]
+            return path[::-1]
+        if cost > costs[vertex]:
+            continue
+        for neighbor in neighbors[vertex]:
+            new_cost = cost + cost_fn(vertex, neighbor)
+            if new_cost < costs.get(neighbor, INF):
+                costs[neighbor] = new_cost
+                parents[neighbor] = vertex
+                heapq.heappush(queue, (new_cost, neighbor))
+    return None
+
+def lazy_prm(start, goal, sample_fn, extend_fn, collision_fn, distance_fn=None, num_samples=100, max_degree=10,
+             weights=None, circular={}, max_distance=INF, max_time=INF, **kwargs):
+    """
+    :return: (path, samples, edges, colliding_vertices, colliding_edges)
+    """
+    start_time = time.time()
+    if distance_fn is None:
+        distance_fn = lambda q1, q2: np.linalg.norm(np.multiply(weights if weights is not None else 1.,
+                                                                np.subtract(q2, q1)))
+    samples = ConfigurationArray(len(start), weights=weights, circular=circular)
+    samples.extend([start, goal] + [sample_fn() for _ in range(num_samples)])
+    edges = sorted(get_roadmap_edges(samples, max_degree=max_degree, max_distance=max_distance))
+    neighbors = {i: set() for i in range(len(samples))}
+    for i, j in edges:
+        neighbors[i].add(j)
+        neighbors[j].add(i)
+    colliding_vertices, colliding_edges = {}, {}
+    edge_fn = get_edge_fn(collision_fn)
+
+    def cost_fn(i, j):
+        return distance_fn(samples[i], samples[j])
+
+    def vertex_collision(i):
+        if i not in colliding_vertices:
+            colliding_vertices[i] = collision_fn(tuple(samples[i]))
+        return colliding_vertices[i]
+
+    def edge_collision(i, j):
+        edge = (min(i, j), max(i, j))
+        if edge not in colliding_edges:
+            colliding_edges[edge] = edge_fn(extend_fn(samples[edge[0]], samples[edge[1]]))
+        return colliding_edges[edge]
+
+    path = None
+    while elapsed_time(start_time) < max_time:
+        indices = shortest_path(0, 1, neighbors, cost_fn)
+        if indices is None:
+            break
+        # Vertices are cheaper to check than edges
+        invalid = [i for i in indices if vertex_collision(i)]
+        for i in invalid:
+            for j in neighbors.pop(i):
+                neighbors[j].discard(i)
+            neighbors[i] = set()
+        if invalid:
+            continue
+        invalid = [(i, j) for i, j in zip(indices[:-1], indices[1:]) if edge_collision(i, j)]
+        for i, j in invalid:
+            neighbors[i].discard(j)
+            neighbors[j].discard(i)
+        if not invalid:
+            path = [start]
+            for i, j in zip(indices[:-1], indices[1:]):
+                path.extend(extend_fn(samples[i], samples[j]))
+            break
+    samples = [tuple(conf) for conf in samples.confs[:len(samples)]]
+    return path, samples, edges, colliding_vertices, colliding_edges
+
+################################################################################
+
+def solve(start, goal, distance_fn, sample_fn, extend_fn, collision_fn, algorithm='birrt',
+          max_time=INF, max_iterations=INF, num_samples=100, smooth=None, smooth_time=INF, **kwargs):
+    start_time = time.time()
+    path = direct_path(start, goal, extend_fn, collision_fn)
+    if (path is not None) or (algorithm == 'direct'):
+        return path
+    max_iterations = RRT_ITERATIONS if max_iterations == INF else max_iterations
+    if algorithm == 'birrt':
+        # Restarts rrt_connect until max_restarts or max_time and smooths the first path found
+        return birrt(start, goal, distance_fn, sample_fn, extend_fn, collision_fn,
+                     smooth=RRT_SMOOTHING if smooth is None else smooth, max_time=max_time,
+                     max_iterations=max_iterations, **kwargs)
+    elif algorithm == 'rrt_connect':
+        path = rrt_connect(start, goal, distance_fn, sample_fn, extend_fn, collision_fn,
+                           max_iterations=max_iterations, max_time=max_time, **kwargs)
+    elif algorithm == 'lazy_prm':
+        path = lazy_prm(start, goal, sample_fn, extend_fn, collision_fn, distance_fn=distance_fn,
+                        num_samples=num_samples, max_time=max_time, **kwargs)[0]
+    else:
+        # Remaining algorithms are provided by the motion_planners submodule
+        from motion_planners.meta import solve as solve_external
+        kwargs.pop('circular', None)
+        return solve_external(start, goal, distance_fn, sample_fn, extend_fn, collision_fn, algorithm=algorithm,
+                              max_time=max_time, max_iterations=max_iterations, num_samples=num_samples,
+                              smooth=smooth, smooth_time=smooth_time, **kwargs)
+    if (path is None) or (smooth is None):
+        return path
+    return smooth_path(path, extend_fn, collision_fn, distance_fn=distance_fn, max_iterations=smooth,
+                       max_time=min(smooth_time, max_time - elapsed_time(start_time)))
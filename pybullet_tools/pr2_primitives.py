@@ -456,11 +456,12 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=25, collisions=True,
         # if pose_to_xyzyaw(pose.value) == (1.093, 7.088, 0.696, 2.8):
         #     yield (Conf(robot, base_joints, (1.241, 6.672, 1.874)),)
 
+        lower_limits, upper_limits = get_custom_limits(robot, base_joints, custom_limits)
         if learned:
-            base_generator = learned_pose_generator(robot, gripper_pose, arm=arm, grasp_type=grasp.grasp_type)
+            base_generator = learned_pose_generator(robot, gripper_pose, arm=arm, grasp_type=grasp.grasp_type,
+                                                    base_limits=(lower_limits, upper_limits), obstacles=obstacles)
         else:
             base_generator = uniform_pose_generator(robot, gripper_pose)
-        lower_limits, upper_limits = get_custom_limits(robot, base_joints, custom_limits)
         while True:
             count = 0
             for base_conf in islice(base_generator, max_attempts):
@@ -491,7 +492,7 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=25, collisions=True,
 ##################################################
 
 
-def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
+def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, cache=False):
     robot = problem.robot
     obstacles = problem.fixed if collisions else []
     # if is_ik_compiled():
@@ -513,7 +514,7 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
         base_conf.assign()
         open_arm(robot, arm)
         set_joint_positions(robot, arm_joints, default_conf) # default_conf | sample_fn()
-        grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits) #, upper_limits=USE_CURRENT)
+        grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits, cache=cache) #, upper_limits=USE_CURRENT)
                                             #nearby_conf=USE_CURRENT) # upper_limits=USE_CURRENT,
         if (grasp_conf is None) or any(pairwise_collision(robot, b) for b in obstacles): # [obj]
             #print('Grasp IK failure', grasp_conf)
@@ -557,11 +558,11 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False):
 
 ##################################################
 
-def get_ik_ir_gen(problem, max_attempts=25, learned=True, teleport=False, verbose=True, **kwargs):
+def get_ik_ir_gen(problem, max_attempts=25, learned=True, teleport=False, verbose=True, cache=False, **kwargs):
     # TODO: compose using general fn
     # ir_sampler = get_ir_sampler(problem, learned=learned, max_attempts=1, **kwargs)
     ir_sampler = get_ir_sampler(problem, learned=learned, max_attempts=40, verbose=verbose, **kwargs)
-    ik_fn = get_ik_fn(problem, teleport=teleport, **kwargs)
+    ik_fn = get_ik_fn(problem, teleport=teleport, cache=cache, **kwargs)
     def gen(*inputs):
         set_renderer(enable=verbose)
         a, o, p, g = inputs
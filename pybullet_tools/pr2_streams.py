@@ -6,6 +6,7 @@ import random
 import time
 import os
 from itertools import islice, count
+from collections import Counter
 import math
 import json
 
@@ -37,12 +38,14 @@ from pybullet_tools.utils import invert, multiply, get_name, set_pose, get_link_
     get_joint_limits, unit_pose, point_from_pose, clone_body, set_all_color, GREEN, BROWN, get_link_subtree, \
     RED, remove_body, aabb2d_from_aabb, aabb_overlap, aabb_contains_point, get_aabb_center, get_link_name, \
     get_links, check_initial_end, get_collision_fn, BLUE, WHITE, TAN, GREY, YELLOW, aabb_contains_aabb, \
-    get_joints, is_movable, pairwise_link_collision, get_closest_points, ConfSaver
+    get_joints, is_movable, pairwise_link_collision, get_closest_points, ConfSaver, get_obstacle_key
 
 from pybullet_tools.bullet_utils import sample_obj_in_body_link_space, nice, set_camera_target_body, is_contained, \
     visualize_point, collided, GRIPPER_DIRECTIONS, get_gripper_direction, check_cfree_gripper, Attachment, \
     has_tracik, visualize_bconf
 from pybullet_tools.logging import dump_json
+from pybullet_tools.spheres import get_sphere_collision_fn
+from pybullet_tools.roadmaps import plan_roadmap_motion
 
 from .general_streams import *
 
@@ -51,7 +54,10 @@ BASE_LIMITS = (-BASE_EXTENT*np.ones(2), BASE_EXTENT*np.ones(2))
 GRASP_LENGTH = 0.03
 APPROACH_DISTANCE = 0.1 + GRASP_LENGTH
 SELF_COLLISIONS = False
+USE_SPHERES = False ## classify clear-cut robot confs with sphere trees before querying Bullet
+USE_ROADMAPS = False ## reuse persistent arm roadmaps for approach paths
 LINK_POSE_TO_JOINT_POSITION = {}
+SPHERE_COLLISION_FNS = {}
 
 ########################################################################
 
@@ -135,6 +141,25 @@ def get_handle_grasps(body_joint, tool_pose=TOOL_POSE, body_pose=unit_pose(),
 #         yield
 
 
+def get_cached_sphere_collision_fn(robot, joints, obstacles):
+    """ sphere trees and kd-trees are set up once per robot, joints, and obstacles; obstacle poses are read per call """
+    key = (robot, tuple(joints), tuple(map(get_obstacle_key, obstacles)))
+    if key not in SPHERE_COLLISION_FNS:
+        SPHERE_COLLISION_FNS[key] = get_sphere_collision_fn(robot, list(joints), list(obstacles))
+    return SPHERE_COLLISION_FNS[key]
+
+
+def robot_collision(robot, joints, obstacles, use_spheres=USE_SPHERES):
+    """ check the robot at its current conf, only querying Bullet when sphere trees are inconclusive """
+    obstacles = list(obstacles)
+    if use_spheres and obstacles:
+        sphere_collision_fn = get_cached_sphere_collision_fn(robot, joints, obstacles)
+        [colliding], [free] = sphere_collision_fn([get_joint_positions(robot, joints)])
+        if colliding or free:
+            return bool(colliding)
+    return any(pairwise_collision(robot, b) for b in obstacles)
+
+
 def get_ir_sampler(problem, custom_limits={}, max_attempts=40, collisions=True,
                    learned=True, verbose=False):
     robot = problem.robot
@@ -142,6 +167,7 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=40, collisions=True,
     obstacles = [o for o in problem.fixed if o not in problem.floors] if collisions else []
     gripper = problem.get_gripper(visual=False)
     heading = f'   pr2_streams.get_ir_sampler | '
+    hit_counts = Counter() ## check the obstacles that most often reject base confs first
 
     def gen_fn(arm, obj, pose, grasp):
 
@@ -184,17 +210,17 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=40, collisions=True,
         default_conf = arm_conf(arm, grasp.carry)
         arm_joints = get_arm_joints(robot, arm)
         base_joints = get_group_joints(robot, 'base')
+        lower_limits, upper_limits = get_custom_limits(robot, base_joints, custom_limits)
         if learned:
-            base_generator = learned_pose_generator(robot, gripper_pose, arm=arm, grasp_type=grasp.grasp_type)
+            base_generator = learned_pose_generator(robot, gripper_pose, arm=arm, grasp_type=grasp.grasp_type,
+                                                    base_limits=(lower_limits, upper_limits), obstacles=obstacles)
         else:
             base_generator = uniform_pose_generator(robot, gripper_pose)
-
-        lower_limits, upper_limits = get_custom_limits(robot, base_joints, custom_limits)
         aconf = nice(get_joint_positions(robot, arm_joints))
         while True:
             count = 0
+            base_confs = []
             for base_conf in islice(base_generator, max_attempts):
-                count += 1
                 if not all_between(lower_limits, base_conf, upper_limits):
                     continue
 
@@ -205,12 +231,28 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=40, collisions=True,
                     z = random.uniform(z - 0.7, z - 0.3)
                     x, y, yaw = base_conf
                     base_conf = (x, y, z, yaw)
+                base_confs.append(base_conf)
 
+            ## classify the whole batch of base confs at once, most are clearly free or colliding
+            rejected = accepted = np.zeros(len(base_confs), dtype=bool)
+            if USE_SPHERES and base_confs:
+                pose.assign()
+                sphere_collision_fn = get_cached_sphere_collision_fn(robot, list(base_joints) + list(arm_joints),
+                                                                     obstacles + [obj])
+                rejected, accepted = sphere_collision_fn([tuple(base_conf) + tuple(default_conf)
+                                                          for base_conf in base_confs])
+            for base_conf, sphere_rejected, sphere_accepted in zip(base_confs, rejected, accepted):
+                count += 1
+                if sphere_rejected:
+                    continue
                 bq = Conf(robot, base_joints, base_conf)
                 pose.assign()
                 bq.assign()
                 set_joint_positions(robot, arm_joints, default_conf)
-                if any(pairwise_collision(robot, b) for b in obstacles + [obj]):
+                bodies = [] if sphere_accepted else sorted(obstacles + [obj], key=lambda b: -hit_counts[b])
+                colliding = next((b for b in bodies if pairwise_collision(robot, b)), None)
+                if colliding is not None:
+                    hit_counts[colliding] += 1
                     continue
                 if verbose:
                     print(f'{heading} IR attempt {count} | bconf = {nice(base_conf)}, aconf = {aconf}')
@@ -225,7 +267,7 @@ def get_ir_sampler(problem, custom_limits={}, max_attempts=40, collisions=True,
 
 ##################################################
 
-def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, verbose=False, ACONF=False):
+def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, verbose=False, ACONF=False, cache=False):
     robot = problem.robot
     obstacles = problem.fixed if collisions else []
     world = problem.world
@@ -267,9 +309,9 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, verbos
         base_conf.assign()
         open_arm(robot, arm)
         set_joint_positions(robot, arm_joints, default_conf) # default_conf | sample_fn()
-        grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits) #, upper_limits=USE_CURRENT)
+        grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits, cache=cache) #, upper_limits=USE_CURRENT)
                                             #nearby_conf=USE_CURRENT) # upper_limits=USE_CURRENT,
-        if (grasp_conf is None) or any(pairwise_collision(robot, b) for b in obstacles+addons): ## approach_obstacles): # [obj]
+        if (grasp_conf is None) or robot_collision(robot, arm_joints, obstacles+addons): ## approach_obstacles): # [obj]
             if verbose:
                 if grasp_conf != None:
                     grasp_conf = nice(grasp_conf)
@@ -287,7 +329,7 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, verbos
         #approach_conf = pr2_inverse_kinematics(robot, arm, approach_pose, custom_limits=custom_limits,
         #                                       upper_limits=USE_CURRENT, nearby_conf=USE_CURRENT)
         approach_conf = sub_inverse_kinematics(robot, arm_joints[0], arm_link, approach_pose, custom_limits=custom_limits)
-        if (approach_conf is None) or any(pairwise_collision(robot, b) for b in obstacles + addons): ##
+        if (approach_conf is None) or robot_collision(robot, arm_joints, obstacles + addons): ##
             if verbose:
                 if approach_conf != None:
                     approach_conf = nice(approach_conf)
@@ -320,10 +362,11 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, verbos
                 if verbose: print(f'{title}Grasp path failure')
                 return None
             set_joint_positions(robot, arm_joints, default_conf)
-            approach_path = plan_joint_motion(robot, arm_joints, approach_conf, attachments=attachments.values(),
-                                              obstacles=obstacles, self_collisions=SELF_COLLISIONS,
-                                              custom_limits=custom_limits, resolutions=resolutions,
-                                              restarts=2, iterations=25, smooth=25)
+            plan_fn = plan_roadmap_motion if USE_ROADMAPS else plan_joint_motion
+            approach_path = plan_fn(robot, arm_joints, approach_conf, attachments=attachments.values(),
+                                    obstacles=obstacles, self_collisions=SELF_COLLISIONS,
+                                    custom_limits=custom_limits, resolutions=resolutions,
+                                    restarts=2, iterations=25, smooth=25)
             if approach_path is None:
                 if verbose: print(f'{title}\tApproach path failure')
                 return None
@@ -345,11 +388,11 @@ def get_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, verbos
 
 
 def get_ik_ir_wconf_gen(problem, max_attempts=25, learned=True, teleport=False,
-                        verbose=False, visualize=False, **kwargs):
+                        verbose=False, visualize=False, cache=False, **kwargs):
     """ given grasp of target object p, return base conf and arm traj """
     ir_max_attempts = 40
     ir_sampler = get_ir_sampler(problem, learned=learned, max_attempts=ir_max_attempts, verbose=verbose, **kwargs)
-    ik_fn = get_ik_fn(problem, teleport=teleport, verbose=False, **kwargs)
+    ik_fn = get_ik_fn(problem, teleport=teleport, verbose=False, cache=cache, **kwargs)
     robot = problem.robot
     obstacles = problem.fixed
     heading = 'pr2_streams.get_ik_ir_wconf_gen | '
@@ -571,7 +614,7 @@ def get_arm_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, ve
         set_joint_positions(robot, arm_joints, grasp_conf) # default_conf | sample_fn()
         # grasp_conf = pr2_inverse_kinematics(robot, arm, gripper_pose, custom_limits=custom_limits) #, upper_limits=USE_CURRENT)
         #                                     #nearby_conf=USE_CURRENT) # upper_limits=USE_CURRENT,
-        if (grasp_conf is None) or any(pairwise_collision(robot, b) for b in obstacles): ## approach_obstacles): # [obj]
+        if (grasp_conf is None) or robot_collision(robot, arm_joints, obstacles): ## approach_obstacles): # [obj]
             if verbose:
                 if grasp_conf != None:
                     grasp_conf = nice(grasp_conf)
@@ -586,7 +629,7 @@ def get_arm_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, ve
                 print(f'{title}Grasp IK success | {nice(grasp_conf)} = pr2_inverse_kinematics({robot} at {nice(base_conf.values)}, {arm}, {nice(gripper_pose[0])}) | pose = {pose}, grasp = {grasp}')
 
         approach_conf = sub_inverse_kinematics(robot, arm_joints[0], arm_link, approach_pose, custom_limits=custom_limits) ##, max_iterations=500
-        if (approach_conf is None) or any(pairwise_collision(robot, b) for b in obstacles): ##
+        if (approach_conf is None) or robot_collision(robot, arm_joints, obstacles): ##
             if verbose:
                 if approach_conf != None:
                     approach_conf = nice(approach_conf)
@@ -614,10 +657,11 @@ def get_arm_ik_fn(problem, custom_limits={}, collisions=True, teleport=False, ve
                 if verbose: print(f'{title}Grasp path failure')
                 return None
             set_joint_positions(robot, arm_joints, default_conf)
-            approach_path = plan_joint_motion(robot, arm_joints, approach_conf, attachments=attachments.values(),
-                                              obstacles=obstacles, self_collisions=SELF_COLLISIONS,
-                                              custom_limits=custom_limits, resolutions=resolutions,
-                                              restarts=2, iterations=25, smooth=25)
+            plan_fn = plan_roadmap_motion if USE_ROADMAPS else plan_joint_motion
+            approach_path = plan_fn(robot, arm_joints, approach_conf, attachments=attachments.values(),
+                                    obstacles=obstacles, self_collisions=SELF_COLLISIONS,
+                                    custom_limits=custom_limits, resolutions=resolutions,
+                                    restarts=2, iterations=25, smooth=25)
             if approach_path is None:
                 if verbose: print(f'{title}Approach path failure')
                 return None
@@ -1473,11 +1517,11 @@ def get_cfree_btraj_pose_test(robot, collisions=True, verbose=True):
 
 
 def get_ik_gen(problem, max_attempts=25, learned=True, teleport=False,
-                        verbose=False, visualize=False, ACONF=False, WCONF=True, **kwargs):
+                        verbose=False, visualize=False, ACONF=False, WCONF=True, cache=False, **kwargs):
     """ given grasp of target object p, return base conf and arm traj """
     ir_max_attempts = 40
     ir_sampler = get_ir_sampler(problem, learned=learned, max_attempts=ir_max_attempts, verbose=verbose, **kwargs)
-    ik_fn = get_ik_fn(problem, teleport=teleport, verbose=False, ACONF=ACONF, **kwargs)
+    ik_fn = get_ik_fn(problem, teleport=teleport, verbose=False, ACONF=ACONF, cache=cache, **kwargs)
     robot = problem.robot
     obstacles = problem.fixed
     heading = 'pr2_streams.get_ik_ir_wconf_gen | '
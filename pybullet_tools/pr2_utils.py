@@ -17,7 +17,9 @@ from .utils import multiply, get_link_pose, set_joint_position, set_joint_positi
     movable_from_joints, quat_from_axis_angle, LockRenderer, Euler, get_links, get_link_name, \
     get_extend_fn, get_moving_links, link_pairs_collision, get_link_subtree, \
     clone_body, get_all_links, pairwise_collision, tform_point, get_camera_matrix, ray_from_pixel, pixel_from_ray, dimensions_from_camera_matrix, \
-    wrap_angle, TRANSPARENT, PI, OOBB, pixel_from_point, set_all_color, wait_if_gui
+    wrap_angle, TRANSPARENT, PI, OOBB, pixel_from_point, set_all_color, wait_if_gui, pose_from_tform, matrix_from_quat, \
+    has_joint, BodySaver, set_base_values
+from .kinematics import get_kinematic_tree
 
 # TODO: restrict number of pr2 rotations to prevent from wrapping too many times
 
@@ -80,6 +82,7 @@ PR2_GRIPPER_ROOTS = {
 }
 
 PR2_BASE_LINK = 'base_footprint'
+PR2_BASE_BODY_LINK = 'base_link' # Collision geometry of the mobile base
 
 # Arm tool poses
 #TOOL_POSE = ([0.18, 0., 0.], [0., 0.70710678, 0., 0.70710678]) # l_gripper_palm_link
@@ -452,7 +455,9 @@ GET_GRASPS = {
 
 DATABASES_DIR = '../databases'
 IR_FILENAME = '{}_{}_ir.pickle'
+IR_ARRAY_FILENAME = '{}_{}_ir.npy'
 IR_CACHE = {}
+IR_ARRAY_CACHE = {}
 
 def get_database_file(filename):
     directory = os.path.dirname(os.path.abspath(__file__))
@@ -468,6 +473,74 @@ def load_inverse_reachability(arm, grasp_type):
     return IR_CACHE[key]
 
 
+def array_from_poses(poses):
+    # (N, 7) array of [x, y, z, qx, qy, qz, qw]
+    return np.array([np.concatenate(pose) for pose in poses], dtype=float).reshape(-1, 7)
+
+
+def save_inverse_reachability_array(arm, grasp_type, gripper_from_base_list):
+    path = get_database_file(IR_ARRAY_FILENAME.format(grasp_type, arm))
+    np.save(path, array_from_poses(gripper_from_base_list))
+    IR_ARRAY_CACHE.pop((arm, grasp_type), None)
+    return path
+
+
+def load_inverse_reachability_array(arm, grasp_type):
+    key = (arm, grasp_type)
+    if key not in IR_ARRAY_CACHE:
+        path = get_database_file(IR_ARRAY_FILENAME.format(grasp_type, arm))
+        if os.path.exists(path):
+            IR_ARRAY_CACHE[key] = np.load(path, mmap_mode='r')
+        else:
+            IR_ARRAY_CACHE[key] = array_from_poses(load_inverse_reachability(arm, grasp_type))
+    return IR_ARRAY_CACHE[key]
+
+
+def get_learned_base_values(gripper_pose, arm, grasp_type):
+    # Applies multiply(gripper_pose, gripper_from_base) to the whole database at once
+    gripper_from_bases = np.array(load_inverse_reachability_array(arm, grasp_type))
+    gripper_point, gripper_quat = gripper_pose
+    points = np.array(gripper_point) + gripper_from_bases[:, :3].dot(matrix_from_quat(gripper_quat).T)
+    x1, y1, z1, w1 = gripper_quat
+    x2, y2, z2, w2 = gripper_from_bases[:, 3:].T
+    x = w1*x2 + x1*w2 + y1*z2 - z1*y2
+    y = w1*y2 - x1*z2 + y1*w2 + z1*x2
+    z = w1*z2 + x1*y2 - y1*x2 + z1*w2
+    w = w1*w2 - x1*x2 - y1*y2 - z1*z2
+    thetas = np.arctan2(2*(w*z + x*y), 1 - 2*(y*y + z*z)) # Same as euler_from_quat
+    return np.column_stack([points[:, 0], points[:, 1], thetas])
+
+
+def get_base_collision_mask(robot, base_values, obstacles, resolution=0.05):
+    # Identifies base values where the base link collides with an obstacle
+    # Obstacles overlapping the largest circle inscribed in the base link on the occupancy grid are candidates
+    from .grids import get_footprint, get_occupancy_grid
+    base_values = np.array(base_values).reshape(-1, 3)
+    if (not obstacles) or (not len(base_values)):
+        return np.zeros(len(base_values), dtype=bool)
+    base_joints = get_group_joints(robot, 'base') if has_joint(robot, PR2_GROUPS['base'][0]) else None
+    base_link = link_from_name(robot, PR2_BASE_BODY_LINK)
+    (lower, upper), z_limits = get_footprint(robot, joints=base_joints, links=[base_link])
+    radius = min(np.min(-lower), np.min(upper))
+    # Snaps the grid limits to improve reuse of the cached grid
+    grid_lower = np.floor(np.min(base_values[:, :2], axis=0) - radius - 1.)
+    grid_upper = np.ceil(np.max(base_values[:, :2], axis=0) + radius + 1.)
+    grid = get_occupancy_grid(obstacles, (grid_lower, grid_upper), z_limits, resolution=resolution)
+    cells = np.clip(grid.cells_from_points(base_values), 0, np.array(grid.shape) - 1)
+    distances = grid.distances[cells[:, 0], cells[:, 1]]
+    # Occupied cells over-approximate the obstacles and cell centers are within half a diagonal of each point
+    mask = distances + np.sqrt(2)*resolution <= radius
+    # Rasterized AABBs are larger than the obstacles, so each candidate is confirmed by Bullet
+    with BodySaver(robot):
+        for index in np.flatnonzero(mask):
+            if base_joints is None:
+                set_base_values(robot, base_values[index])
+            else:
+                set_joint_positions(robot, base_joints, base_values[index])
+            mask[index] = any(pairwise_collision((robot, [base_link]), obstacle) for obstacle in obstacles)
+    return mask
+
+
 def learned_forward_generator(robot, base_pose, arm, grasp_type):
     gripper_from_base_list = list(load_inverse_reachability(arm, grasp_type))
     random.shuffle(gripper_from_base_list)
@@ -475,20 +548,20 @@ def learned_forward_generator(robot, base_pose, arm, grasp_type):
         yield multiply(base_pose, invert(gripper_from_base))
 
 
-def learned_pose_generator(robot, gripper_pose, arm, grasp_type):
+def learned_pose_generator(robot, gripper_pose, arm, grasp_type, base_limits=None, obstacles=[]):
     # TODO: record collisions with the reachability database
-    gripper_from_base_list = load_inverse_reachability(arm, grasp_type)
-    random.shuffle(gripper_from_base_list)
+    base_values = get_learned_base_values(gripper_pose, arm, grasp_type)
+    if base_limits is not None:
+        lower_limits, upper_limits = base_limits
+        base_values = base_values[np.all((np.array(lower_limits) <= base_values) &
+                                         (base_values <= np.array(upper_limits)), axis=1)]
+    base_values = base_values[~get_base_collision_mask(robot, base_values, obstacles)]
     #handles = []
-    for gripper_from_base in gripper_from_base_list:
-        base_point, base_quat = multiply(gripper_pose, gripper_from_base)
-        x, y, _ = base_point
-        _, _, theta = euler_from_quat(base_quat)
-        base_values = (x, y, theta)
+    for index in np.random.permutation(len(base_values)):
         #handles.extend(draw_point(np.array([x, y, -0.1]), color=(1, 0, 0), size=0.05))
         #set_base_values(robot, base_values)
         #yield get_pose(robot)
-        yield base_values
+        yield tuple(base_values[index])
 
 #####################################
 
@@ -635,32 +708,30 @@ def inverse_visibility(pr2, point, head_name=HEAD_LINK_NAME, head_joints=None,
         head_joints = joints_from_names(pr2, PR2_GROUPS['head'])
     # TODO: could also set the target orientation for inverse kinematics
     head_conf = np.zeros(len(head_joints))
-    with LockRenderer(lock=True):
-        with ConfSaver(pr2):
-            for iteration in range(max_iterations):
-                set_joint_positions(pr2, head_joints, head_conf)
-                world_from_head = get_link_pose(pr2, head_link)
-                point_head = tform_point(invert(world_from_head), point)
-                error_angle = angle_between(camera_axis, point_head)
-                if abs(error_angle) <= tolerance:
-                    break
-                normal_head = np.cross(camera_axis, point_head)
-                normal_world = tform_point((unit_point(), quat_from_pose(world_from_head)), normal_head)
-                correction_quat = quat_from_axis_angle(normal_world, step_size*error_angle)
-                correction_euler = euler_from_quat(correction_quat)
-                _, angular = compute_jacobian(pr2, head_link)
-                correction_conf = np.array([np.dot(angular[mj], correction_euler)
-                                            for mj in movable_from_joints(pr2, head_joints)])
-                if verbose:
-                    print('Iteration: {} | Error: {:.3f} | Correction: {}'.format(
-                        iteration, error_angle, correction_conf))
-                head_conf += correction_conf
-                #if debug:
-                #wait_if_gui()
-                if np.all(correction_conf == 0):
-                    return None
-            else:
-                return None
+    # Forward kinematics and world frame Jacobians are computed without setting the head joints
+    kinematic_tree = get_kinematic_tree(pr2)
+    for iteration in range(max_iterations):
+        world_from_head = pose_from_tform(kinematic_tree.link_poses([head_conf], head_joints, [head_link])[0, 0])
+        point_head = tform_point(invert(world_from_head), point)
+        error_angle = angle_between(camera_axis, point_head)
+        if abs(error_angle) <= tolerance:
+            break
+        normal_head = np.cross(camera_axis, point_head)
+        normal_world = tform_point((unit_point(), quat_from_pose(world_from_head)), normal_head)
+        correction_quat = quat_from_axis_angle(normal_world, step_size*error_angle)
+        correction_euler = euler_from_quat(correction_quat)
+        angular = kinematic_tree.jacobians([head_conf], head_joints, head_link)[0, 3:]
+        correction_conf = angular.T.dot(correction_euler)
+        if verbose:
+            print('Iteration: {} | Error: {:.3f} | Correction: {}'.format(
+                iteration, error_angle, correction_conf))
+        head_conf += correction_conf
+        #if debug:
+        #wait_if_gui()
+        if np.all(correction_conf == 0):
+            return None
+    else:
+        return None
     if violates_limits(pr2, head_joints, head_conf):
         return None
     return head_conf
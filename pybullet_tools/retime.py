@@ -175,20 +175,121 @@ def ramp_retime_path(path, max_velocities, acceleration_fraction=INF, sample_ste
         time_from_starts.append(time_from_start + duration)
     return waypoints, time_from_starts
 
+################################################################################
+
+def get_path_parameterization(path):
+    # Arc length of each waypoint and the unit direction of each straight segment between them
+    differences = np.array([get_difference(q1, q2) for q1, q2 in get_pairs(path)], dtype=float)
+    lengths = np.linalg.norm(differences, axis=1)
+    return np.append(0., np.cumsum(lengths)), differences / lengths[:, np.newaxis]
+
+def compute_controllable_sets(directions, max_velocities, max_accelerations, steps, stops):
+    """
+    Backward pass of TOPP-RA over squared path velocities x = ds/dt^2 with path accelerations u = d^2s/dt^2
+    Along a straight segment q'' = 0, so each joint bounds |u| by a constant and x' = x + 2*step*u
+    :param directions: (N - 1, dof) unit direction of each interval
+    :param stops: (N,) points at which the path must come to rest, such as corners
+    :return: the largest controllable x at each of the N points and the largest x and |u| within each interval
+    """
+    speeds = np.abs(directions)
+    with np.errstate(divide='ignore'):
+        velocity_limits = np.min(np.square(max_velocities / speeds), axis=1)
+        acceleration_limits = np.min(max_accelerations / speeds, axis=1)
+    # Points within a segment share its limit and breakpoints take the tighter of the two segments
+    max_xs = np.minimum(np.append(velocity_limits, INF), np.append(INF, velocity_limits))
+    max_xs[stops] = 0.
+    upper_xs = np.array(max_xs)
+    for i in reversed(range(len(upper_xs) - 1)):
+        upper_xs[i] = min(max_xs[i], upper_xs[i+1] + 2*steps[i]*acceleration_limits[i])
+    return upper_xs, velocity_limits, acceleration_limits
+
+def optimal_retime_path(path, max_velocities, acceleration_fraction=INF, num_samples=None, sample_step=None):
+    """
+    Time-optimal path parameterization (TOPP-RA) subject to joint velocity and acceleration limits
+    The path is followed along its straight segments, so it stops at corners when accelerations are bounded
+    :param path:
+    :param max_velocities:
+    :param acceleration_fraction: fraction of velocity_fraction*max_velocity per second
+    :param num_samples: number of points along the path at which the limits are enforced
+    :param sample_step: if not None, resamples the trajectory every sample_step seconds
+    :return:
+    """
+    assert np.all(max_velocities)
+    if len(path) == 0:
+        return [], []
+    # Removes repeated and collinear waypoints
+    path = waypoints_from_path(path)
+    if len(path) <= 1:
+        return list(path), [0.]
+    max_velocities = np.array(max_velocities, dtype=float)
+    max_accelerations = max_velocities * acceleration_fraction
+    breakpoints, directions = get_path_parameterization(path)
+    if num_samples is None:
+        num_samples = max(len(path), 100)
+    # Every segment has an interior point so that consecutive stops are never adjacent
+    grid = np.unique(np.concatenate([breakpoints, (breakpoints[:-1] + breakpoints[1:]) / 2.,
+                                     np.linspace(breakpoints[0], breakpoints[-1], num=num_samples)]))
+    steps = np.diff(grid)
+    segments = np.clip(np.searchsorted(breakpoints, grid[:-1] + steps / 2.) - 1, 0, len(directions) - 1)
+    bounded = np.all(np.isfinite(max_accelerations))
+    stops = np.zeros(len(grid), dtype=bool)
+    if bounded:
+        stops[[0, -1]] = True
+        stops[np.searchsorted(grid, breakpoints)] = True
+    upper_xs, velocity_limits, acceleration_limits = compute_controllable_sets(
+        directions[segments], max_velocities, max_accelerations, steps, stops)
+
+    if bounded:
+        # Forward pass greedily accelerates while remaining within the controllable sets
+        xs = np.array(upper_xs)
+        for i in range(len(grid) - 1):
+            xs[i+1] = min(xs[i] + 2*steps[i]*acceleration_limits[i], upper_xs[i+1])
+        velocities = np.sqrt(xs)
+        start_velocities = velocities[:-1]
+        accelerations = (xs[1:] - xs[:-1]) / (2*steps)
+        durations = 2*steps / (velocities[:-1] + velocities[1:])
+    else:
+        # Velocities change instantaneously, so each interval is traversed at its limit
+        start_velocities = np.sqrt(velocity_limits)
+        accelerations = np.zeros(len(steps))
+        durations = steps / start_velocities
+    time_from_starts = np.append(0., np.cumsum(durations))
+    positions = np.array([np.interp(grid, breakpoints, values) for values in np.array(path, dtype=float).T]).T
+    if not np.all(np.isfinite(time_from_starts)):
+        return ramp_retime_path(path, max_velocities, acceleration_fraction=acceleration_fraction,
+                                sample_step=sample_step)
+    if sample_step is None:
+        return list(positions), list(time_from_starts)
+    times = np.append(np.arange(0., time_from_starts[-1], sample_step), [time_from_starts[-1]])
+    # Path accelerations are constant within each interval
+    indices = np.clip(np.searchsorted(time_from_starts, times, side='right') - 1, 0, len(durations) - 1)
+    taus = times - time_from_starts[indices]
+    distances = np.minimum(grid[indices] + start_velocities[indices]*taus + accelerations[indices]*np.square(taus) / 2.,
+                           grid[indices + 1])
+    return list(np.array([np.interp(distances, breakpoints, values) for values in np.array(path, dtype=float).T]).T), \
+           list(times)
+
 def retime_trajectory(robot, joints, path, only_waypoints=False,
-                      velocity_fraction=DEFAULT_SPEED_FRACTION, **kwargs):
+                      velocity_fraction=DEFAULT_SPEED_FRACTION, optimal=False, num_samples=None, **kwargs):
     """
     :param robot:
     :param joints:
     :param path:
     :param velocity_fraction: fraction of max_velocity
+    :param optimal: if True, also retimes the whole path at once using optimal_retime_path and returns the faster one
     :return:
     """
     path = adjust_path(robot, joints, path)
     if only_waypoints:
         path = waypoints_from_path(path)
     max_velocities = velocity_fraction * np.array(get_max_velocities(robot, joints))
-    return ramp_retime_path(path, max_velocities, **kwargs)
+    ramp_path, ramp_times = ramp_retime_path(path, max_velocities, **kwargs)
+    if not optimal:
+        return ramp_path, ramp_times
+    optimal_path, optimal_times = optimal_retime_path(path, max_velocities, num_samples=num_samples, **kwargs)
+    if optimal_times[-1] < ramp_times[-1]:
+        return optimal_path, optimal_times
+    return ramp_path, ramp_times
 
 ################################################################################
 
@@ -214,7 +315,7 @@ def approximate_spline(time_from_starts, path, k=3, approx=INF):
     return positions
 
 def interpolate_path(robot, joints, path, velocity_fraction=DEFAULT_SPEED_FRACTION,
-                     k=1, bspline=False, dump=False, **kwargs):
+                     k=1, bspline=False, dump=False, optimal=False, acceleration_fraction=INF, **kwargs):
     from scipy.interpolate import CubicSpline, interp1d
     #from scipy.interpolate import CubicHermiteSpline, KroghInterpolator
     # https://scikit-learn.org/stable/auto_examples/linear_model/plot_polynomial_interpolation.html
@@ -223,7 +324,8 @@ def interpolate_path(robot, joints, path, velocity_fraction=DEFAULT_SPEED_FRACTI
     # https://docs.scipy.org/doc/scipy/reference/tutorial/interpolate.html
     # Waypoints are followed perfectly, twice continuously differentiable
     # TODO: https://pythonrobotics.readthedocs.io/en/latest/modules/path_tracking.html#mpc-modeling
-    path, time_from_starts = retime_trajectory(robot, joints, path, velocity_fraction=velocity_fraction, sample_step=None)
+    path, time_from_starts = retime_trajectory(robot, joints, path, velocity_fraction=velocity_fraction, optimal=optimal,
+                                               acceleration_fraction=acceleration_fraction, sample_step=None)
     if k == 3:
         if bspline:
             positions = approximate_spline(time_from_starts, path, k=k, **kwargs)
@@ -0,0 +1,266 @@
+import os
+import time
+import numpy as np
+
+from .utils import get_joint_positions, get_joints, get_link_pose, get_link_parent, get_joint_names, get_pose, \
+    get_configuration, get_model_hash, get_body_name, get_model_info, get_client, parse_body, get_buffered_aabb, \
+    get_sample_fn, get_distance_fn, get_extend_fn, get_collision_fn, check_initial_end, plan_joint_motion, \
+    euler_from_quat, ensure_dir, elapsed_time, aabb_union, get_link_ancestors, get_aabb_vertices, \
+    aabb_from_points, tform_points, multiply, invert, AABB, BASE_LINK, MAX_DISTANCE, INF
+from .planners import ConfigurationArray, shortest_path, shortcut_path
+
+ROADMAP_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'databases', 'roadmaps/'))
+BASE_BUCKET = (0.5, 0.5, np.pi/4) # meters, meters, radians
+ROADMAPS = {}
+
+################################################################################
+
+def get_mount_link(body, joints):
+    # Link the planned chain is mounted on, such as the PR2 torso
+    return get_link_parent(body, joints[0])
+
+def get_base_bucket(body, joints, resolution=BASE_BUCKET):
+    point, quat = get_link_pose(body, get_mount_link(body, joints))
+    base = np.append(point[:2], euler_from_quat(quat)[2])
+    return tuple(np.floor(base / np.array(resolution)).astype(int))
+
+def get_roadmap_path(body, joints, bucket):
+    name = get_model_hash(body) or get_body_name(body)
+    return os.path.join(ROADMAP_DIR, '{}_{}_{}.npz'.format(
+        name, '-'.join(get_joint_names(body, joints)), '_'.join(map(str, bucket))))
+
+def get_mount_frame(body, joints):
+    return invert(get_link_pose(body, get_mount_link(body, joints)))
+
+def get_context(body, joints):
+    # Everything other than the planned joints and the pose of their mount link that affects the robot's geometry
+    mount_link = get_mount_link(body, joints)
+    mount_joints = [link for link in get_link_ancestors(body, mount_link) + [mount_link] if link != BASE_LINK]
+    other_joints = [joint for joint in get_joints(body) if (joint not in joints) and (joint not in mount_joints)]
+    return np.array(get_joint_positions(body, other_joints), dtype=float)
+
+def get_frame_aabb(frame, aabb):
+    return AABB(*aabb_from_points(tform_points(frame, get_aabb_vertices(aabb))))
+
+def get_scene(obstacles, frame):
+    # Obstacle poses and AABBs relative to frame, so moving the robot's base moves every obstacle
+    return {obstacle: (np.concatenate(multiply(frame, get_pose(parse_body(obstacle)[0]))),
+                       np.array(get_configuration(parse_body(obstacle)[0]), dtype=float),
+                       get_frame_aabb(frame, get_buffered_aabb(obstacle)))
+            for obstacle in obstacles}
+
+def get_settings_key(self_collisions=True, disabled_collisions=set(), custom_limits={}, max_distance=MAX_DISTANCE,
+                     resolutions=None):
+    # Statuses are only valid for the collision settings that they were computed with
+    return (self_collisions, frozenset(disabled_collisions),
+            tuple(sorted((joint, tuple(limits)) for joint, limits in custom_limits.items())), max_distance,
+            None if resolutions is None else tuple(resolutions))
+
+################################################################################
+
+class RoadmapStatus(object):
+    """
+    Lazily validated vertex and edge statuses of a roadmap for one set of collision settings
+    Each status stores the AABB swept by the moving links in the mount link frame
+    so that only statuses near bodies that moved relative to the robot are reset
+    """
+    def __init__(self):
+        self.vertex_status = {}
+        self.edge_status = {}
+        self.context = None
+        self.scene = {}
+    def reset(self, aabbs=None):
+        # Resets statuses whose swept AABB intersects any of aabbs (or all if None)
+        for status in [self.vertex_status, self.edge_status]:
+            if aabbs is None:
+                status.clear()
+                continue
+            keys = list(status)
+            if not keys or not aabbs:
+                continue
+            lowers = np.array([status[key][1][0] for key in keys])
+            uppers = np.array([status[key][1][1] for key in keys])
+            reset = np.zeros(len(keys), dtype=bool)
+            for lower, upper in aabbs:
+                reset |= np.all(lowers <= upper, axis=1) & np.all(np.array(lower) <= uppers, axis=1)
+            for index in np.nonzero(reset)[0]:
+                del status[keys[index]]
+    def update(self, context, scene):
+        if (self.context is None) or (len(context) != len(self.context)) or not np.allclose(context, self.context):
+            self.reset()
+            self.context = context
+            self.scene = scene
+            return
+        changed = [(self.scene.get(obstacle) or scene.get(obstacle))[2] for obstacle in set(self.scene) ^ set(scene)]
+        for obstacle in set(self.scene) & set(scene):
+            (pose1, conf1, aabb1), (pose2, conf2, aabb2) = self.scene[obstacle], scene[obstacle]
+            if (len(conf1) != len(conf2)) or not (np.allclose(pose1, pose2) and np.allclose(conf1, conf2)):
+                changed.extend([aabb1, aabb2])
+        self.reset([aabb for aabb in changed if aabb is not None])
+        self.scene = scene
+    def __repr__(self):
+        return '{}(|V|={}, |E|={})'.format(self.__class__.__name__, len(self.vertex_status), len(self.edge_status))
+
+class Roadmap(object):
+    """
+    Probabilistic roadmap whose vertices and edges persist across queries and are validated lazily
+    """
+    def __init__(self, confs=[], edges=[], path=None):
+        self.samples = None
+        self.neighbors = {}
+        self.path = path
+        self.statuses = {}
+        if len(confs):
+            self.add_vertices(confs, edges=edges)
+    def __len__(self):
+        return 0 if self.samples is None else len(self.samples)
+    @property
+    def edges(self):
+        return {(i, j) for i, neighbors in self.neighbors.items() for j in neighbors if i < j}
+    def add_vertices(self, confs, edges=None, max_degree=10):
+        confs = np.array(confs, dtype=float)
+        if self.samples is None:
+            self.samples = ConfigurationArray(confs.shape[1])
+        indices = self.samples.extend(confs)
+        for index in indices:
+            self.neighbors[index] = set()
+        if edges is None:
+            edges = [(i, j) for i in indices
+                     for j in self.samples.nearest_indices(self.samples[i], k=max_degree + 1) if i != j]
+        for i, j in edges:
+            self.neighbors[i].add(j)
+            self.neighbors[j].add(i)
+        return indices
+    def get_status(self, settings):
+        if settings not in self.statuses:
+            self.statuses[settings] = RoadmapStatus()
+        return self.statuses[settings]
+    def save(self, path=None):
+        path = self.path if path is None else path
+        ensure_dir(path)
+        np.savez_compressed(path, confs=self.samples.confs[:len(self)],
+                            edges=np.array(sorted(self.edges), dtype=int).reshape(-1, 2))
+        return path
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return Roadmap(data['confs'], edges=list(map(tuple, data['edges'])), path=path)
+    def __repr__(self):
+        return '{}(|V|={}, |E|={})'.format(self.__class__.__name__, len(self), len(self.edges))
+
+def get_roadmap(body, joints, load=True):
+    bucket = get_base_bucket(body, joints)
+    key = (get_client(), body, get_model_info(body), tuple(joints), bucket)
+    if key not in ROADMAPS:
+        path = get_roadmap_path(body, joints, bucket)
+        ROADMAPS[key] = Roadmap.load(path) if (load and os.path.exists(path)) else Roadmap(path=path)
+    return ROADMAPS[key]
+
+################################################################################
+
+def plan_roadmap_motion(body, joints, end_conf, obstacles=[], attachments=[], self_collisions=True,
+                        disabled_collisions=set(), weights=None, resolutions=None, max_distance=MAX_DISTANCE,
+                        custom_limits={}, num_samples=100, max_degree=10, max_samples=1000, max_time=INF,
+                        smooth=None, save=True, verbose=False, **kwargs):
+    """
+    Plans using a persistent roadmap per (robot, joints, base pose bucket)
+    """
+    start_time = time.time()
+    if attachments:
+        # The swept AABBs do not include attached bodies
+        return plan_joint_motion(body, joints, end_conf, obstacles=obstacles, attachments=attachments,
+                                 self_collisions=self_collisions, disabled_collisions=disabled_collisions,
+                                 weights=weights, resolutions=resolutions, max_distance=max_distance,
+                                 custom_limits=custom_limits, smooth=smooth, **kwargs)
+    start_conf = get_joint_positions(body, joints)
+    sample_fn = get_sample_fn(body, joints, custom_limits=custom_limits)
+    distance_fn = get_distance_fn(body, joints, weights=weights)
+    extend_fn = get_extend_fn(body, joints, resolutions=resolutions)
+    collision_fn = get_collision_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                    custom_limits=custom_limits, max_distance=max_distance)
+    moving_links = list(collision_fn.moving_links)
+    if not check_initial_end(start_conf, end_conf, collision_fn):
+        return None
+
+    roadmap = get_roadmap(body, joints)
+    frame = get_mount_frame(body, joints)
+    status = roadmap.get_status(get_settings_key(self_collisions, disabled_collisions, custom_limits,
+                                                 max_distance, resolutions))
+    status.update(get_context(body, joints), get_scene(obstacles, frame))
+    num_vertices = len(roadmap)
+    if len(roadmap) < num_samples:
+        roadmap.add_vertices([sample_fn() for _ in range(num_samples)], max_degree=max_degree)
+    samples, neighbors = roadmap.samples, roadmap.neighbors
+
+    # The start and end are connected to the roadmap only for this query
+    start_index, end_index = -1, -2
+    terminals = {start_index: np.array(start_conf, dtype=float), end_index: np.array(end_conf, dtype=float)}
+    terminal_status = {}
+
+    def get_conf(i):
+        return terminals[i] if i in terminals else samples[i]
+
+    def check_confs(confs):
+        aabbs = []
+        for q in confs:
+            colliding = collision_fn(q)
+            aabbs.append(get_frame_aabb(frame, get_buffered_aabb(body, link=moving_links, max_distance=max_distance/2.)))
+            if colliding:
+                return True, aabb_union(aabbs)
+        return False, aabb_union(aabbs)
+
+    def vertex_collision(i):
+        if i in terminals:
+            return False # Checked by check_initial_end
+        if i not in status.vertex_status:
+            status.vertex_status[i] = check_confs([samples[i]])
+        return status.vertex_status[i][0]
+
+    def edge_collision(i, j):
+        edge = (min(i, j), max(i, j))
+        edge_status = terminal_status if (i in terminals) or (j in terminals) else status.edge_status
+        if edge not in edge_status:
+            edge_status[edge] = check_confs(extend_fn(get_conf(edge[0]), get_conf(edge[1])))
+        return edge_status[edge][0]
+
+    def valid_neighbors():
+        # Excludes vertices and edges already known to be in collision
+        valid = {i: {j for j in neighbors[i] if not status.vertex_status.get(j, (False,))[0] and
+                     not status.edge_status.get((min(i, j), max(i, j)), (False,))[0]}
+                 for i in neighbors if not status.vertex_status.get(i, (False,))[0]}
+        for i in terminals:
+            valid[i] = set()
+        for i, conf in terminals.items():
+            for j in samples.nearest_indices(conf, k=max_degree):
+                if (j in valid) and not terminal_status.get((min(i, j), max(i, j)), (False,))[0]:
+                    valid[i].add(j)
+                    valid[j].add(i)
+        return valid
+
+    path = None
+    while elapsed_time(start_time) < max_time:
+        indices = shortest_path(start_index, end_index, valid_neighbors(),
+                                lambda i, j: distance_fn(get_conf(i), get_conf(j)))
+        if indices is None:
+            if len(roadmap) >= max_samples:
+                break
+            roadmap.add_vertices([sample_fn() for _ in range(num_samples)], max_degree=max_degree)
+            continue
+        # Vertices are cheaper to check than edges
+        if any([vertex_collision(i) for i in indices]):
+            continue
+        if any(edge_collision(i, j) for i, j in zip(indices[:-1], indices[1:])):
+            continue
+        path = [start_conf]
+        for i, j in zip(indices[:-1], indices[1:]):
+            path.extend(extend_fn(get_conf(i), get_conf(j)))
+        break
+    if save and (len(roadmap) != num_vertices):
+        # Only sampled vertices are persisted
+        roadmap.save()
+    if (path is not None) and smooth:
+        path = shortcut_path(path, extend_fn, collision_fn, distance_fn=distance_fn, max_iterations=smooth,
+                             max_time=max_time - elapsed_time(start_time))
+    if verbose:
+        print('{} | path: {} | time: {:.3f}'.format(roadmap, path is not None, elapsed_time(start_time)))
+    return path
@@ -0,0 +1,199 @@
+import os
+import hashlib
+import time
+import numpy as np
+from collections import Counter
+
+from .utils import get_model_hash, parse_body, get_all_links, get_aabb, get_aabbs, aabb_union, get_com_pose, \
+    get_sphere_geometry, probe_shape, get_probe_closest_points, get_collision_data, get_pose, get_configuration, \
+    get_collision_fn, get_custom_limits, set_joint_positions, pairwise_collision, elapsed_time, ensure_dir, \
+    MAX_DISTANCE
+from .spheres import get_sphere_trees, transform_points, SPHERE_RESOLUTION
+
+SDF_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir, 'databases', 'sdfs/'))
+SDF_RESOLUTION = 0.04 # meters
+SDF_PADDING = 0.3 # meters
+SDF_CACHE = {}
+
+################################################################################
+
+class SignedDistanceField(object):
+    """
+    Voxelized signed distance to a set of static obstacles
+    Queries return lower bounds on the true signed distance, so they can be used as a conservative pre-filter
+    """
+    def __init__(self, distances, lower, resolution, padding=SDF_PADDING):
+        self.distances = np.array(distances, dtype=np.float32)
+        self.lower = np.array(lower, dtype=float)
+        self.resolution = resolution
+        self.padding = padding
+    @property
+    def shape(self):
+        return self.distances.shape
+    @property
+    def upper(self):
+        return self.lower + self.resolution*np.array(self.shape)
+    @property
+    def error(self):
+        # Occupied voxels contain all obstacle points within the voxel radius
+        # and queries snap to the nearest voxel center
+        return np.sqrt(3) * self.resolution
+    def voxels_from_points(self, points):
+        return np.floor((np.array(points) - self.lower) / self.resolution).astype(int)
+    def query(self, points):
+        points = np.array(points, dtype=float).reshape(-1, 3)
+        voxels = self.voxels_from_points(points)
+        inside = np.all((0 <= voxels) & (voxels < np.array(self.shape)), axis=1)
+        distances = np.full(len(points), self.padding)
+        if np.any(inside):
+            i, j, k = voxels[inside].T
+            distances[inside] = self.distances[i, j, k] - self.error
+        return distances
+    def __call__(self, points):
+        return self.query(points)
+    def save(self, path):
+        ensure_dir(path)
+        np.savez_compressed(path, distances=self.distances, lower=self.lower,
+                            resolution=self.resolution, padding=self.padding)
+        return path
+    @staticmethod
+    def load(path):
+        data = np.load(path)
+        return SignedDistanceField(data['distances'], data['lower'], float(data['resolution']),
+                                   padding=float(data['padding']))
+    def __repr__(self):
+        return '{}(shape={}, resolution={})'.format(self.__class__.__name__, self.shape, self.resolution)
+
+################################################################################
+
+def get_scene_hash(obstacles, resolution=SDF_RESOLUTION, padding=SDF_PADDING):
+    # Keyed by the obstacle models and their placements
+    sha = hashlib.sha1('{:.6f} {:.6f}'.format(resolution, padding).encode())
+    for obstacle in obstacles:
+        body, links = parse_body(obstacle)
+        model_hash = get_model_hash(body)
+        if model_hash is None:
+            model_hash = str([get_collision_data(body, link) for link in get_all_links(body)])
+        sha.update(model_hash.encode())
+        sha.update(np.round(np.concatenate(get_pose(body)), 4).tobytes())
+        sha.update(np.round(np.array(get_configuration(body), dtype=float), 4).tobytes())
+        sha.update(str(links).encode())
+    return sha.hexdigest()
+
+def get_sdf_path(scene_hash):
+    return os.path.join(SDF_DIR, '{}.npz'.format(scene_hash))
+
+def compute_occupancy(obstacles, lower, shape, resolution):
+    radius = np.sqrt(3) * resolution / 2.
+    centers = lower + resolution*(np.indices(shape).reshape(3, -1).T + 0.5)
+    occupied = np.zeros(len(centers), dtype=bool)
+    with probe_shape(get_sphere_geometry(radius)) as probe:
+        for obstacle in obstacles:
+            body, links = parse_body(obstacle)
+            if links is None:
+                links = get_all_links(body)
+            for link in links:
+                aabbs = get_aabbs(body, links=[link])
+                if not aabbs:
+                    continue
+                [(link_lower, link_upper)] = aabbs
+                candidates = np.where(~occupied & np.all(centers >= np.array(link_lower) - radius, axis=1) &
+                                      np.all(centers <= np.array(link_upper) + radius, axis=1))[0]
+                for index in candidates:
+                    occupied[index] = bool(get_probe_closest_points(probe, centers[index], body,
+                                                                    link=link, max_distance=0.))
+    return occupied.reshape(shape)
+
+def compute_sdf(obstacles, resolution=SDF_RESOLUTION, padding=SDF_PADDING, verbose=False):
+    """
+    Voxelizes the obstacles and computes the signed distance from each voxel center
+    """
+    from scipy.ndimage import distance_transform_edt
+    start_time = time.time()
+    aabb = aabb_union([get_aabb(parse_body(obstacle)[0]) for obstacle in obstacles])
+    lower = np.array(aabb[0]) - padding
+    shape = tuple(np.ceil((np.array(aabb[1]) + padding - lower) / resolution).astype(int))
+    occupied = compute_occupancy(obstacles, lower, shape, resolution)
+    distances = distance_transform_edt(~occupied, sampling=resolution) - \
+                distance_transform_edt(occupied, sampling=resolution)
+    sdf = SignedDistanceField(distances, lower, resolution, padding=padding)
+    if verbose:
+        print('Computed {} with {} occupied voxels in {:.3f} seconds'.format(
+            sdf, np.count_nonzero(occupied), elapsed_time(start_time)))
+    return sdf
+
+def get_sdf(obstacles, resolution=SDF_RESOLUTION, padding=SDF_PADDING, path=None, save=True, **kwargs):
+    # Persisted per scene so that static geometry is only voxelized once
+    obstacles = list(obstacles)
+    if path is None:
+        path = get_sdf_path(get_scene_hash(obstacles, resolution=resolution, padding=padding))
+    if path in SDF_CACHE:
+        return SDF_CACHE[path]
+    if os.path.exists(path):
+        sdf = SignedDistanceField.load(path)
+    else:
+        sdf = compute_sdf(obstacles, resolution=resolution, padding=padding, **kwargs)
+        if save:
+            sdf.save(path)
+    SDF_CACHE[path] = sdf
+    return sdf
+
+def get_state_sdf(state, **kwargs):
+    # State.fixed excludes the robot, movable objects, and floors
+    return get_sdf(state.fixed, **kwargs)
+
+################################################################################
+
+def get_sdf_clearance_fn(body, links, sdf, resolution=SPHERE_RESOLUTION):
+    trees = get_sphere_trees(body, links=links, resolution=resolution)
+    spheres = {link: tree.coarse for link, tree in trees.items() if tree is not None}
+    # Links that cannot be approximated are never certified
+    missing = {link: -np.inf for link, tree in trees.items() if tree is None}
+    links = sorted(spheres)
+    radii = np.concatenate([spheres[link].radii for link in links]) if links else np.zeros(0)
+    indices = np.cumsum([0] + [len(spheres[link].radii) for link in links])
+
+    def clearance_fn():
+        # Lower bounds the distance from each link to the static obstacles in the current state
+        if not links:
+            return dict(missing)
+        centers = np.concatenate([transform_points(get_com_pose(body, link), spheres[link].centers) for link in links])
+        distances = np.minimum.reduceat(sdf.query(centers) - radii, indices[:-1])
+        clearances = dict(zip(links, distances))
+        clearances.update(missing)
+        return clearances
+    return clearance_fn
+
+def get_sdf_collision_fn(body, joints, fixed_obstacles, obstacles=[], attachments=[], sdf=None,
+                         max_distance=MAX_DISTANCE, resolution=SDF_RESOLUTION,
+                         sphere_resolution=SPHERE_RESOLUTION, **kwargs):
+    """
+    Skips Bullet checks against fixed_obstacles whenever the signed distance field certifies the robot is clear
+    of them, otherwise falls back to pairwise_collision via get_collision_fn
+    """
+    fixed_obstacles = list(fixed_obstacles)
+    if sdf is None:
+        sdf = get_sdf(fixed_obstacles, resolution=resolution)
+    collision_fn = get_collision_fn(body, joints, fixed_obstacles + list(obstacles), attachments,
+                                    max_distance=max_distance, **kwargs)
+    movable_collision_fn = get_collision_fn(body, joints, obstacles, attachments,
+                                            max_distance=max_distance, **kwargs)
+    clearance_fn = get_sdf_clearance_fn(body, collision_fn.moving_links, sdf, resolution=sphere_resolution)
+    lower_limits, upper_limits = map(np.array, get_custom_limits(body, joints, kwargs.get('custom_limits', {})))
+
+    def sdf_collision_fn(q, verbose=False):
+        if np.any(np.less(q, lower_limits)) or np.any(np.greater(q, upper_limits)):
+            return collision_fn(q, verbose=verbose)
+        set_joint_positions(body, joints, q)
+        if all(clearance > max_distance for clearance in clearance_fn().values()):
+            sdf_collision_fn.counts['certified'] += 1
+            return movable_collision_fn(q, verbose=verbose) or \
+                   any(pairwise_collision(attachment.child, obstacle, max_distance=max_distance)
+                       for attachment in attachments for obstacle in fixed_obstacles)
+        sdf_collision_fn.counts['fallback'] += 1
+        return collision_fn(q, verbose=verbose)
+
+    sdf_collision_fn.counts = Counter()
+    sdf_collision_fn.sdf = sdf
+    sdf_collision_fn.clearance_fn = clearance_fn
+    return sdf_collision_fn
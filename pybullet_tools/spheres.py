@@ -0,0 +1,297 @@
+import os
+import numpy as np
+from collections import namedtuple
+
+from .utils import get_model_hash, get_model_info, get_body_name, get_link_name, get_all_links, parse_body, \
+    get_collision_data, get_data_pose, vertices_from_data, get_aabbs, get_aabb_vertices, aabb_from_points, \
+    apply_affine, invert, matrix_from_quat, get_com_pose, get_moving_links, read_json, write_json, ensure_dir, \
+    get_client, get_sphere_geometry, probe_shape, get_probe_closest_points, MAX_DISTANCE
+from .kinematics import get_kinematic_tree
+
+# Generated at runtime, so stored in the user's cache rather than the package
+SPHERE_TREE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')),
+                               'pybullet_planning', 'sphere_trees/')
+SPHERE_RESOLUTION = 0.03 # meters
+MAX_CELLS = 4096
+SPHERE_TREE_CACHE = {}
+
+Spheres = namedtuple('Spheres', ['centers', 'radii'])
+# Centers are in the link's center of mass frame
+# coarse and outer spheres cover the collision geometry while inner spheres are contained within it
+SphereTree = namedtuple('SphereTree', ['center', 'radius', 'coarse', 'outer', 'inner'])
+
+def empty_spheres():
+    return Spheres(np.zeros((0, 3)), np.zeros(0))
+
+def concatenate_spheres(spheres):
+    spheres = list(spheres)
+    if not spheres:
+        return empty_spheres()
+    return Spheres(np.concatenate([s.centers for s in spheres]), np.concatenate([s.radii for s in spheres]))
+
+def transform_points(pose, points):
+    # Vectorized apply_affine
+    point, quat = pose
+    return np.array(points).dot(matrix_from_quat(quat).T) + point
+
+################################################################################
+
+def get_element_vertices(body, link):
+    # Vertices of each collision element in the link's center of mass frame
+    elements = []
+    for data in get_collision_data(body, link):
+        try:
+            vertices = vertices_from_data(data)
+        except (RuntimeError, IOError, NotImplementedError):
+            return None
+        elements.append(np.array(apply_affine(get_data_pose(data), vertices)))
+    return elements
+
+def get_aabb_element(body, link):
+    # Conservatively bounds collision elements that cannot be parsed (e.g. missing meshes or planes)
+    aabbs = get_aabbs(body, links=[link])
+    if not aabbs or not np.all(np.isfinite(aabbs[0])):
+        return None
+    [aabb] = aabbs
+    return np.array(apply_affine(invert(get_com_pose(body, link)), get_aabb_vertices(aabb)))
+
+def get_hull_equations(vertices):
+    try:
+        from scipy.spatial import ConvexHull
+        return ConvexHull(vertices).equations
+    except Exception: # Degenerate (e.g. planar) geometry
+        return None
+
+def get_cells(vertices, resolution=SPHERE_RESOLUTION, max_cells=MAX_CELLS):
+    lower, upper = map(np.array, aabb_from_points(vertices))
+    num_cells = np.maximum(np.ceil((upper - lower) / resolution), 1)
+    if np.prod(num_cells) > max_cells:
+        num_cells = np.maximum(np.floor(num_cells / (np.prod(num_cells) / max_cells)**(1./3)), 1)
+    num_cells = num_cells.astype(int)
+    sizes = np.maximum(upper - lower, 1e-6) / num_cells
+    centers = lower + sizes*(np.indices(num_cells).reshape(3, -1).T + 0.5)
+    return centers, np.linalg.norm(sizes) / 2.
+
+def cover_with_spheres(vertices, **kwargs):
+    # Spheres whose union contains the convex hull of vertices
+    centers, radius = get_cells(vertices, **kwargs)
+    equations = get_hull_equations(vertices)
+    if equations is not None:
+        # Keeps every cell whose bounding sphere could intersect the hull
+        centers = centers[np.all(centers.dot(equations[:, :3].T) + equations[:, 3] <= radius, axis=1)]
+    return Spheres(centers, radius*np.ones(len(centers)))
+
+def inscribe_spheres(vertices, **kwargs):
+    # Candidate spheres contained within the convex hull of vertices
+    equations = get_hull_equations(vertices)
+    if equations is None:
+        return empty_spheres()
+    centers, _ = get_cells(vertices, **kwargs)
+    radii = -np.max(centers.dot(equations[:, :3].T) + equations[:, 3], axis=1)
+    return Spheres(centers[radii > 0], radii[radii > 0])
+
+def verify_inner_spheres(body, link, spheres, max_spheres=16, tolerance=1e-3):
+    # Bullet may treat meshes differently than their convex hull, so inner spheres are validated against it
+    inner = []
+    probe_radius = 1e-3
+    with probe_shape(get_sphere_geometry(probe_radius)) as probe:
+        world_centers = transform_points(get_com_pose(body, link), spheres.centers)
+        for index in np.argsort(-spheres.radii):
+            if len(inner) >= max_spheres:
+                break
+            distances = [info.contactDistance for info in get_probe_closest_points(
+                probe, world_centers[index], body, link=link, max_distance=0.)]
+            if not distances:
+                continue
+            radius = min(spheres.radii[index], -min(distances) - probe_radius) - tolerance
+            if radius > 0:
+                inner.append((spheres.centers[index], radius))
+    if not inner:
+        return empty_spheres()
+    centers, radii = zip(*inner)
+    return Spheres(np.array(centers), np.array(radii))
+
+def approximate_sphere_tree(body, link, resolution=SPHERE_RESOLUTION, max_inner=16):
+    elements = get_element_vertices(body, link)
+    if elements is None:
+        element = get_aabb_element(body, link)
+        if element is None:
+            return None
+        elements, candidates = [element], empty_spheres()
+    else:
+        candidates = concatenate_spheres(inscribe_spheres(vertices, resolution=resolution)
+                                         for vertices in elements if len(vertices) >= 4)
+    outer = concatenate_spheres(cover_with_spheres(vertices, resolution=resolution)
+                                for vertices in elements if len(vertices))
+    coarse = concatenate_spheres(cover_with_spheres(vertices, resolution=2*resolution)
+                                 for vertices in elements if len(vertices))
+    if not len(outer.radii):
+        return None
+    inner = verify_inner_spheres(body, link, candidates, max_spheres=max_inner)
+    lower, upper = aabb_from_points(outer.centers)
+    center = (np.array(lower) + np.array(upper)) / 2.
+    radius = np.max(np.linalg.norm(outer.centers - center, axis=1) + outer.radii)
+    return SphereTree(center, radius, coarse, outer, inner)
+
+################################################################################
+
+def get_sphere_tree_path(model_hash, resolution=SPHERE_RESOLUTION):
+    return os.path.join(SPHERE_TREE_DIR, '{}_{}.json'.format(model_hash, int(round(1000*resolution))))
+
+def save_sphere_trees(body, trees, resolution=SPHERE_RESOLUTION):
+    model_hash = get_model_hash(body)
+    assert model_hash is not None
+    data = {
+        'robot': get_body_name(body),
+        'urdf': get_model_info(body).path,
+        'hash': model_hash,
+        'resolution': resolution,
+        'links': {get_link_name(body, link): None if tree is None else {
+            'center': list(tree.center),
+            'radius': tree.radius,
+            'coarse': np.column_stack(tree.coarse).tolist(),
+            'outer': np.column_stack(tree.outer).tolist(),
+            'inner': np.column_stack(tree.inner).tolist(),
+        } for link, tree in trees.items()},
+    }
+    path = get_sphere_tree_path(model_hash, resolution=resolution)
+    ensure_dir(path)
+    write_json(path, data)
+    return path
+
+def load_sphere_trees(body, resolution=SPHERE_RESOLUTION):
+    model_hash = get_model_hash(body)
+    if model_hash is None:
+        return None
+    path = get_sphere_tree_path(model_hash, resolution=resolution)
+    if not os.path.exists(path):
+        return None
+    data = read_json(path)
+    def parse_spheres(rows):
+        rows = np.array(rows, dtype=float).reshape(-1, 4)
+        return Spheres(rows[:, :3], rows[:, 3])
+    link_from_name = {get_link_name(body, link): link for link in get_all_links(body)}
+    return {link_from_name[name]: None if tree is None else SphereTree(
+        np.array(tree['center']), tree['radius'], parse_spheres(tree['coarse']),
+        parse_spheres(tree['outer']), parse_spheres(tree['inner']))
+            for name, tree in data['links'].items() if name in link_from_name}
+
+def get_sphere_tree_key(body, resolution=SPHERE_RESOLUTION):
+    return (get_client(), body, get_model_hash(body), get_model_info(body), resolution)
+
+def get_sphere_trees(body, links=None, resolution=SPHERE_RESOLUTION):
+    """
+    Sphere trees for the collision links of body, cached on disk per URDF
+    :return: dict from link to SphereTree (or None if the link could not be approximated)
+    """
+    key = get_sphere_tree_key(body, resolution=resolution)
+    if key not in SPHERE_TREE_CACHE:
+        trees = load_sphere_trees(body, resolution=resolution)
+        if trees is None:
+            trees = {link: approximate_sphere_tree(body, link, resolution=resolution)
+                     for link in get_all_links(body) if get_collision_data(body, link)}
+            if get_model_hash(body) is not None:
+                save_sphere_trees(body, trees, resolution=resolution)
+        SPHERE_TREE_CACHE[key] = trees
+    trees = SPHERE_TREE_CACHE[key]
+    if links is None:
+        return dict(trees)
+    return {link: trees[link] for link in links if link in trees}
+
+################################################################################
+
+KD_TREES = {}
+
+def get_kd_tree(tree_key, link, level, spheres):
+    # Nearest neighbor queries over sphere centers in their link frame
+    # Keyed like SPHERE_TREE_CACHE, so there is at most one kd-tree per cached sphere tree level
+    from scipy.spatial import cKDTree
+    key = (tree_key, link, level)
+    if key not in KD_TREES:
+        KD_TREES[key] = cKDTree(spheres.centers)
+    return KD_TREES[key]
+
+def get_sphere_collision_fn(body, joints, obstacles, max_distance=MAX_DISTANCE, resolution=SPHERE_RESOLUTION):
+    """
+    Classifies a batch of configurations as clearly colliding or clearly free of obstacles using NumPy forward
+    kinematics and sphere trees. Configurations that are neither require Bullet collision checks.
+    :return: function from an (N, len(joints)) array to (colliding, free) boolean arrays
+    """
+    kinematic_tree = get_kinematic_tree(body)
+    trees = get_sphere_trees(body, resolution=resolution)
+    exact = all(tree is not None for tree in trees.values())
+    links = sorted(link for link, tree in trees.items() if tree is not None)
+    root_centers = np.array([trees[link].center for link in links]).reshape(-1, 3)
+    root_radii = np.array([trees[link].radius for link in links])
+    moving_links = set(get_moving_links(body, joints))
+    static = np.array([link not in moving_links for link in links], dtype=bool)
+
+    def get_obstacle_trees():
+        # Obstacles may have moved since the last call
+        obstacle_trees = []
+        complete = True
+        for obstacle in obstacles:
+            obstacle_body, obstacle_links = parse_body(obstacle)
+            tree_key = get_sphere_tree_key(obstacle_body, resolution=resolution)
+            for link, tree in get_sphere_trees(obstacle_body, links=obstacle_links, resolution=resolution).items():
+                if tree is None:
+                    complete = False
+                    continue
+                point, quat = get_com_pose(obstacle_body, link)
+                obstacle_trees.append((tree, np.array(point), matrix_from_quat(quat), (tree_key, link)))
+        return obstacle_trees, complete
+
+    def sphere_collision_fn(confs):
+        confs = np.array(confs, dtype=float).reshape(-1, len(joints))
+        colliding = np.zeros(len(confs), dtype=bool)
+        uncertain = np.zeros(len(confs), dtype=bool)
+        obstacle_trees, complete = get_obstacle_trees()
+        if not (exact and complete):
+            uncertain[:] = True
+        if not links or not obstacle_trees:
+            return colliding, ~uncertain
+        poses = kinematic_tree.link_poses(confs, joints, links, com=True)
+        rotations, translations = poses[..., :3, :3], poses[..., :3, 3]
+        roots = np.einsum('nlij,lj->nli', rotations, root_centers) + translations
+        obstacle_centers = np.array([point + rotation.dot(tree.center) for tree, point, rotation, _ in obstacle_trees])
+        obstacle_radii = np.array([tree.radius for tree, _, _, _ in obstacle_trees])
+        gaps = np.linalg.norm(roots[:, :, None, :] - obstacle_centers[None, None, :, :], axis=3) \
+               - root_radii[None, :, None] - obstacle_radii[None, None, :]
+        close = gaps <= max_distance
+        for l, m in zip(*np.nonzero(np.any(close, axis=0))):
+            tree = trees[links[l]]
+            obstacle_tree, point, rotation, (tree_key, obstacle_link) = obstacle_trees[m]
+            clear = np.zeros(len(confs), dtype=bool)
+            for spheres, level in [(tree.inner, 'inner'), (tree.coarse, 'outer'), (tree.outer, 'outer')]:
+                obstacle_spheres = getattr(obstacle_tree, level)
+                # Configurations that are already classified are skipped
+                indices = np.nonzero(close[:, l, m] & ~colliding & ~uncertain & ~clear)[0]
+                if not len(indices) or not len(spheres.radii) or not len(obstacle_spheres.radii):
+                    continue
+                if static[l]:
+                    # The link does not depend on joints
+                    indices = indices[:1]
+                # Robot spheres expressed in the obstacle link's frame
+                link_from_obstacle = np.einsum('ij,njk->nik', rotation.T, rotations[indices, l])
+                offsets = (translations[indices, l] - point).dot(rotation)
+                centers = np.matmul(spheres.centers, link_from_obstacle.transpose(0, 2, 1)) + offsets[:, None, :]
+                bound = np.max(spheres.radii) + np.max(obstacle_spheres.radii) + max(max_distance, 0.)
+                distances, nearest = get_kd_tree(tree_key, obstacle_link, level, obstacle_spheres).query(centers.reshape(-1, 3),
+                                                                         distance_upper_bound=bound)
+                distances = distances.reshape(len(indices), -1)
+                if static[l]:
+                    indices = np.nonzero(close[:, l, m] & ~colliding & ~uncertain & ~clear)[0]
+                if spheres is not tree.inner:
+                    # Conservative when the obstacle's spheres have different radii
+                    separations = distances - spheres.radii - np.max(obstacle_spheres.radii)
+                    near = np.any(separations <= max_distance, axis=1)
+                    if spheres is tree.coarse:
+                        clear[indices] |= ~near
+                    else:
+                        uncertain[indices] |= near
+                else:
+                    radii = np.append(obstacle_spheres.radii, 0.)[nearest].reshape(distances.shape)
+                    colliding[indices] |= np.any(distances - spheres.radii - radii < 0., axis=1)
+        return colliding, ~(uncertain | colliding)
+
+    return sphere_collision_fn
@@ -1,5 +1,9 @@
 import math
 import os.path
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 from tracikpy import TracIKSolver
@@ -7,7 +11,7 @@ from tracikpy import TracIKSolver
 from pybullet_tools.utils import Pose, multiply, invert, tform_from_pose, get_model_info, BASE_LINK, \
     get_link_name, link_from_name, get_joint_name, joint_from_name, parent_link_from_joint, joints_from_names, \
     links_from_names, get_link_pose, draw_pose, set_joint_positions, get_joint_positions, get_joint_limits, \
-    CIRCULAR_LIMITS, get_custom_limits
+    CIRCULAR_LIMITS, get_custom_limits, elapsed_time
 
 
 class IKSolver(object):
@@ -36,6 +40,8 @@ class IKSolver(object):
         self.ik_solver.joint_limits = list(get_custom_limits(
             self.body, self.joints, custom_limits=custom_limits, circular_limits=CIRCULAR_LIMITS))
 
+        self.max_time = max_time
+        self.error = error
         self.tool_offset = tool_offset # None
         self.random_generator = np.random.RandomState(seed)
         self.solutions = []
@@ -149,3 +155,71 @@ class IKSolver(object):
     def __str__(self):
         return '{}(body={}, tool={}, base={}, joints={})'.format(
             self.__class__.__name__, self.robot, self.tool_name, self.base_name, list(self.joint_names))
+
+
+class IKSolverPool(object):
+    """
+    Holds one TRAC-IK instance per worker thread, which solve concurrently because the native solver releases the GIL
+    All simulator queries happen on the calling thread
+    """
+    def __init__(self, body, tool_link, num_workers=None, **kwargs):
+        self.solver = IKSolver(body, tool_link, **kwargs)
+        self.num_workers = os.cpu_count() if num_workers is None else num_workers
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+        self.local = threading.local()
+    @property
+    def robot(self):
+        return self.solver.robot
+    def get_ik_solver(self):
+        ik_solver = getattr(self.local, 'ik_solver', None)
+        if ik_solver is None:
+            ik_solver = TracIKSolver(
+                urdf_file=self.solver.urdf_path,
+                base_link=self.solver.base_name,
+                tip_link=self.solver.tool_name,
+                timeout=self.solver.max_time, epsilon=self.solver.error,
+                solve_type='Speed',
+            )
+            ik_solver.joint_limits = self.solver.joint_limits
+            self.local.ik_solver = ik_solver
+        return ik_solver
+
+    def solve_many(self, tool_poses, seed_confs=None, pos_tolerance=1e-5, ori_tolerance=math.radians(5e-2)):
+        """
+        :param seed_confs: one seed per pose; defaults to uniformly sampled confs
+        :return: a list of solutions (None upon failure) and a list of solve times in seconds
+        """
+        base_from_world = invert(self.solver.get_base_pose())
+        poses = [multiply(base_from_world, tool_pose) for tool_pose in tool_poses]
+        tforms = list(map(tform_from_pose, poses))
+        if seed_confs is None:
+            seed_confs = [self.solver.sample_conf() for _ in poses]
+        assert len(seed_confs) == len(tforms)
+        bx, by, bz = pos_tolerance * np.ones(3)
+        brx, bry, brz = ori_tolerance * np.ones(3)
+
+        def solve(tform, seed_conf):
+            start_time = time.time()
+            conf = self.get_ik_solver().ik(tform, qinit=seed_conf, bx=bx, by=by, bz=bz, brx=brx, bry=bry, brz=brz)
+            return conf, elapsed_time(start_time)
+        results = list(self.executor.map(solve, tforms, seed_confs))
+        solutions = [conf for conf, _ in results]
+        times = [solve_time for _, solve_time in results]
+        self.solver.solutions.extend(zip(poses, solutions))
+        return solutions, times
+    def solve_many_randomized(self, tool_poses, num_seeds=1, **kwargs):
+        # Returns the first successful solution across num_seeds random seeds for each pose
+        tool_poses = list(tool_poses)
+        solutions, times = self.solve_many([tool_pose for tool_pose in tool_poses for _ in range(num_seeds)], **kwargs)
+        grouped = [solutions[i*num_seeds:(i+1)*num_seeds] for i in range(len(tool_poses))]
+        return [next((conf for conf in group if conf is not None), None) for group in grouped], \
+               [sum(times[i*num_seeds:(i+1)*num_seeds]) for i in range(len(tool_poses))]
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+    def __str__(self):
+        return '{}(solver={}, workers={})'.format(self.__class__.__name__, self.solver, self.num_workers)
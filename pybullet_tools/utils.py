@@ -2,6 +2,7 @@ from __future__ import print_function
 
 import collections
 import colorsys
+import copy
 import inspect
 import json
 import math
@@ -15,21 +16,20 @@ import random
 import sys
 import time
 import datetime
+import hashlib
 import shutil
 import cProfile
 import pstats
 
-from collections import defaultdict, deque, namedtuple
+from collections import defaultdict, deque, namedtuple, Counter
 from itertools import product, combinations, count, cycle, islice
 from multiprocessing import TimeoutError
 from contextlib import contextmanager
+from functools import wraps
 
 from .transformations import quaternion_from_matrix, unit_vector, euler_from_quaternion, quaternion_slerp
 
-directory = os.path.dirname(os.path.abspath(__file__))
-sys.path.append(os.path.join(directory, '../motion'))
-from motion_planners.rrt_connect import birrt
-from motion_planners.meta import direct_path, solve
+from .planners import birrt, direct_path, solve, bisection_order, get_batch_fn, get_edge_fn
 
 #from ..motion.motion_planners.rrt_connect import birrt, direct_path
 
@@ -1218,6 +1218,7 @@ def disable_gravity():
 
 def step_simulation():
     p.stepSimulation(physicsClientId=CLIENT)
+    touch_body(None)
 
 def update_scene():
     # TODO: https://github.com/bulletphysics/bullet3/pull/3331
@@ -1794,11 +1795,20 @@ def get_euler(body):
 def get_base_values(body):
     return base_values_from_pose(get_pose(body))
 
+STATE_VERSIONS = Counter() # Incremented whenever a body's state is set (None for every body)
+
+def touch_body(body):
+    STATE_VERSIONS[body] += 1
+
+def get_state_version(body):
+    return STATE_VERSIONS[None], STATE_VERSIONS[body]
+
 def set_pose(body, pose):
     if len(pose) != 2:
         print('utils.set_pose()')
     (point, quat) = pose
     p.resetBasePositionAndOrientation(body, point, quat, physicsClientId=CLIENT)
+    touch_body(body)
 
 def set_point(body, point):
     set_pose(body, (point, get_quat(body)))
@@ -1989,10 +1999,12 @@ def get_joint_torques(body, joints):
 
 def set_joint_state(body, joint, position, velocity):
     p.resetJointState(body, joint, targetValue=position, targetVelocity=velocity, physicsClientId=CLIENT)
+    touch_body(body)
 
 def set_joint_position(body, joint, value):
     # TODO: remove targetVelocity=0
     p.resetJointState(body, joint, targetValue=value, targetVelocity=0, physicsClientId=CLIENT)
+    touch_body(body)
 
 # def set_joint_velocity(body, joint, velocity):
 #     p.resetJointState(body, joint, targetVelocity=velocity, physicsClientId=CLIENT) # TODO: targetValue required
@@ -2913,6 +2925,25 @@ def clone_world(client=None, exclude=[]):
             mapping[body] = new_body
     return mapping
 
+def reload_world(client=None, exclude=[]):
+    # Reloads bodies from their model files when possible, which is more faithful than clone_body
+    mapping = {}
+    for body in get_bodies():
+        if body in exclude:
+            continue
+        info = get_model_info(body)
+        if (info is None) or (info.path is None):
+            mapping[body] = clone_body(body, collision=True, visual=False, client=client)
+            continue
+        pose, configuration = get_pose(body), get_configuration(body)
+        with ClientSaver(client):
+            with HideOutput():
+                new_body = load_model_info(info)
+            set_pose(new_body, pose)
+            set_configuration(new_body, configuration)
+        mapping[body] = new_body
+    return mapping
+
 #####################################
 
 def get_mesh_data(obj, link=BASE_LINK, shape_index=0, visual=True):
@@ -3371,21 +3402,210 @@ def approximate_as_cylinder(body, **kwargs):
 
 #####################################
 
+# Collision statistics
+
+COLLISION_STATISTICS_ENABLED = False
+COLLISION_STATISTICS = defaultdict(Counter)
+COLLISION_STREAMS = []
+
+def enable_collision_statistics(enable=True):
+    global COLLISION_STATISTICS_ENABLED
+    COLLISION_STATISTICS_ENABLED = enable
+    return enable
+
+def collision_statistics_enabled():
+    return COLLISION_STATISTICS_ENABLED
+
+def reset_collision_statistics():
+    COLLISION_STATISTICS.clear()
+
+@contextmanager
+def collision_stream(name):
+    # Attributes collision checks to a stream (such as a pddlstream external or a planner)
+    COLLISION_STREAMS.append(name)
+    try:
+        yield name
+    finally:
+        COLLISION_STREAMS.pop()
+
+def step_collision_stream(name, generator):
+    # Only enters the stream while the generator runs, so suspended generators do not claim other checks
+    while True:
+        with collision_stream(name):
+            try:
+                value = next(generator)
+            except StopIteration:
+                return
+        yield value
+
+def stream_collisions(name, fn):
+    # Attributes the collision checks performed by fn, or by the generator that it returns, to stream name
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        if not COLLISION_STATISTICS_ENABLED:
+            return fn(*args, **kwargs)
+        with collision_stream(name):
+            result = fn(*args, **kwargs)
+        if inspect.isgenerator(result):
+            return step_collision_stream(name, result)
+        return result
+    return wrapped
+
+def instrument_stream_map(stream_map):
+    return {name: stream_collisions(name, fn) if callable(fn) else fn for name, fn in stream_map.items()}
+
+def get_call_site():
+    # First frame outside of this module
+    frame = sys._getframe(1)
+    while (frame is not None) and (frame.f_code.co_filename == __file__):
+        frame = frame.f_back
+    if frame is None:
+        return None
+    return '{}:{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_lineno, frame.f_code.co_name)
+
+def get_collision_key(function, body1, body2):
+    stream = COLLISION_STREAMS[-1] if COLLISION_STREAMS else None
+    body1 = None if body1 is None else int(parse_body(body1)[0])
+    body2 = None if body2 is None else int(parse_body(body2)[0])
+    return (stream, get_call_site(), function, (body1, body2))
+
+def count_collision_statistic(name, function, body1, body2, value=1):
+    # Callers in inner loops should check COLLISION_STATISTICS_ENABLED first to avoid building the arguments
+    if not COLLISION_STATISTICS_ENABLED:
+        return
+    COLLISION_STATISTICS[get_collision_key(function, body1, body2)][name] += value
+
+def instrument_collisions(fn, name=None, bodies=None):
+    """
+    Records calls, wall time, and hits of fn per stream, call site, and body pair
+    when collision statistics are enabled and otherwise only adds a flag check
+    :param bodies: fixed (body1, body2) pair, otherwise taken from the first two arguments
+    """
+    function = fn.__name__ if name is None else name
+    @wraps(fn)
+    def instrumented(*args, **kwargs):
+        if not COLLISION_STATISTICS_ENABLED:
+            return fn(*args, **kwargs)
+        if bodies is not None:
+            body1, body2 = bodies
+        else:
+            body1 = args[0] if len(args) >= 1 else kwargs.get('body1')
+            body2 = args[1] if len(args) >= 2 else kwargs.get('body2')
+        key = get_collision_key(function, body1, body2)
+        start_time = time.time()
+        result = fn(*args, **kwargs)
+        statistics = COLLISION_STATISTICS[key]
+        statistics['calls'] += 1
+        statistics['time'] += elapsed_time(start_time)
+        statistics['hits'] += bool(result)
+        return result
+    return instrumented
+
+#####################################
+
 # Collision
 
 MAX_DISTANCE = 0. # 0. | 1e-3
 
 CollisionPair = namedtuple('Collision', ['body', 'links'])
 
+DEFAULT_FILTER = 1 # btBroadphaseProxy::DefaultFilter
+STATIC_FILTER = 2 # btBroadphaseProxy::StaticFilter
+ALL_FILTER = -1 # btBroadphaseProxy::AllFilter
+COLLISION_FILTERS = {}
+
 def set_collision_mask(body, link, group, mask=0):
     # p.URDF_USE_SELF_COLLISION
     # p.URDF_USE_SELF_COLLISION_EXCLUDE_PARENT
     # p.URDF_USE_SELF_COLLISION_EXCLUDE_ALL_PARENTS
-    return p.setCollisionFilterGroupMask(body, link, group, mask)
+    COLLISION_FILTERS[CLIENT, int(body), link] = (group, mask)
+    return p.setCollisionFilterGroupMask(body, link, group, mask, physicsClientId=CLIENT)
+
+def get_collision_filter(body, link):
+    # Bullet doesn't expose the (group, mask) of a link, so only those set through set_collision_mask are known
+    key = (CLIENT, int(body), link)
+    if key in COLLISION_FILTERS:
+        return COLLISION_FILTERS[key]
+    if get_mass(body, link) == STATIC_MASS:
+        return STATIC_FILTER, ALL_FILTER ^ STATIC_FILTER
+    return DEFAULT_FILTER, ALL_FILTER
 
 def set_collision_pair_mask(body1, body2, link1=BASE_LINK, link2=BASE_LINK, enable=True):
     return p.setCollisionFilterPair(body1, link1, body2, link2, enableCollision=enable)
 
+CLOSEST_ENGINE = 'closest'
+CONTACT_ENGINE = 'contacts'
+CONTACT_BREAKING_THRESHOLD = 0.02 # Bullet default, see set_aabb_buffer
+MOVING_GROUP = 1 << 6
+OBSTACLE_GROUP = 1 << 7
+LINK_KEY = 1 << 16
+
+def get_link_keys(body, links):
+    return [int(body)*LINK_KEY + (link - BASE_LINK) for link in links]
+
+def get_pair_keys(keys1, keys2):
+    keys1, keys2 = np.array(keys1, dtype=np.int64), np.array(keys2, dtype=np.int64)
+    return np.minimum(keys1, keys2)*(LINK_KEY**2) + np.maximum(keys1, keys2)
+
+def assign_obstacle_groups(obstacles):
+    # Obstacles keep their mask, so adding OBSTACLE_GROUP leaves their contacts with the rest of the scene unchanged
+    for body, links in map(expand_links, obstacles):
+        for link in links:
+            group, mask = get_collision_filter(body, link)
+            if not (group & OBSTACLE_GROUP):
+                set_collision_mask(body, link, group | OBSTACLE_GROUP, mask=mask)
+
+def assign_moving_groups(moving_bodies):
+    # Moving links only generate contacts with obstacles and each other
+    for body, links in map(expand_links, moving_bodies):
+        for link in links:
+            set_collision_mask(body, link, MOVING_GROUP, mask=MOVING_GROUP | OBSTACLE_GROUP)
+
+def get_contact_check_fn(body, moving_bodies, obstacles, link_pairs=[], max_distance=MAX_DISTANCE,
+                         self_contacts=False, filter_contacts=False):
+    """
+    Checks a configuration with a single performCollisionDetection and getContactPoints sweep
+    Contacts are filtered against the allowed (moving, obstacle) and self link pairs in NumPy
+    :param self_contacts: body was loaded with URDF_USE_SELF_COLLISION, otherwise link_pairs are checked pairwise
+    :param filter_contacts: assigns collision groups once so that Bullet skips contacts that are filtered anyway.
+    This only prunes contacts when collisionFilterMode=0 (AND), which also needs it because Bullet's default masks
+    can drop (moving, obstacle) contacts in that mode. The masks persist after the function is created, so when
+    simulating the moving links also stop colliding with everything other than the obstacles.
+    """
+    assert max_distance <= CONTACT_BREAKING_THRESHOLD
+    moving_bodies = [expand_links(moving) for moving in moving_bodies]
+    obstacles = [expand_links(obstacle) for obstacle in obstacles]
+    if filter_contacts:
+        assign_obstacle_groups(obstacles)
+        assign_moving_groups(moving_bodies)
+    allowed = [get_pair_keys(*zip(*product(get_link_keys(body1, links1), get_link_keys(body2, links2))))
+               for (body1, links1), (body2, links2) in product(moving_bodies, obstacles)
+               if links1 and links2]
+    if self_contacts and link_pairs:
+        allowed.append(get_pair_keys(*zip(*(get_link_keys(body, link_pair) for link_pair in link_pairs))))
+        link_pairs = []
+    allowed = np.unique(np.concatenate(allowed)) if allowed else np.zeros(0, dtype=np.int64)
+
+    def check_fn(verbose=False):
+        # Assumes that the configuration and attachments are already assigned
+        for link1, link2 in link_pairs:
+            if pairwise_link_collision(body, link1, body, link2):
+                if verbose: print(body, link1, body, link2)
+                return True
+        p.performCollisionDetection(physicsClientId=CLIENT)
+        contacts = p.getContactPoints(physicsClientId=CLIENT)
+        if not contacts or not len(allowed):
+            return False
+        # contactFlag, bodyA, bodyB, linkA, linkB, ..., contactDistance
+        contacts = np.array([contact[1:5] + (contact[8],) for contact in contacts])
+        keys1 = contacts[:, 0].astype(np.int64)*LINK_KEY + (contacts[:, 2].astype(np.int64) - BASE_LINK)
+        keys2 = contacts[:, 1].astype(np.int64)*LINK_KEY + (contacts[:, 3].astype(np.int64) - BASE_LINK)
+        colliding = np.isin(get_pair_keys(keys1, keys2), allowed) & (contacts[:, 4] <= max_distance)
+        if verbose and np.any(colliding):
+            print(*map(int, contacts[np.argmax(colliding), :4]))
+        return bool(np.any(colliding))
+    return check_fn
+
 def get_buffered_aabb(body, link=None, max_distance=MAX_DISTANCE, **kwargs):
     body, links = parse_body(body, link=link)
     return buffer_aabb(aabb_union(get_aabbs(body, links=links, **kwargs)), buffer=max_distance)
@@ -3449,6 +3669,8 @@ def draw_collision_info(collision_info, **kwargs):
 def get_closest_points(body1, body2, link1=None, link2=None, max_distance=MAX_DISTANCE, use_aabb=False):
     if use_aabb and not aabb_overlap(get_buffered_aabb(body1, link1, max_distance=max_distance/2.),
                                      get_buffered_aabb(body2, link2, max_distance=max_distance/2.)):
+        if COLLISION_STATISTICS_ENABLED:
+            count_collision_statistic('pruned', 'get_closest_points', body1, body2)
         return []
     # TODO: https://github.com/bulletphysics/bullet3/blob/5ae9a15ecac7bc7e71f1ec1b544a55135d7d7e32/examples/pybullet/examples/getClosestPoints.py
     # return p.getClosestPoints(bodyA=-1, bodyB=-1, distance=100, collisionShapeA=geom, collisionShapeB=geomBox,
@@ -3472,6 +3694,26 @@ def get_closest_points(body1, body2, link1=None, link2=None, max_distance=MAX_DI
         return []
     return [CollisionInfo(*info) for info in results]
 
+get_closest_points = instrument_collisions(get_closest_points)
+
+@contextmanager
+def probe_shape(geometry):
+    # Collision shape for get_probe_closest_points that, unlike a probe body, leaves body ids unchanged
+    shape = create_collision_shape(geometry)
+    try:
+        yield shape
+    finally:
+        with HideOutput():
+            p.removeCollisionShape(shape, physicsClientId=CLIENT)
+
+def get_probe_closest_points(shape, point, body, link=None, max_distance=MAX_DISTANCE):
+    kwargs = {} if link is None else {'linkIndexB': link}
+    results = p.getClosestPoints(bodyA=-1, bodyB=body, distance=max_distance, collisionShapeA=shape,
+                                 collisionShapePositionA=point, physicsClientId=CLIENT, **kwargs)
+    if results is None:
+        return []
+    return [CollisionInfo(*info) for info in results]
+
 def pairwise_link_collision(body1, link1, body2, link2=BASE_LINK, **kwargs):
     return len(get_closest_points(body1, body2, link1=link1, link2=link2, **kwargs)) != 0
 
@@ -3496,7 +3738,6 @@ def body_collision(body1, body2, **kwargs):
     results = get_closest_points(body1, body2, **kwargs)
 
     ## YANG: debugging
-    from pybullet_tools.bullet_utils import nice, set_camera_target_body
     # handles = []
     # for collision_info in results:
     #     handles.extend(draw_collision_info(collision_info, color=YELLOW))
@@ -3505,6 +3746,8 @@ def body_collision(body1, body2, **kwargs):
 
     return len(results) != 0
 
+body_collision = instrument_collisions(body_collision)
+
 def pairwise_collision(body1, body2, **kwargs):
     if isinstance(body1, tuple) or isinstance(body2, tuple):
         body1, links1 = expand_links(body1)
@@ -3512,6 +3755,8 @@ def pairwise_collision(body1, body2, **kwargs):
         return any_link_pair_collision(body1, links1, body2, links2, **kwargs)
     return body_collision(body1, body2, **kwargs)
 
+pairwise_collision = instrument_collisions(pairwise_collision)
+
 def pairwise_collisions(body, obstacles, link=None, **kwargs):
     return any(pairwise_collision(body1=body, body2=other, link1=link, **kwargs)
                for other in obstacles if body != other)
@@ -3524,6 +3769,104 @@ def single_collision(body, **kwargs):
 
 #####################################
 
+# Broad phase
+
+class ObstacleIndex(object):
+    # Sweep-and-prune over the per-link AABBs of a set of obstacles
+    # update() only polls obstacles whose state was set through this module since the last call
+    # update(force=True) polls every obstacle, such as after moving them directly through pybullet
+    def __init__(self, obstacles, max_distance=MAX_DISTANCE):
+        self.obstacles = list(map(get_obstacle_key, obstacles))
+        self.bodies = [parse_body(obstacle).body for obstacle in self.obstacles]
+        self.max_distance = max_distance
+        self.joints_from_body = {}
+        self.version_from_obstacle = {}
+        self.state_from_obstacle = {}
+        self.aabbs_from_obstacle = {}
+        self.entries = []
+        self.lower = self.upper = np.zeros((0, 3))
+        self.num_builds = 0
+        self.update(force=True)
+    def get_state(self, obstacle):
+        body, _ = parse_body(obstacle)
+        if body not in self.joints_from_body:
+            self.joints_from_body[body] = get_movable_joints(body)
+        return get_pose(body), get_joint_positions(body, self.joints_from_body[body])
+    def update(self, force=False):
+        moved = []
+        for obstacle, body in zip(self.obstacles, self.bodies):
+            version = get_state_version(body)
+            if not force and (self.version_from_obstacle.get(obstacle, None) == version):
+                continue
+            self.version_from_obstacle[obstacle] = version
+            state = self.get_state(obstacle)
+            if self.state_from_obstacle.get(obstacle, None) == state:
+                continue
+            self.state_from_obstacle[obstacle] = state
+            body, links = expand_links(obstacle)
+            self.aabbs_from_obstacle[obstacle] = [buffer_aabb(aabb, buffer=self.max_distance/2.)
+                                                  for aabb in get_aabbs(body, links=links)]
+            moved.append(obstacle)
+        if moved:
+            self.build()
+        return moved
+    def build(self):
+        entries = [(obstacle, aabb) for obstacle in self.obstacles
+                   for aabb in self.aabbs_from_obstacle[obstacle]]
+        entries.sort(key=lambda pair: pair[1].lower[0])
+        self.entries = [obstacle for obstacle, _ in entries]
+        self.lower = np.array([aabb.lower for _, aabb in entries]).reshape(-1, 3)
+        self.upper = np.array([aabb.upper for _, aabb in entries]).reshape(-1, 3)
+        self.num_builds += 1
+    def query(self, aabbs):
+        # Returns the obstacles with at least one link AABB that overlaps with aabbs
+        if not aabbs or not self.entries:
+            return []
+        lower = np.array([aabb.lower for aabb in aabbs])
+        upper = np.array([aabb.upper for aabb in aabbs])
+        # Entries are sorted by their lower x bound
+        end = np.searchsorted(self.lower[:, 0], np.max(upper[:, 0]), side='right')
+        overlaps = np.logical_and(np.less_equal(self.lower[np.newaxis, :end], upper[:, np.newaxis]),
+                                  np.less_equal(lower[:, np.newaxis], self.upper[np.newaxis, :end])).all(axis=2)
+        indices = np.flatnonzero(overlaps.any(axis=0))
+        candidates = {self.entries[i] for i in indices}
+        return [obstacle for obstacle in self.obstacles if obstacle in candidates]
+    def query_obstacles(self, aabbs, obstacles):
+        # Same as query but returns the corresponding elements of obstacles
+        candidates = set(self.query(aabbs))
+        return [obstacle for obstacle in obstacles if get_obstacle_key(obstacle) in candidates]
+    def __len__(self):
+        return len(self.entries)
+    def __repr__(self):
+        return '{}({}, {})'.format(self.__class__.__name__, len(self.obstacles), len(self.entries))
+
+OBSTACLE_INDICES = collections.OrderedDict()
+MAX_OBSTACLE_INDICES = 32
+
+def get_obstacle_key(obstacle):
+    # Hashable version of body or (body, [links])
+    if not isinstance(obstacle, tuple):
+        return obstacle
+    body, links = obstacle
+    return CollisionPair(body, links if links is None else tuple(links))
+
+def get_obstacle_index(obstacles, max_distance=MAX_DISTANCE):
+    # Persists across collision functions and only recomputes the obstacles that moved
+    key = (CLIENT, frozenset(map(get_obstacle_key, obstacles)), max_distance)
+    if key not in OBSTACLE_INDICES:
+        OBSTACLE_INDICES[key] = ObstacleIndex(obstacles, max_distance=max_distance)
+        while len(OBSTACLE_INDICES) > MAX_OBSTACLE_INDICES:
+            OBSTACLE_INDICES.popitem(last=False)
+    else:
+        OBSTACLE_INDICES[key] = OBSTACLE_INDICES.pop(key)
+        OBSTACLE_INDICES[key].update(force=True)
+    return OBSTACLE_INDICES[key]
+
+def reset_obstacle_indices():
+    OBSTACLE_INDICES.clear()
+
+#####################################
+
 Ray = namedtuple('Ray', ['start', 'end'])
 
 def get_ray(ray):
@@ -3635,6 +3978,17 @@ def get_difference_fn(body, joints):
                      for circular, value2, value1 in zip(circular_joints, q2, q1))
     return fn
 
+def get_difference_array_fn(body, joints):
+    # Same as get_difference_fn but over (..., dof) arrays of configurations
+    circular_joints = np.array([is_circular(body, joint) for joint in joints], dtype=bool)
+    lower, upper = circular_interval()
+
+    def fn(q2, q1):
+        differences = np.array(q2, dtype=float) - np.array(q1, dtype=float)
+        differences[..., circular_joints] = np.mod(differences[..., circular_joints] - lower, upper - lower) + lower
+        return differences
+    return fn
+
 def get_default_weights(body, joints, weights=None):
     if weights is not None:
         return weights
@@ -3701,6 +4055,25 @@ def get_extend_fn(body, joints, resolutions=None, norm=2):
         return refine_fn(q1, q2)
     return fn
 
+def get_refine_array_fn(body, joints, num_steps=0):
+    # Same configurations as get_refine_fn as a single (num_steps + 1, dof) array
+    difference_fn = get_difference_array_fn(body, joints)
+    fractions = np.arange(1, num_steps + 2, dtype=float) / (num_steps + 1)
+    def fn(q1, q2):
+        return np.array(q1, dtype=float) + fractions[:, np.newaxis]*difference_fn(q2, q1)
+    return fn
+
+def get_extend_array_fn(body, joints, resolutions=None, norm=2):
+    # Same configurations as get_extend_fn as a single (k, dof) array per edge
+    resolutions = get_default_resolutions(body, joints, resolutions)
+    difference_fn = get_difference_array_fn(body, joints)
+    def fn(q1, q2):
+        differences = difference_fn(q2, q1)
+        steps = int(np.linalg.norm(np.divide(differences, resolutions), ord=norm))
+        fractions = np.arange(1, steps + 2, dtype=float) / (steps + 1)
+        return np.array(q1, dtype=float) + fractions[:, np.newaxis]*differences
+    return fn
+
 def remove_redundant(path, tolerance=1e-3):
     assert path
     new_path = [path[0]]
@@ -3774,6 +4147,116 @@ def get_self_link_pairs(body, joints, disabled_collisions=set(), only_moving=Tru
                                                 (pair[::-1] not in disabled_collisions), check_link_pairs))
     return check_link_pairs
 
+#####################################
+
+# Allowed collision matrix
+
+COLLISION_MATRIX_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir,
+                                                    'databases', 'collision_matrices/'))
+NEVER_COLLIDE, ALWAYS_COLLIDE, SOMETIMES_COLLIDE = 'never', 'always', 'sometimes'
+COLLISION_MATRIX_CACHE = {}
+HASH_FROM_MODEL = {}
+DISABLED_FROM_BODY = {}
+
+def get_model_hash(body):
+    # Keyed by the URDF content (and scale) rather than its path
+    info = get_model_info(body)
+    if (info is None) or (info.path is None) or not os.path.isfile(info.path):
+        return None
+    key = (info.path, info.scale)
+    if key not in HASH_FROM_MODEL:
+        with open(info.path, 'rb') as f:
+            content = f.read()
+        HASH_FROM_MODEL[key] = hashlib.sha1(content + str(info.scale).encode()).hexdigest()
+    return HASH_FROM_MODEL[key]
+
+def get_collision_matrix_path(model_hash):
+    return os.path.join(COLLISION_MATRIX_DIR, '{}.json'.format(model_hash))
+
+def compute_collision_matrix(body, num_samples=10000, custom_limits={}, verbose=False):
+    """
+    Classifies each non-adjacent pair of collision links as never, always, or sometimes colliding
+    by sampling random configurations (similar to the MoveIt Setup Assistant)
+    Never colliding is only as reliable as the number of samples, so matrices are opt-in in get_collision_fn
+    """
+    joints = get_movable_joints(body)
+    links = [link for link in get_all_links(body) if can_collide(body, link)]
+    link_pairs = [pair for pair in combinations(links, 2) if not are_links_adjacent(body, *pair)]
+    indices1, indices2 = map(np.array, zip(*[(links.index(link1), links.index(link2))
+                                             for link1, link2 in link_pairs])) if link_pairs else ([], [])
+    sample_fn = get_sample_fn(body, joints, custom_limits=custom_limits)
+    counts = np.zeros(len(link_pairs), dtype=int)
+    start_time = time.time()
+    with ConfSaver(body):
+        for iteration in range(num_samples):
+            set_joint_positions(body, joints, sample_fn())
+            lower, upper = map(np.array, zip(*[get_aabb(body, link) for link in links]))
+            overlapping = np.logical_and(np.less_equal(lower[indices1], upper[indices2]),
+                                         np.less_equal(lower[indices2], upper[indices1])).all(axis=1)
+            for index in np.flatnonzero(overlapping):
+                link1, link2 = link_pairs[index]
+                if pairwise_link_collision(body, link1, body, link2):
+                    counts[index] += 1
+            if verbose and (iteration % 100 == 0):
+                print('Iteration: {} | Colliding pairs: {} | Time: {:.3f}'.format(
+                    iteration, np.count_nonzero(counts), elapsed_time(start_time)))
+    matrix = {}
+    for pair, num_collisions in zip(link_pairs, counts):
+        if num_collisions == 0:
+            matrix[pair] = NEVER_COLLIDE
+        elif num_collisions == num_samples:
+            matrix[pair] = ALWAYS_COLLIDE
+        else:
+            matrix[pair] = SOMETIMES_COLLIDE
+    return matrix
+
+def save_collision_matrix(body, matrix, **kwargs):
+    model_hash = get_model_hash(body)
+    assert model_hash is not None
+    pairs = {category: [] for category in [NEVER_COLLIDE, ALWAYS_COLLIDE, SOMETIMES_COLLIDE]}
+    for (link1, link2), category in matrix.items():
+        pairs[category].append([get_link_name(body, link1), get_link_name(body, link2)])
+    data = {
+        'robot': get_body_name(body),
+        'urdf': get_model_info(body).path,
+        'hash': model_hash,
+        'pairs': pairs,
+    }
+    data.update(kwargs)
+    path = get_collision_matrix_path(model_hash)
+    ensure_dir(path)
+    write_json(path, data)
+    COLLISION_MATRIX_CACHE.pop(model_hash, None)
+    DISABLED_FROM_BODY.clear()
+    return path
+
+def load_collision_matrix(body):
+    model_hash = get_model_hash(body)
+    if model_hash is None:
+        return None
+    if model_hash not in COLLISION_MATRIX_CACHE:
+        path = get_collision_matrix_path(model_hash)
+        COLLISION_MATRIX_CACHE[model_hash] = read_json(path) if os.path.exists(path) else None
+    return COLLISION_MATRIX_CACHE[model_hash]
+
+def create_collision_matrix(body, num_samples=10000, **kwargs):
+    matrix = compute_collision_matrix(body, num_samples=num_samples, **kwargs)
+    return save_collision_matrix(body, matrix, num_samples=num_samples)
+
+def get_matrix_disabled_collisions(body, categories=(NEVER_COLLIDE, ALWAYS_COLLIDE)):
+    # Link pairs that do not need to be checked according to the cached collision matrix (if any)
+    key = (CLIENT, body, get_model_hash(body), tuple(categories))
+    if key not in DISABLED_FROM_BODY:
+        data = load_collision_matrix(body)
+        disabled = set()
+        if data is not None:
+            link_mapping = {get_link_name(body, link): link for link in get_all_links(body)}
+            disabled = {(link_mapping[name1], link_mapping[name2]) for category in categories
+                        for name1, name2 in data['pairs'][category]
+                        if (name1 in link_mapping) and (name2 in link_mapping)}
+        DISABLED_FROM_BODY[key] = frozenset(disabled)
+    return DISABLED_FROM_BODY[key]
+
 def get_limits_fn(body, joints, custom_limits={}, verbose=False):
     lower_limits, upper_limits = get_custom_limits(body, joints, custom_limits)
 
@@ -3786,8 +4269,13 @@ def get_limits_fn(body, joints, custom_limits={}, verbose=False):
     return limits_fn
 
 def get_collision_fn(body, joints, obstacles=[], attachments=[], self_collisions=True, disabled_collisions=set(),
-                     custom_limits={}, use_aabb=False, cache=False, max_distance=MAX_DISTANCE, **kwargs):
+                     custom_limits={}, use_aabb=False, cache=False, max_distance=MAX_DISTANCE,
+                     broad_phase=False, adaptive=False, use_collision_matrix=False, engine=CLOSEST_ENGINE,
+                     self_contacts=False, filter_contacts=False, **kwargs):
     # TODO: convert most of these to keyword arguments
+    assert engine in [CLOSEST_ENGINE, CONTACT_ENGINE], engine
+    if self_collisions and use_collision_matrix:
+        disabled_collisions = set(disabled_collisions) | get_matrix_disabled_collisions(body)
     check_link_pairs = get_self_link_pairs(body, joints, disabled_collisions) if self_collisions else []
     moving_links = frozenset(link for link in get_moving_links(body, joints)
                              if can_collide(body, link)) # TODO: propagate elsewhere
@@ -3796,28 +4284,39 @@ def get_collision_fn(body, joints, obstacles=[], attachments=[], self_collisions
     #moving_bodies = list(flatten(flatten_links(*pair) for pair in moving_bodies)) # Introduces overhead
     #moving_bodies = [body] + [attachment.child for attachment in attachments]
     get_obstacle_aabb = cached_fn(get_buffered_aabb, cache=cache, max_distance=max_distance/2., **kwargs)
+    obstacle_index = get_obstacle_index(obstacles, max_distance=max_distance) if broad_phase else None
+    collision_links = [CollisionPair(body1, [link for link in links if can_collide(body1, link)])
+                       for body1, links in map(expand_links, moving_bodies)]
+    obstacle_pairs = list(product(moving_bodies, obstacles))
+    self_counts, obstacle_counts = Counter(), Counter() # Fail-first ordering when adaptive
     limits_fn = get_limits_fn(body, joints, custom_limits=custom_limits)
+    lower_limits, upper_limits = map(np.array, get_custom_limits(body, joints, custom_limits))
     # TODO: sort bodies by bounding box size
 
     def collision_fn(q, verbose=False):
-        from pybullet_tools.bullet_utils import set_camera_target_body
         ## set_camera_target_body(body, dx=0.2, dy=-0.2, dz=0.2)
         if limits_fn(q):
-            limits_fn(q)
             return True
+        return check_fn(q, verbose=verbose)
+    collision_fn = instrument_collisions(collision_fn, bodies=(body, None))
+
+    def check_fn(q, verbose=False):
+        # Assumes that q is within the joint limits
         set_joint_positions(body, joints, q)
         for attachment in attachments:
             attachment.assign()
         #wait_for_duration(1e-2)
         get_moving_aabb = cached_fn(get_buffered_aabb, cache=True, max_distance=max_distance/2., **kwargs)
 
-        for link1, link2 in check_link_pairs:
+        for i, (link1, link2) in enumerate(check_link_pairs):
             # Self-collisions should not have the max_distance parameter
             # TODO: self-collisions between body and attached_bodies (except for the link adjacent to the robot)
             if (not use_aabb or aabb_overlap(get_moving_aabb(body), get_moving_aabb(body))) and \
                     pairwise_link_collision(body, link1, body, link2): #, **kwargs):
                 #print(get_body_name(body), get_link_name(body, link1), get_link_name(body, link2))
                 if verbose: print(body, link1, body, link2)
+                if adaptive:
+                    promote_hit(check_link_pairs, self_counts, i)
                 return True
 
         # #step_simulation()
@@ -3833,9 +4332,33 @@ def get_collision_fn(body, joints, obstacles=[], attachments=[], self_collisions
         #             return True
         # return False
 
-        for body1, body2 in product(moving_bodies, obstacles):
-            if (not use_aabb or aabb_overlap(get_moving_aabb(body1), get_obstacle_aabb(body2))) \
-                    and pairwise_collision(body1, body2, **kwargs):
+        if obstacle_index is not None:
+            obstacle_index.update() # Obstacles (e.g. placed objects) may have been set since the last call
+            for body1, (moving_body, links) in zip(moving_bodies, collision_links):
+                moving_aabbs = [buffer_aabb(get_aabb(moving_body, link), buffer=max_distance/2.) for link in links]
+                candidates = obstacle_index.query_obstacles(moving_aabbs, obstacles)
+                if COLLISION_STATISTICS_ENABLED:
+                    count_collision_statistic('pairs', 'collision_fn', body1, None, value=len(obstacles))
+                    count_collision_statistic('pruned', 'collision_fn', body1, None,
+                                              value=len(obstacles) - len(candidates))
+                if adaptive:
+                    candidates.sort(key=lambda body2: -obstacle_counts[get_pair_key((body1, body2))])
+                for body2 in candidates:
+                    if pairwise_collision(body1, body2, **kwargs):
+                        if verbose: print(body1, body2)
+                        if adaptive:
+                            obstacle_counts[get_pair_key((body1, body2))] += 1
+                        return True
+            return False
+
+        for i, (body1, body2) in enumerate(obstacle_pairs):
+            if COLLISION_STATISTICS_ENABLED:
+                count_collision_statistic('pairs', 'collision_fn', body1, body2)
+            if use_aabb and not aabb_overlap(get_moving_aabb(body1), get_obstacle_aabb(body2)):
+                if COLLISION_STATISTICS_ENABLED:
+                    count_collision_statistic('pruned', 'collision_fn', body1, body2)
+                continue
+            if pairwise_collision(body1, body2, **kwargs):
                 #print(get_body_name(body1), get_body_name(body2))
                 if verbose:
                     from pybullet_tools.bullet_utils import nice  ## YANG
@@ -3844,39 +4367,353 @@ def get_collision_fn(body, joints, obstacles=[], attachments=[], self_collisions
                     else:
                         print(body1, body2)
                 ## set_camera_target_body(body2, dx=0.5, dy=-0.2, dz=0.3)
+                if adaptive:
+                    promote_hit(obstacle_pairs, obstacle_counts, i, get_key=get_pair_key)
                 return True
         return False
+
+    if engine == CONTACT_ENGINE:
+        contact_fn = get_contact_check_fn(body, moving_bodies, obstacles, link_pairs=check_link_pairs,
+                                          max_distance=max_distance, self_contacts=self_contacts,
+                                          filter_contacts=filter_contacts)
+        def check_fn(q, verbose=False):
+            set_joint_positions(body, joints, q)
+            for attachment in attachments:
+                attachment.assign()
+            return contact_fn(verbose=verbose)
+
+    instrumented_check_fn = instrument_collisions(check_fn, name='collision_fn', bodies=(body, None))
+
+    def batch_fn(confs, early_exit=False, order=None, verbose=False):
+        """
+        :param confs: (N, dof) array of configurations
+        :param early_exit: stop at the first colliding configuration and report all unchecked ones as colliding
+        :param order: sequence of indices in which to check confs (such as bisection_order)
+        :return: (N,) boolean array that is True for configurations in collision
+        """
+        confs = np.array(confs, dtype=float).reshape(-1, len(joints))
+        collisions = np.logical_or(np.less(confs, lower_limits), np.greater(confs, upper_limits)).any(axis=1)
+        order = np.arange(len(confs)) if order is None else np.array(order, dtype=int)
+        if COLLISION_STATISTICS_ENABLED and collisions.any():
+            # Joint limit violations count as calls and hits like they do in collision_fn
+            num_violations = np.count_nonzero(collisions) if not early_exit else 1
+            count_collision_statistic('calls', 'collision_fn', body, None, value=num_violations)
+            count_collision_statistic('hits', 'collision_fn', body, None, value=num_violations)
+        if early_exit and collisions.any():
+            return np.ones(len(confs), dtype=bool)
+        for k, i in enumerate(order):
+            if not collisions[i] and instrumented_check_fn(confs[i], verbose=verbose):
+                collisions[i] = True
+                if early_exit:
+                    collisions[order[k:]] = True
+                    break
+        return collisions
+
+    collision_fn.batch = batch_fn
+    collision_fn.link_pairs = check_link_pairs
+    collision_fn.moving_links = moving_links
+    collision_fn.self_counts = self_counts
+    collision_fn.obstacle_counts = obstacle_counts
     return collision_fn
 
+def get_pair_key(pair):
+    # Hashable version of a pair of bodies or (body, [links])
+    return tuple(map(get_obstacle_key, pair))
+
+def promote_hit(pairs, counts, index, get_key=lambda pair: pair):
+    # Increments the hit count of pairs[index] and moves it forward to keep pairs sorted by decreasing count
+    pair = pairs[index]
+    counts[get_key(pair)] += 1
+    while (0 < index) and (counts[get_key(pairs[index - 1])] < counts[get_key(pair)]):
+        pairs[index] = pairs[index - 1]
+        index -= 1
+    pairs[index] = pair
+
+def get_batch_collision_fn(body, joints, **kwargs):
+    return get_collision_fn(body, joints, **kwargs).batch
+
+def get_lazy_extend_fn():
+    # Skips the interpolated configurations, which are validated once a candidate path is found
+    def fn(q1, q2):
+        return [q2]
+    return fn
+
+def check_path(path, extend_fn, collision_fn, bisect=True, edge_fn=None):
+    # Returns the interpolated path if each of its edges is collision-free
+    if path is None:
+        return None
+    if edge_fn is None:
+        edge_fn = get_edge_fn(collision_fn, bisect=bisect)
+    refined_path = list(path[:1])
+    for q1, q2 in get_pairs(path):
+        segment = list(extend_fn(q1, q2))
+        if edge_fn(segment):
+            return None
+        refined_path.extend(segment)
+    return refined_path
+
+def plan_lazily(plan_fn, extend_fn, collision_fn, max_attempts=1, edge_fn=None):
+    """
+    :param plan_fn: function from an extend_fn to a path (or None)
+    :param edge_fn: validates the edges of candidate paths (defaults to bisection-ordered discrete checks)
+    :return: the first lazily planned path whose edges are collision-free,
+             otherwise the path planned with extend_fn from the start
+    """
+    lazy_extend_fn = get_lazy_extend_fn()
+    for attempt in range(max_attempts):
+        path = check_path(plan_fn(lazy_extend_fn), extend_fn, collision_fn, bisect=True, edge_fn=edge_fn)
+        if path is not None:
+            return path
+    return plan_fn(extend_fn)
+
+def remap_bodies(bodies, mapping):
+    return [(mapping[body[0]],) + tuple(body[1:]) if isinstance(body, tuple) else mapping[body] for body in bodies]
+
+def remap_attachments(attachments, mapping):
+    new_attachments = []
+    for attachment in attachments:
+        attachment = copy.copy(attachment)
+        attachment.parent, attachment.child = mapping[attachment.parent], mapping[attachment.child]
+        new_attachments.append(attachment)
+    return new_attachments
+
+def plan_in_parallel(plan_fn, workers=2, race=True, max_time=INF, cost_fn=len, verbose=False):
+    """
+    Runs plan_fn(mapping) with independent random seeds in forked worker processes
+    Workers inherit a copy of the current DIRECT client, or of a DIRECT copy of the GUI client given by mapping
+    :param race: return the first path found and terminate the remaining workers,
+                 otherwise return the lowest cost path after all workers finish or max_time elapses
+    """
+    import multiprocessing
+    from queue import Empty
+    start_time = time.time()
+    context = multiprocessing.get_context('fork')
+    queue = context.Queue()
+    client = get_client()
+    mapping = {body: body for body in get_bodies()}
+    if has_gui():
+        # The GUI connection cannot be shared with forked processes
+        client = p.connect(p.DIRECT)
+        CLIENTS[client] = None
+        mapping = reload_world(client=client)
+
+    def run(seed):
+        set_client(client)
+        random.seed(seed)
+        np.random.seed(seed % (2**32))
+        queue.put((seed, plan_fn(mapping)))
+
+    seeds = [random.randint(0, 2**32 - 1) for _ in range(workers)]
+    processes = [context.Process(target=run, args=(seed,)) for seed in seeds]
+    for process in processes:
+        process.start()
+    paths = []
+    num_results = 0
+    while (num_results < workers) and (elapsed_time(start_time) < max_time):
+        try:
+            seed, path = queue.get(timeout=0.01)
+        except Empty:
+            if not any(process.is_alive() for process in processes) and queue.empty():
+                break
+            continue
+        num_results += 1
+        if path is not None:
+            paths.append(path)
+            if race:
+                break
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+    if client != get_client():
+        p.disconnect(physicsClientId=client)
+        del CLIENTS[client]
+    if verbose:
+        print('Workers: {} | Results: {} | Paths: {} | Time: {:.3f}'.format(
+            workers, num_results, len(paths), elapsed_time(start_time)))
+    if not paths:
+        return None
+    return min(paths, key=cost_fn)
+
+#####################################
+
+# Certified edges
+
+def get_displacement_bounds(body, joints, links, aabbs=None):
+    """
+    Upper bounds the displacement of any point on each link per unit change of each joint
+    :param aabbs: optional AABB per link of the geometry it carries (e.g. an attached body) at the current configuration
+    :return: (len(links), len(joints)) array
+    """
+    # Link frames coincide with joint frames, so the distance between consecutive link frames is constant
+    # except across prismatic joints, which can extend it by at most their range of motion
+    bounds = np.zeros((len(links), len(joints)))
+    for i, link in enumerate(links):
+        chain = get_link_ancestors(body, link) + [link]
+        points = [np.array(get_link_pose(body, l)[0]) for l in chain]
+        lengths = [get_length(point2 - point1) for point1, point2 in get_pairs(points)]
+        for k, child in enumerate(chain[1:]):
+            if get_joint_type(body, child) == p.JOINT_PRISMATIC:
+                lower, upper = get_joint_limits(body, child)
+                lengths[k] += max(upper - lower, 0.)
+        radius = 0.
+        link_aabbs = get_aabbs(body, links=[link]) if aabbs is None else [aabbs[i]]
+        if link_aabbs:
+            [aabb] = link_aabbs
+            radius = max(get_length(np.array(vertex) - points[-1]) for vertex in get_aabb_vertices(aabb))
+        for j, joint in enumerate(joints):
+            if joint not in chain:
+                continue
+            if get_joint_type(body, joint) == p.JOINT_PRISMATIC:
+                bounds[i, j] = 1.
+            else:
+                index = chain.index(joint)
+                bounds[i, j] = sum(lengths[index:]) + radius
+    return bounds
+
+def get_link_clearance(body, link, obstacle, max_distance=MAX_DISTANCE):
+    obstacle_body, obstacle_links = parse_body(obstacle)
+    if obstacle_links is None:
+        obstacle_links = [None]
+    distances = [info.contactDistance for obstacle_link in obstacle_links
+                 for info in get_closest_points(body, obstacle_body, link1=link, link2=obstacle_link,
+                                                max_distance=max_distance)]
+    return min(distances + [max_distance])
+
+def get_certified_edge_fn(body, joints, obstacles=[], attachments=[], self_collisions=True,
+                          disabled_collisions=set(), custom_limits={}, max_distance=MAX_DISTANCE,
+                          max_clearance=0.25, fallback_steps=4, **kwargs):
+    """
+    Certifies intervals of an edge as collision-free using the clearance at a configuration
+    and a joint-space Lipschitz bound on the displacement of each link and attached body
+    Falls back to discrete collision checks near obstacles
+    Clearance queries are pruned by AABBs: pairs farther apart than max_clearance are not queried
+    """
+    collision_fn = get_collision_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                    custom_limits=custom_limits, max_distance=max_distance, **kwargs)
+    link_pairs = list(collision_fn.link_pairs)
+    moving_links = sorted(collision_fn.moving_links)
+    links = sorted(set(moving_links) | set(flatten(link_pairs)))
+    index_from_link = {link: i for i, link in enumerate(links)}
+    moving_parts = [(body, link) for link in moving_links] + [(attachment.child, None) for attachment in attachments]
+    # Rows of bounds: one per link followed by one per attachment
+    moving_indices = np.array([index_from_link[link] for link in moving_links] +
+                              list(range(len(links), len(links) + len(attachments))), dtype=int)
+    indices1, indices2 = (np.array([index_from_link[pair[k]] for pair in link_pairs], dtype=int) for k in range(2))
+    with ConfSaver(body):
+        bounds = get_displacement_bounds(body, joints, links)
+        # Attached bodies move rigidly with their parent link
+        attachment_bounds = np.zeros((len(attachments), len(joints)))
+        for i, attachment in enumerate(attachments):
+            if attachment.parent != body:
+                continue
+            with PoseSaver(attachment.child):
+                attachment.assign()
+                attachment_bounds[i] = get_displacement_bounds(body, joints, [attachment.parent_link],
+                                                               aabbs=[get_aabb(attachment.child)])[0]
+        bounds = np.vstack([bounds, attachment_bounds])
+    obstacle_index = get_obstacle_index(obstacles, max_distance=max_clearance)
+    circular = np.array([is_circular(body, joint) for joint in joints], dtype=bool)
+    lower_limits, upper_limits = map(np.array, get_custom_limits(body, joints, custom_limits))
+    counts = Counter()
+
+    def clearance_fn(q):
+        set_joint_positions(body, joints, q)
+        for attachment in attachments:
+            attachment.assign()
+        obstacle_index.update()
+        link_clearances = []
+        for moving_body, link in moving_parts:
+            moving_aabb = buffer_aabb(get_aabb(moving_body, link), buffer=max_clearance/2.)
+            candidates = obstacle_index.query_obstacles([moving_aabb], obstacles)
+            counts['pruned'] += len(obstacles) - len(candidates)
+            counts['closest'] += len(candidates)
+            link_clearances.append(min([get_link_clearance(moving_body, link, obstacle, max_distance=max_clearance)
+                                        for obstacle in candidates] + [max_clearance]))
+        aabbs = [get_aabb(body, link) for link in links]
+        lower = np.array([aabb.lower for aabb in aabbs]).reshape(-1, 3)
+        upper = np.array([aabb.upper for aabb in aabbs]).reshape(-1, 3)
+        nearby = np.logical_and(np.less_equal(lower[indices1], upper[indices2] + max_clearance),
+                                np.less_equal(lower[indices2], upper[indices1] + max_clearance)).all(axis=1)
+        pair_clearances = np.full(len(link_pairs), max_clearance)
+        for i in np.flatnonzero(nearby):
+            link1, link2 = link_pairs[i]
+            pair_clearances[i] = min([info.contactDistance for info in get_closest_points(
+                body, body, link1=link1, link2=link2, max_distance=max_clearance)] + [max_clearance])
+        counts['pruned'] += len(link_pairs) - int(np.count_nonzero(nearby))
+        counts['closest'] += int(np.count_nonzero(nearby))
+        return np.array(link_clearances), pair_clearances
+
+    def edge_fn(confs):
+        confs = np.array(list(confs), dtype=float).reshape(-1, len(joints))
+        if np.logical_or(np.less(confs, lower_limits), np.greater(confs, upper_limits)).any():
+            return True
+        index = fallback = 0
+        while index < len(confs):
+            if fallback:
+                counts['discrete'] += 1
+                if collision_fn(confs[index]):
+                    return True
+                index += 1
+                fallback -= 1
+                continue
+            counts['clearance'] += 1
+            link_clearances, pair_clearances = clearance_fn(confs[index])
+            if np.less_equal(link_clearances, max_distance).any() or np.less_equal(pair_clearances, 0.).any():
+                return True
+            differences = confs[index+1:] - confs[index]
+            differences[:, circular] = (differences[:, circular] + PI) % (2*PI) - PI
+            displacements = np.abs(differences).dot(bounds.T)
+            certified = np.less(displacements[:, moving_indices], link_clearances - max_distance).all(axis=1) & \
+                        np.less(displacements[:, indices1] + displacements[:, indices2], pair_clearances).all(axis=1)
+            num_certified = len(certified) if certified.all() else int(np.argmin(certified))
+            counts['certified'] += num_certified
+            index += 1 + num_certified
+            if num_certified == 0:
+                fallback = fallback_steps
+        return False
+
+    edge_fn.counts = counts
+    return edge_fn
+
 def interpolate_joint_waypoints(body, joints, waypoints, resolutions=None,
-                                collision_fn=lambda *args, **kwargs: False, **kwargs):
+                                collision_fn=lambda *args, **kwargs: False, bisect=False, edge_fn=None, **kwargs):
     # TODO: unify with refine_path
     extend_fn = get_extend_fn(body, joints, resolutions=resolutions, **kwargs)
+    if edge_fn is None:
+        edge_fn = get_edge_fn(collision_fn, bisect=bisect)
     path = waypoints[:1]
     for waypoint in waypoints[1:]:
         assert len(joints) == len(waypoint)
-        for q in list(extend_fn(path[-1], waypoint)):
-            if collision_fn(q):
-                return None
-            path.append(q) # TODO: could instead yield
+        segment = list(extend_fn(path[-1], waypoint))
+        if edge_fn(segment):
+            return None
+        path.extend(segment) # TODO: could instead yield
     return path
 
 def plan_waypoints_joint_motion(body, joints, waypoints, start_conf=None, obstacles=[], attachments=[],
                                 self_collisions=True, disabled_collisions=set(),
                                 resolutions=None, custom_limits={}, max_distance=MAX_DISTANCE,
-                                use_aabb=False, cache=True):
+                                use_aabb=False, cache=True, broad_phase=False, adaptive=False, bisect=False,
+                                certify=False):
     if start_conf is None:
         start_conf = get_joint_positions(body, joints)
     assert len(start_conf) == len(joints)
     collision_fn = get_collision_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
                                     custom_limits=custom_limits, max_distance=max_distance,
-                                    use_aabb=use_aabb, cache=cache)
+                                    use_aabb=use_aabb, cache=cache, broad_phase=broad_phase, adaptive=adaptive)
     waypoints = [start_conf] + list(waypoints)
     for i, waypoint in enumerate(waypoints):
         if collision_fn(waypoint):
             #print('Warning: waypoint configuration {}/{} is in collision'.format(i, len(waypoints)))
             return None
-    return interpolate_joint_waypoints(body, joints, waypoints, resolutions=resolutions, collision_fn=collision_fn)
+    edge_fn = None
+    if certify:
+        edge_fn = get_certified_edge_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                        custom_limits=custom_limits, max_distance=max_distance,
+                                        use_aabb=use_aabb, cache=cache, broad_phase=broad_phase)
+    return interpolate_joint_waypoints(body, joints, waypoints, resolutions=resolutions,
+                                       collision_fn=collision_fn, bisect=bisect, edge_fn=edge_fn)
 
 def plan_direct_joint_motion(body, joints, end_conf, **kwargs):
     return plan_waypoints_joint_motion(body, joints, [end_conf], **kwargs)
@@ -3898,9 +4735,23 @@ def check_initial_end(start_conf, end_conf, collision_fn, verbose=False):
 def plan_joint_motion(body, joints, end_conf, obstacles=[], attachments=[],
                       self_collisions=True, disabled_collisions=set(),
                       weights=None, resolutions=None, max_distance=MAX_DISTANCE,
-                      use_aabb=False, cache=True, custom_limits={}, algorithm=None, **kwargs):
+                      use_aabb=False, cache=True, broad_phase=False, adaptive=False,
+                      custom_limits={}, algorithm=None, lazy=False, certify=False, workers=1, race=True,
+                      **kwargs):
 
     assert len(joints) == len(end_conf)
+    if workers > 1:
+        def worker_fn(mapping):
+            return plan_joint_motion(mapping[body], joints, end_conf, obstacles=remap_bodies(obstacles, mapping),
+                                     attachments=remap_attachments(attachments, mapping),
+                                     self_collisions=self_collisions, disabled_collisions=disabled_collisions,
+                                     weights=weights, resolutions=resolutions, max_distance=max_distance,
+                                     use_aabb=use_aabb, cache=cache, broad_phase=broad_phase, adaptive=adaptive,
+                                     custom_limits=custom_limits, algorithm=algorithm, lazy=lazy, certify=certify,
+                                     **kwargs)
+        distance_fn = get_distance_fn(body, joints, weights=weights)
+        return plan_in_parallel(worker_fn, workers=workers, race=race, max_time=kwargs.get('max_time', INF),
+                                cost_fn=lambda path: sum(distance_fn(*pair) for pair in get_pairs(path)))
     if (weights is None) and (resolutions is not None):
         with np.errstate(divide='ignore'): ## YANG
             weights = np.reciprocal(resolutions)
@@ -3909,22 +4760,37 @@ def plan_joint_motion(body, joints, end_conf, obstacles=[], attachments=[],
     extend_fn = get_extend_fn(body, joints, resolutions=resolutions)
     collision_fn = get_collision_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
                                     custom_limits=custom_limits, max_distance=max_distance,
-                                    use_aabb=use_aabb, cache=cache)
+                                    use_aabb=use_aabb, cache=cache, broad_phase=broad_phase, adaptive=adaptive)
+
+    # Nearest neighbor queries embed joints without limits on the unit circle
+    circular = {i for i, joint in enumerate(joints) if is_circular(body, joint)}
 
     start_conf = get_joint_positions(body, joints)
     if not check_initial_end(start_conf, end_conf, collision_fn):
         return None
 
-    if algorithm is None:
-        return birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn, **kwargs)
-    return solve(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn, algorithm=algorithm, **kwargs)
+    def plan_fn(extend_fn):
+        if algorithm is None:
+            return birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
+                         circular=circular, **kwargs)
+        return solve(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
+                     algorithm=algorithm, circular=circular, **kwargs)
+    if certify:
+        # Certification validates whole edges, so it is applied to lazily planned paths
+        edge_fn = get_certified_edge_fn(body, joints, obstacles, attachments, self_collisions, disabled_collisions,
+                                        custom_limits=custom_limits, max_distance=max_distance,
+                                        use_aabb=use_aabb, cache=cache, broad_phase=broad_phase)
+        return plan_lazily(plan_fn, extend_fn, collision_fn, edge_fn=edge_fn)
+    if lazy:
+        return plan_lazily(plan_fn, extend_fn, collision_fn)
+    return plan_fn(extend_fn)
     #return plan_lazy_prm(start_conf, end_conf, sample_fn, extend_fn, collision_fn)
 
 plan_holonomic_motion = plan_joint_motion
 
 def plan_lazy_prm(start_conf, end_conf, sample_fn, extend_fn, collision_fn, **kwargs):
     # TODO: cost metric based on total robot movement (encouraging greater distances possibly)
-    from motion_planners.lazy_prm import lazy_prm
+    from .planners import lazy_prm
     path, samples, edges, colliding_vertices, colliding_edges = lazy_prm(
         start_conf, end_conf, sample_fn, extend_fn, collision_fn, num_samples=200, **kwargs)
     if path is None:
@@ -4005,7 +4871,8 @@ def plan_nonholonomic_motion(body, joints, end_conf, obstacles=[], attachments=[
                              self_collisions=True, disabled_collisions=set(),
                              weights=None, resolutions=None, reversible=True,
                              linear_tol=EPSILON, angular_tol=0.,
-                             max_distance=MAX_DISTANCE, use_aabb=False, cache=True, custom_limits={}, algorithm=None, **kwargs):
+                             max_distance=MAX_DISTANCE, use_aabb=False, cache=True, custom_limits={}, algorithm=None,
+                             lattice=False, **kwargs):
 
     assert len(joints) == len(end_conf) == 3
     sample_fn = get_sample_fn(body, joints, custom_limits=custom_limits)
@@ -4021,6 +4888,15 @@ def plan_nonholonomic_motion(body, joints, end_conf, obstacles=[], attachments=[
     start_conf = get_joint_positions(body, joints)
     if not check_initial_end(start_conf, end_conf, collision_fn):
         return None
+    if lattice:
+        # Falls back to sampling if Bullet rejects the path planned over the motion primitive lattice
+        from pybullet_tools.grids import plan_lattice_motion
+        path = plan_lattice_motion(body, joints, end_conf, obstacles=obstacles,
+                                   weights=get_default_weights(body, joints, weights), reversible=reversible,
+                                   extend_fn=extend_fn, collision_fn=collision_fn, start_conf=start_conf,
+                                   custom_limits=custom_limits)
+        if path is not None:
+            return path
 
     if algorithm is None:
         return birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn, **kwargs)
@@ -4048,7 +4924,7 @@ def get_base_distance_fn(weights=1*np.ones(3)):
 
 def plan_base_motion(body, end_conf, base_limits, obstacles=[], direct=False,
                      weights=1*np.ones(3), resolutions=0.05*np.ones(3),
-                     max_distance=MAX_DISTANCE, algorithm=None, **kwargs):
+                     max_distance=MAX_DISTANCE, algorithm=None, lazy=False, grid=False, **kwargs):
     def sample_fn():
         x, y = np.random.uniform(*base_limits)
         theta = np.random.uniform(*CIRCULAR_LIMITS)
@@ -4076,11 +4952,28 @@ def plan_base_motion(body, end_conf, base_limits, obstacles=[], direct=False,
     if not check_initial_end(start_conf, end_conf, collision_fn):
         return None
 
+    if direct and lazy:
+        return check_path([start_conf, end_conf], extend_fn, collision_fn, bisect=True)
     if direct:
         return direct_path(start_conf, end_conf, extend_fn, collision_fn)
-    if algorithm is None:
-        return birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn, **kwargs)
-    return solve(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn, algorithm=algorithm, **kwargs)
+    if grid:
+        # Falls back to sampling if Bullet rejects the path planned over the occupancy grid
+        from pybullet_tools.grids import plan_grid_base_motion
+        path = plan_grid_base_motion(body, end_conf, base_limits, obstacles=obstacles, weights=weights,
+                                     extend_fn=extend_fn, collision_fn=collision_fn, start_conf=start_conf)
+        if path is not None:
+            return path
+
+    def plan_fn(extend_fn):
+        # theta wraps around
+        if algorithm is None:
+            return birrt(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
+                         circular={2}, **kwargs)
+        return solve(start_conf, end_conf, distance_fn, sample_fn, extend_fn, collision_fn,
+                     algorithm=algorithm, circular={2}, **kwargs)
+    if lazy:
+        return plan_lazily(plan_fn, extend_fn, collision_fn)
+    return plan_fn(extend_fn)
 
 #####################################
 
@@ -4702,6 +5595,40 @@ def interpolate_poses(pose1, pose2, pos_step_size=0.01, ori_step_size=np.pi/16):
         yield (pos, quat)
     yield pose2
 
+def interpolate_points_array(point1, point2, step_size=1e-2):
+    # Same points as interpolate_points as a single (k, 3) array
+    num_steps = max(2, int(math.ceil(get_distance(point1, point2) / step_size)))
+    fractions = np.linspace(0, 1, num=num_steps, endpoint=True)[:, np.newaxis]
+    return (1 - fractions)*np.array(point1, dtype=float) + fractions*np.array(point2, dtype=float)
+
+def slerp_quats(quat1, quat2, fractions):
+    # Vectorized quat_combination that returns a (k, 4) array of quaternions
+    quat1 = np.array(quat1, dtype=float) / np.linalg.norm(quat1)
+    quat2 = np.array(quat2, dtype=float) / np.linalg.norm(quat2)
+    fractions = np.array(fractions, dtype=float)
+    d = np.dot(quat1, quat2)
+    if abs(abs(d) - 1.) < 1e-6:
+        quats = np.tile(quat1, (len(fractions), 1))
+    else:
+        sign = -1. if d < 0 else 1. # Shortest path
+        angle = math.acos(sign*d)
+        quats = (np.sin((1. - fractions)*angle)[:, np.newaxis]*quat1 +
+                 np.sin(fractions*angle)[:, np.newaxis]*sign*quat2) / math.sin(angle)
+    quats[fractions == 0.] = quat1
+    quats[fractions == 1.] = quat2
+    return quats
+
+def interpolate_poses_array(pose1, pose2, pos_step_size=0.01, ori_step_size=np.pi/16):
+    # Same poses as interpolate_poses as stacked (k, 3) positions and (k, 4) quaternions
+    pos1, quat1 = pose1
+    pos2, quat2 = pose2
+    num_steps = max(2, int(math.ceil(max(
+        np.divide(get_pose_distance(pose1, pose2), [pos_step_size, ori_step_size])))))
+    fractions = np.linspace(0, 1, num=num_steps, endpoint=True)
+    positions = (1 - fractions[:, np.newaxis])*np.array(pos1, dtype=float) + \
+                fractions[:, np.newaxis]*np.array(pos2, dtype=float)
+    return positions, slerp_quats(quat1, quat2, fractions)
+
 def interpolate(value1, value2, num_steps=2):
     num_steps = max(num_steps, 2)
     yield value1
@@ -4721,6 +5648,19 @@ def interpolate_waypoints(interpolate_fn, waypoints, returns_first=True):
                 continue
             yield value
 
+def interpolate_waypoints_array(interpolate_fn, waypoints, returns_first=True):
+    # Stacks the arrays returned by an array interpolate_fn, such as get_extend_array_fn, along a path
+    # The first row of a segment is only dropped when it repeats the previous waypoint
+    if len(waypoints) <= 1:
+        return np.array(waypoints, dtype=float)
+    segments = [np.array(waypoints[:1], dtype=float)]
+    for waypoint1, waypoint2 in get_pairs(waypoints):
+        segment = np.array(interpolate_fn(waypoint1, waypoint2), dtype=float)
+        if returns_first and (len(segment) != 0) and all_close(segment[0], segments[-1][-1]):
+            segment = segment[1:]
+        segments.append(segment)
+    return np.vstack(segments)
+
 # def workspace_trajectory(robot, link, start_point, direction, quat, **kwargs):
 #     # TODO: pushing example
 #     # TODO: just use current configuration?
@@ -4746,26 +5686,67 @@ def get_null_space(robot, joints, custom_limits={}):
     joint_ranges = 10*np.ones(len(joints))
     return NullSpace(list(lower), list(upper), list(joint_ranges), list(rest_positions))
 
-def create_sub_robot(robot, first_joint, target_link):
-    # TODO: create a class or generator for repeated use
+def create_sub_robot(robot, first_joint, target_link, client=None):
     selected_links = get_link_subtree(robot, first_joint) # TODO: child_link_from_joint?
     selected_joints = prune_fixed_joints(robot, selected_links)
     assert(target_link in selected_links)
     sub_target_link = selected_links.index(target_link)
-    sub_robot = clone_body(robot, links=selected_links, visual=False, collision=False) # TODO: joint limits
-    assert len(selected_joints) == len(get_movable_joints(sub_robot))
+    sub_robot = clone_body(robot, links=selected_links, visual=False, collision=False, client=client) # TODO: joint limits
+    with ClientSaver(client):
+        assert len(selected_joints) == len(get_movable_joints(sub_robot))
     return sub_robot, selected_joints, sub_target_link
 
+SUB_ROBOT_CLIENT = None
+SUB_ROBOTS = {}
+
+def get_sub_robot_client():
+    # Sub-robots live in their own client so they never appear in get_bodies() of the planning world
+    global SUB_ROBOT_CLIENT
+    if (SUB_ROBOT_CLIENT is None) or not p.isConnected(physicsClientId=SUB_ROBOT_CLIENT):
+        with HideOutput():
+            SUB_ROBOT_CLIENT = p.connect(p.DIRECT)
+        CLIENTS[SUB_ROBOT_CLIENT] = None
+        SUB_ROBOTS.clear()
+    return SUB_ROBOT_CLIENT
+
+def get_sub_robot(robot, first_joint, target_link):
+    # Reuses one sub-robot per (robot, first_joint, target_link) and resets it rather than cloning for every query
+    client = get_sub_robot_client()
+    key = (CLIENT, robot, get_model_info(robot), first_joint, target_link)
+    if key not in SUB_ROBOTS:
+        sub_robot, selected_joints, sub_target_link = create_sub_robot(robot, first_joint, target_link, client=client)
+        with ClientSaver(client):
+            sub_pose = get_pose(sub_robot)
+        base_from_sub = multiply(invert(get_link_pose(robot, get_link_parent(robot, first_joint))), sub_pose)
+        SUB_ROBOTS[key] = (sub_robot, selected_joints, sub_target_link, get_link_subtree(robot, first_joint), base_from_sub)
+    sub_robot, selected_joints, sub_target_link, selected_links, base_from_sub = SUB_ROBOTS[key]
+    # Matches the state of a freshly cloned sub-robot
+    base_pose = get_link_pose(robot, get_link_parent(robot, first_joint))
+    positions = get_joint_positions(robot, selected_links)
+    with ClientSaver(client):
+        set_pose(sub_robot, multiply(base_pose, base_from_sub))
+        set_joint_positions(sub_robot, range(len(selected_links)), positions)
+    return sub_robot, selected_joints, sub_target_link
+
+def remove_sub_robots():
+    if SUB_ROBOT_CLIENT is not None:
+        with ClientSaver(SUB_ROBOT_CLIENT):
+            for sub_robot, _, _, _, _ in SUB_ROBOTS.values():
+                remove_body(sub_robot)
+    SUB_ROBOTS.clear()
+
 def multiple_sub_inverse_kinematics(robot, first_joint, target_link, target_pose, max_attempts=1, max_solutions=INF,
                                     max_time=INF, custom_limits={}, first_close=True, **kwargs):
     # TODO: gradient descent using collision_info
     start_time = time.time()
     ancestor_joints = prune_fixed_joints(robot, get_ordered_ancestors(robot, target_link))
     affected_joints = ancestor_joints[ancestor_joints.index(first_joint):]
-    sub_robot, selected_joints, sub_target_link = create_sub_robot(robot, first_joint, target_link)
+    sub_robot, selected_joints, sub_target_link = get_sub_robot(robot, first_joint, target_link)
+    client = get_sub_robot_client()
     #sub_joints = get_movable_joints(sub_robot)
     #sub_from_real = dict(safe_zip(sub_joints, selected_joints))
-    sub_joints = prune_fixed_joints(sub_robot, get_ordered_ancestors(sub_robot, sub_target_link))
+    with ClientSaver(client):
+        sub_joints = prune_fixed_joints(sub_robot, get_ordered_ancestors(sub_robot, sub_target_link))
     selected_joints = affected_joints
     #sub_from_real = dict(safe_zip(sub_joints, selected_joints))
 
@@ -4776,14 +5757,16 @@ def multiple_sub_inverse_kinematics(robot, first_joint, target_link, target_pose
     for attempt in irange(max_attempts):
         if (len(solutions) >= max_solutions) or (elapsed_time(start_time) >= max_time):
             break
-        if not first_close or (attempt >= 1): # TODO: multiple seed confs
-            sub_conf = sample_fn()
-            set_joint_positions(sub_robot, sub_joints, sub_conf)
-        sub_kinematic_conf = inverse_kinematics(sub_robot, sub_target_link, target_pose,
-                                                max_time=max_time-elapsed_time(start_time), **kwargs)
+        sub_conf = sample_fn() if (not first_close or (attempt >= 1)) else None # TODO: multiple seed confs
+        with ClientSaver(client):
+            if sub_conf is not None:
+                set_joint_positions(sub_robot, sub_joints, sub_conf)
+            sub_kinematic_conf = inverse_kinematics(sub_robot, sub_target_link, target_pose,
+                                                    max_time=max_time-elapsed_time(start_time), **kwargs)
+            if sub_kinematic_conf is not None:
+                #set_configuration(sub_robot, sub_kinematic_conf)
+                sub_kinematic_conf = get_joint_positions(sub_robot, sub_joints)
         if sub_kinematic_conf is not None:
-            #set_configuration(sub_robot, sub_kinematic_conf)
-            sub_kinematic_conf = get_joint_positions(sub_robot, sub_joints)
             set_joint_positions(robot, selected_joints, sub_kinematic_conf)
             kinematic_conf = get_configuration(robot) # TODO: test on the resulting robot state (e.g. collisions)
             #if not all_between(lower_limits, kinematic_conf, upper_limits):
@@ -4791,11 +5774,15 @@ def multiple_sub_inverse_kinematics(robot, first_joint, target_link, target_pose
     if solutions:
         set_configuration(robot, solutions[-1])
     # TODO: test for redundant configurations
-    remove_body(sub_robot)
     return solutions
 
 def plan_cartesian_motion(robot, first_joint, target_link, waypoint_poses,
-                          max_iterations=200, max_time=INF, custom_limits={}, **kwargs):
+                          max_iterations=200, max_time=INF, custom_limits={}, extrapolate=False, **kwargs):
+    """
+    Solves the waypoints one at a time, warm starting each from the solution of the previous waypoint
+    :param extrapolate: if True, instead warm starts each waypoint by linearly extrapolating the solutions
+                        of the previous two waypoints, which saves IK iterations along smooth paths
+    """
     # TODO: fix stationary joints
     # TODO: pass in set of movable joints and take least common ancestor
     # TODO: update with most recent bullet updates
@@ -4803,52 +5790,49 @@ def plan_cartesian_motion(robot, first_joint, target_link, waypoint_poses,
     # https://github.com/bulletphysics/bullet3/blob/master/examples/pybullet/examples/inverse_kinematics_husky_kuka.py
     # TODO: plan a path without needing to following intermediate waypoints
 
-    from pybullet_tools.bullet_utils import nice  ## YANG
-
     lower_limits, upper_limits = get_custom_limits(robot, get_movable_joints(robot), custom_limits)
-    sub_robot, selected_joints, sub_target_link = create_sub_robot(robot, first_joint, target_link)
-    sub_joints = get_movable_joints(sub_robot)
+    sub_robot, selected_joints, sub_target_link = get_sub_robot(robot, first_joint, target_link)
+    client = get_sub_robot_client()
+    with ClientSaver(client):
+        sub_joints = get_movable_joints(sub_robot)
     #null_space = get_null_space(robot, selected_joints, custom_limits=custom_limits)
     null_space = None
 
-    solutions = []
-    for target_pose in waypoint_poses:
-        # print(f'pddlstream.plan_cartesian_motion | target_pose {nice(target_pose)}')
+    def iterative_fn(target_pose):
         start_time = time.time()
         for iteration in irange(max_iterations):
             if elapsed_time(start_time) >= max_time:
-                remove_body(sub_robot)
                 return None
             sub_kinematic_conf = inverse_kinematics_helper(sub_robot, sub_target_link, target_pose, null_space=null_space)
             if sub_kinematic_conf is None:
-                remove_body(sub_robot)
                 return None
-
-            # print(f'pddlstream.plan_cartesian_motion | {iteration}\t {nice(sub_kinematic_conf)}')
             set_joint_positions(sub_robot, sub_joints, sub_kinematic_conf)
-            # print(f'\t link pose {get_link_pose(sub_robot, sub_target_link)}')
             if is_pose_close(get_link_pose(sub_robot, sub_target_link), target_pose, **kwargs):
-                # print(f'\t is close {get_link_pose(sub_robot, sub_target_link)}')
-                set_joint_positions(robot, selected_joints, sub_kinematic_conf)
-                kinematic_conf = get_configuration(robot)
-                if not all_between(lower_limits, kinematic_conf, upper_limits):
-                    # print(f'\t out of limits {kinematic_conf} lower {lower_limits} upper {upper_limits}')
-
-                    #movable_joints = get_movable_joints(robot)
-                    #print([(get_joint_name(robot, j), l, v, u) for j, l, v, u in
-                    #       zip(movable_joints, lower_limits, kinematic_conf, upper_limits) if not (l <= v <= u)])
-                    #print("Limits violated")
-                    #wait_if_gui()
-                    remove_body(sub_robot)
-                    return None
                 #print("IK iterations:", iteration)
-                solutions.append(kinematic_conf)
-                break
-        else:
-            remove_body(sub_robot)
+                return sub_kinematic_conf
+        return None
+
+    solutions = []
+    sub_solutions = []
+    for target_pose in waypoint_poses:
+        with ClientSaver(client):
+            if extrapolate and (len(sub_solutions) >= 2):
+                seed_conf = 2*np.array(sub_solutions[-1]) - np.array(sub_solutions[-2])
+                set_joint_positions(sub_robot, sub_joints, seed_conf)
+            sub_kinematic_conf = iterative_fn(target_pose)
+        if sub_kinematic_conf is None:
+            return None
+        sub_solutions.append(sub_kinematic_conf)
+        set_joint_positions(robot, selected_joints, sub_kinematic_conf)
+        kinematic_conf = get_configuration(robot)
+        if not all_between(lower_limits, kinematic_conf, upper_limits):
+            #movable_joints = get_movable_joints(robot)
+            #print([(get_joint_name(robot, j), l, v, u) for j, l, v, u in
+            #       zip(movable_joints, lower_limits, kinematic_conf, upper_limits) if not (l <= v <= u)])
+            #print("Limits violated")
+            #wait_if_gui()
             return None
-    # TODO: finally:
-    remove_body(sub_robot)
+        solutions.append(kinematic_conf)
     return solutions
 
 def sub_inverse_kinematics(robot, first_joint, target_link, target_pose, **kwargs):